@@ -0,0 +1,178 @@
+"""Parser and encoder micro-benchmarks over captured and generated packets, reporting time and allocations per
+operation. Run with python -m benchmarks.codec [--json out.json] [--baseline old.json --threshold 0.1]"""
+import gc
+import json
+import sys
+import time
+import timeit
+import tracemalloc
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional
+
+from resolver.buffer import ByteBuffer
+from resolver.packet import DnsHeader, DnsMessage, LazyDnsMessage
+from resolver.record_type import QType
+from tests.fixtures import a_record, ns_record, cname_record, soa_record, response
+from tests.fixtures import RESPONSE_NS_ROOT, RESPONSE_DNS_FRAME_A_WITH_JUMP, RESPONSE_A_NS_BERKELEY, \
+    QUERY_A_ROOT_SERVER
+
+MIN_TIME = 0.2  # Seconds each timing run lasts at least
+REPEAT = 5  # Timing runs per case, the fastest one is reported
+
+
+def large_response(records: int) -> bytes:
+    """Response to an A query with records answers under one zone plus matching NS and glue, names compress well"""
+    zone = "bench.example.com"
+    answer = [a_record(f"www.{zone}", f"10.{i >> 8 & 255}.{i & 255}.1", ttl=300) for i in range(records)]
+    nameservers = [f"ns{i}.{zone}" for i in range(4)]
+    return response(f"www.{zone}", QType.A, answer=answer,
+                    authority=[ns_record(zone, ns) for ns in nameservers],
+                    additional=[a_record(ns, f"192.0.2.{i + 1}") for i, ns in enumerate(nameservers)]).build_bytes()
+
+
+def mixed_response(records: int) -> bytes:
+    """Response mixing CNAME, A, NS and SOA records with many distinct names, stresses name decoding"""
+    answer = [cname_record("alias.mixed.example.org", "target.mixed.example.org")]
+    answer += [a_record(f"host{i}.sub{i % 7}.mixed.example.org", f"172.16.{i >> 8 & 255}.{i & 255}")
+               for i in range(records)]
+    return response("alias.mixed.example.org", QType.A, answer=answer,
+                    authority=[soa_record("mixed.example.org")]).build_bytes()
+
+
+def large_referral(nameservers: int) -> bytes:
+    """Glued referral for a deep zone to nameservers sharing one long suffix, as TLD and hosting referrals are -
+    every NS and glue owner name is a pointer chain into the same suffix"""
+    zone = "customer.zone.hosting.example.com"
+    names = [f"ns{i}.anycast.dns-servers.hosting-provider.example.net" for i in range(nameservers)]
+    return response(f"www.{zone}", QType.A, authority=[ns_record(zone, ns) for ns in names],
+                    additional=[a_record(ns, f"198.51.100.{i % 250 + 1}") for i, ns in enumerate(names)]).build_bytes()
+
+
+def packets() -> dict[str, bytes]:
+    return {
+        "query_a_root_server": bytes.fromhex(QUERY_A_ROOT_SERVER),
+        "a_ns_berkeley": bytes.fromhex(RESPONSE_A_NS_BERKELEY),
+        "a_with_jump": bytes.fromhex(RESPONSE_DNS_FRAME_A_WITH_JUMP),
+        "ns_root": bytes.fromhex(RESPONSE_NS_ROOT),
+        "large_a_256": large_response(256),
+        "mixed_1000": mixed_response(1000),
+        "referral_13": large_referral(13),
+        "referral_100": large_referral(100),
+    }
+
+
+def operations(data: bytes) -> dict[str, Callable[[], object]]:
+    """Benchmarked operations over one packet"""
+    message = DnsMessage().from_bytes(data)
+    return {
+        "header": lambda: DnsHeader().from_buffer(ByteBuffer(data)),
+        "parse": lambda: DnsMessage().from_bytes(data),
+        "lazy_index": lambda: LazyDnsMessage().from_bytes(data).skip_sections(),
+        "build": lambda: message.build_bytes(),
+        "roundtrip": lambda: DnsMessage().from_bytes(data).build_bytes(),
+    }
+
+
+@dataclass
+class Result:
+    case: str  # packet/operation
+    size: int  # Packet size in bytes
+    ns_per_op: float
+    peak_bytes: int  # Highest memory held above the starting point during one operation
+    blocks: int  # Memory blocks allocated by one operation and still referenced by its result
+
+    def concise_info(self) -> str:
+        return f"{self.case.ljust(34)}{self.size:8d} B{self.ns_per_op:14.0f} ns/op" \
+               f"{self.peak_bytes:12d} B peak{self.blocks:8d} blocks"
+
+
+def time_op(fn: Callable[[], object], min_time: float = MIN_TIME, repeat: int = REPEAT) -> float:
+    """Nanoseconds per call of the fastest of repeat runs, each at least min_time long"""
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / elapsed))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def trace_op(fn: Callable[[], object]) -> tuple[int, int]:
+    """Peak bytes and number of live blocks allocated by one call, result is kept alive while measuring"""
+    fn()  # Warm up caches such as interned names so that they are not attributed to the operation
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        start = tracemalloc.take_snapshot()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - start_bytes
+        end = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]  # Snapshots allocate too
+    diff = end.filter_traces(own).compare_to(start.filter_traces(own), "filename")
+    blocks = sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+    del result
+    return peak, blocks
+
+
+def run(selected: Optional[str] = None, min_time: float = MIN_TIME, repeat: int = REPEAT) -> list[Result]:
+    """Runs benchmarks whose packet/operation name contains selected"""
+    results = []
+    for name, data in packets().items():
+        for op, fn in operations(data).items():
+            case = f"{name}/{op}"
+            if selected and selected not in case:
+                continue
+            peak, blocks = trace_op(fn)
+            results.append(Result(case, len(data), time_op(fn, min_time, repeat), peak, blocks))
+    return results
+
+
+def regressions(results: list[Result], baseline: dict, threshold: float) -> list[str]:
+    """Describes cases slower than in baseline by more than threshold, a fraction e.g. 0.1 for 10%"""
+    previous = {r["case"]: r for r in baseline["results"]}
+    found = []
+    for result in results:
+        old = previous.get(result.case)
+        if old is None:
+            continue
+        change = result.ns_per_op / old["ns_per_op"] - 1
+        if change > threshold:
+            found.append(f"{result.case}: {old['ns_per_op']:.0f} -> {result.ns_per_op:.0f} ns/op ({change:+.1%})")
+    return found
+
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(description="DNS codec benchmarks")
+    parser.add_argument("-k", "--select", type=str, help="Only run cases whose packet/operation contains this")
+    parser.add_argument("--json", type=str, help="Writes results as JSON to the file, - for stdout")
+    parser.add_argument("--baseline", type=str, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Fails when a case is slower than baseline by more than this fraction")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME, help="Seconds each timing run lasts at least")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="Timing runs per case")
+    arg = parser.parse_args(argv)
+
+    results = run(arg.select, arg.min_time, arg.repeat)
+    report = {"python": sys.version.split()[0], "time": time.time(), "results": [asdict(r) for r in results]}
+    if arg.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"python {report['python']}")
+        for result in results:
+            print(result.concise_info())
+        if arg.json:
+            with open(arg.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if arg.baseline:
+        with open(arg.baseline) as f:
+            found = regressions(results, json.load(f), arg.threshold)
+        for line in found:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""Load benchmark of the server mode - queries per second answered from cache by 1..N SO_REUSEPORT workers,
+driven by closed-loop UDP load generator processes against a stub upstream on localhost.
+Run with python -m benchmarks.load [--workers 1,2,4] [--clients 4] [--duration 5]"""
+import functools
+import json
+import multiprocessing
+import os
+import random
+import select
+import socket
+import sys
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+
+from resolver.cache import ResponseCache
+from resolver.packet import DnsMessage
+from resolver.record_type import QType
+from resolver.resolver import create_query
+from resolver.server import forward_to
+from resolver.workers import Supervisor, free_port, serve_worker
+from tests.fixtures import StubServer, a_record, answer_with
+
+NAMES = 200  # Distinct names queried, all of them answered from cache once warm
+WINDOW = 64  # Queries each generator keeps outstanding
+DURATION = 5.0
+
+
+def upstream(query: DnsMessage):
+    return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+
+def queries(names: int) -> list[bytes]:
+    return [create_query(f"host{i}.load.example.com", QType.A).build_bytes() for i in range(names)]
+
+
+def generate(port: int, names: int, duration: float, window: int, host: str = "127.0.0.1") -> int:
+    """Keeps window queries outstanding for duration seconds, returns number of responses received
+    Queries lost or dropped are replaced after a quiet period of 100ms"""
+    packets = queries(names)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        sock.connect((host, port))
+
+        def send(count: int):
+            for _ in range(count):
+                try:
+                    sock.send(random.choice(packets))
+                except BlockingIOError:
+                    return
+
+        received = 0
+        send(window)
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            if not select.select([sock], [], [], 0.1)[0]:
+                send(window)
+                continue
+            while True:
+                try:
+                    sock.recv(4096)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                received += 1
+                send(1)
+        return received
+
+
+def warm(port: int, names: int, timeout: float = 10.0):
+    """Waits for the workers to answer and puts every name in their caches. Each client address is hashed onto one
+    worker, so every name is queried from many source ports to reach all of them"""
+    deadline = time.monotonic() + timeout
+    packets = queries(names)
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(0.5)
+            sock.connect(("127.0.0.1", port))
+            try:
+                sock.send(packets[0])
+                sock.recv(4096)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No worker answered on port {port}")
+    for _ in range(16):
+        generate(port, names, 0.05, window=names)
+
+
+@dataclass
+class Result:
+    workers: int
+    clients: int
+    responses: int
+    seconds: float
+
+    @property
+    def qps(self) -> float:
+        return self.responses / self.seconds
+
+    def concise_info(self, base_qps: float) -> str:
+        return f"{self.workers:3d} workers {self.clients:3d} clients {self.qps:12.0f} qps" \
+               f"{self.qps / base_qps:8.2f}x"
+
+
+def measure(workers: int, clients: int, upstream_port: int, names: int = NAMES, duration: float = DURATION,
+            window: int = WINDOW) -> Result:
+    port = free_port()
+    make_resolve = functools.partial(forward_to, "127.0.0.1", upstream_port, ResponseCache())
+    with Supervisor(functools.partial(serve_worker, make_resolve, "127.0.0.1", port), workers):
+        warm(port, names)
+        with multiprocessing.get_context("fork").Pool(clients) as pool:
+            started = time.monotonic()
+            counts = pool.starmap(generate, [(port, names, duration, window)] * clients)
+            elapsed = time.monotonic() - started
+    return Result(workers, clients, sum(counts), elapsed)
+
+
+def run(workers: list[int], clients: int, names: int = NAMES, duration: float = DURATION,
+        window: int = WINDOW) -> list[Result]:
+    with StubServer(upstream) as stub:
+        return [measure(count, clients, stub.port, names, duration, window) for count in workers]
+
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(description="DNS server load benchmark")
+    parser.add_argument("--workers", type=str, default=f"1,2,{max(2, (os.cpu_count() or 1) // 2)}",
+                        help="Comma separated worker counts to measure")
+    parser.add_argument("--clients", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="Load generator processes")
+    parser.add_argument("--duration", type=float, default=DURATION, help="Seconds of load per worker count")
+    parser.add_argument("--window", type=int, default=WINDOW, help="Queries each generator keeps outstanding")
+    parser.add_argument("--names", type=int, default=NAMES, help="Distinct names queried")
+    parser.add_argument("--json", type=str, help="Writes results as JSON to the file, - for stdout")
+    arg = parser.parse_args(argv)
+
+    counts = sorted({int(n) for n in arg.workers.split(",")})
+    results = run(counts, arg.clients, arg.names, arg.duration, arg.window)
+    report = {"python": sys.version.split()[0], "cpus": os.cpu_count(), "time": time.time(),
+              "results": [dict(asdict(r), qps=r.qps) for r in results]}
+    if arg.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"python {report['python']}, {report['cpus']} cpus")
+        for result in results:
+            print(result.concise_info(results[0].qps))
+        if arg.json:
+            with open(arg.json, "w") as f:
+                json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
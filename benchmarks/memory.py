@@ -0,0 +1,80 @@
+"""Resident memory per decoded record - keeps records of many parsed responses alive and measures
+allocations with tracemalloc. Records are measured as decoded and in the representation used before records were
+slotted, __dict__ dataclasses holding names that are not interned. Run with python -m benchmarks.memory"""
+import gc
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from typing import Any
+
+from resolver.packet import DnsMessage, DnsResourceRecord
+from resolver.record_type import RData
+from tests.fixtures import RESPONSE_NS_ROOT, RESPONSE_A_NS_BERKELEY
+
+MESSAGES = 2000
+
+
+class DictRData:
+    """RDATA kept in a per instance __dict__ as before records were slotted, presentation text is not memoized"""
+
+    def __init__(self, rdata: RData):
+        for cls in type(rdata).__mro__:
+            for slot in getattr(cls, "__slots__", ()):
+                if slot != "_text":
+                    setattr(self, slot, _fresh(getattr(rdata, slot)))
+
+
+@dataclass
+class DictRecord:
+    """Resource record as a plain dataclass, the representation before records were slotted"""
+    name: str
+    qtype: Any
+    qclass: Any
+    ttl: int
+    rdlength: int
+    rdata: DictRData
+
+
+def _fresh(value):
+    """Copy of a str which is not interned, as names decoded by every message used to be"""
+    return value.encode().decode() if isinstance(value, str) else value
+
+
+def legacy_record(rr: DnsResourceRecord) -> DictRecord:
+    return DictRecord(_fresh(rr.name), rr.qtype, rr.qclass, rr.ttl, rr.rdlength, DictRData(rr.rdata))
+
+
+def resident_bytes_per_record(packet: str, messages: int = MESSAGES, render: bool = True,
+                              legacy: bool = False) -> float:
+    """Average bytes held per resource record once all records of messages copies of packet are decoded
+    render also formats every record once, as printers and resolved_ns do, so memoized text is accounted for
+    legacy keeps the records converted to the representation used before records were slotted"""
+    data = bytes.fromhex(packet)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = []
+    for _ in range(messages):
+        msg = DnsMessage().from_bytes(data)
+        decoded = msg.answer + msg.authority + msg.additional
+        records.extend([legacy_record(rr) for rr in decoded] if legacy else decoded)
+    if render and not legacy:
+        for rr in records:
+            str(rr.rdata)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(records)
+
+
+def main():
+    print(f"python {sys.version.split()[0]}")
+    packets = (("NS_ROOT (14 NS, 26 A/AAAA)", RESPONSE_NS_ROOT), ("A_NS_BERKELEY (1 A)", RESPONSE_A_NS_BERKELEY))
+    for label, packet in packets:
+        old = resident_bytes_per_record(packet, legacy=True)
+        new = resident_bytes_per_record(packet)
+        print(f"{label.ljust(30)} {old:8.1f} -> {new:8.1f} B/record ({new / old - 1:+.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Startup-to-warm time of a resolver restoring its caches from a snapshot - time until the first answer can be
+served from cache and until every restored entry was served once, for caches of several sizes.
+Run with python -m benchmarks.snapshot [--entries 1000,10000,50000]"""
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.snapshot import load_snapshot, save_snapshot
+from tests.fixtures import a_record, ns_record, referral, response
+
+ENTRIES = "1000,10000,50000"
+
+
+def populated(entries: int) -> tuple[ResponseCache, DelegationCache]:
+    """Caches holding entries answers of four A records with NS and glue, spread over entries // 10 zones"""
+    cache, delegations = ResponseCache(max_entries=None), DelegationCache(max_zones=entries)
+    for i in range(entries):
+        zone = f"zone{i // 10}.example"
+        name = f"host{i}.{zone}"
+        nameservers = {f"ns{j}.{zone}": f"192.0.2.{j + 1}" for j in range(2)}
+        cache.put(response(name, answer=[a_record(name, f"10.{i >> 16 & 255}.{i >> 8 & 255}.{j}", ttl=3600)
+                                         for j in range(4)],
+                           authority=[ns_record(zone, ns, ttl=3600) for ns in nameservers],
+                           additional=[a_record(ns, addr, ttl=3600) for ns, addr in nameservers.items()]))
+        if i % 10 == 0:
+            delegations.add_referral(referral(name, zone, nameservers))
+    return cache, delegations
+
+
+@dataclass
+class Result:
+    entries: int
+    file_bytes: int
+    save_ms: float
+    load_ms: float  # Restoring the caches from the snapshot
+    first_answer_ms: float  # From start of loading until the first cached answer is served
+    warm_ms: float  # From start of loading until every restored answer was served once
+    eager_ms: float  # Loading and decoding every message up front, as a loader parsing the whole file would
+
+    def concise_info(self) -> str:
+        return f"{self.entries:8d} entries{self.file_bytes / 1e6:9.1f} MB  save {self.save_ms:8.1f} ms" \
+               f"  load {self.load_ms:8.1f} ms  first answer {self.first_answer_ms:8.1f} ms" \
+               f"  warm {self.warm_ms:8.1f} ms  eager decode {self.eager_ms:8.1f} ms"
+
+
+def measure(entries: int, directory: str) -> Result:
+    cache, delegations = populated(entries)
+    names = [name for name, _, _ in cache.entries]
+    path = os.path.join(directory, f"cache-{entries}.snap")
+    started = time.perf_counter()
+    save_snapshot(path, cache, delegations)
+    save_ms = (time.perf_counter() - started) * 1000
+    del cache, delegations
+
+    restored, restored_delegations = ResponseCache(max_entries=None), DelegationCache(max_zones=entries)
+    started = time.perf_counter()
+    load_snapshot(path, restored, restored_delegations)
+    loaded = time.perf_counter()
+    restored.get(names[0], "A")
+    first = time.perf_counter()
+    for name in names:
+        restored.get(name, "A")
+    warm = time.perf_counter()
+
+    eager = ResponseCache(max_entries=None)
+    eager_started = time.perf_counter()
+    load_snapshot(path, eager)
+    for entry in eager.entries.values():
+        entry.message.materialize()
+    eager_ms = (time.perf_counter() - eager_started) * 1000
+    return Result(entries, os.path.getsize(path), save_ms, (loaded - started) * 1000, (first - started) * 1000,
+                  (warm - started) * 1000, eager_ms)
+
+
+def run(entries: list[int]) -> list[Result]:
+    with tempfile.TemporaryDirectory() as directory:
+        return [measure(count, directory) for count in entries]
+
+
+def main(argv=None) -> int:
+    parser = ArgumentParser(description="Cache snapshot startup-to-warm benchmark")
+    parser.add_argument("--entries", type=str, default=ENTRIES, help="Comma separated cache sizes to measure")
+    parser.add_argument("--json", type=str, help="Writes results as JSON to the file, - for stdout")
+    arg = parser.parse_args(argv)
+
+    results = run([int(n) for n in arg.entries.split(",")])
+    report = {"python": sys.version.split()[0], "time": time.time(), "results": [asdict(r) for r in results]}
+    if arg.json == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"python {report['python']}")
+        for result in results:
+            print(result.concise_info())
+        if arg.json:
+            with open(arg.json, "w") as f:
+                json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
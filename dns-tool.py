@@ -1,7 +1,20 @@
 #!/usr/bin/env python
+import asyncio
+import functools
+import json
+import signal
+import struct
+import sys
 from argparse import ArgumentParser
+from typing import Optional
 
-from resolver import recursive_lookup, lookup
+from resolver import recursive_lookup, lookup, alookup, arecursive_lookup, query_metrics, response_cache
+from resolver.bulk import BulkSummary, resolve_stream
+from resolver.pcap import DNS_PORTS, CaptureSummary, read_messages
+from resolver.server import DnsServer, forward_to, recurse
+from resolver.snapshot import keep_snapshot
+from resolver.workers import Supervisor, free_port, serve_worker
+from resolver.trace import Span
 
 DEFAULT_RECORD_TYPE = "A"
 DEFAULT_DNS_SERVER = "1.1.1.1"
@@ -12,17 +25,126 @@ parser = ArgumentParser(description="DNS Lookup Tool",
                               f"\tyahoo.com aaaa @8.8.8.8  -> AAAA record types @8.8.8.8\n"
                               f"\t. ns                     -> root name servers\n"
                               f"\tyahoo.com a --norecurse  -> non-recursive query\n"
-                              f"\tyahoo.com mx --trace     -> recursive resolve for AAAA")
+                              f"\tyahoo.com mx --trace     -> recursive resolve for AAAA\n"
+                              f"\tyahoo.com --trace --waterfall -> timing of every query of a recursive resolve\n"
+                              f"\t--input names.txt mx     -> bulk resolve \"qname [record_type]\" lines, - for stdin\n"
+                              f"\tserve --port 5353        -> caching forwarder to 1.1.1.1, see serve --help\n"
+                              f"\tpcap capture.pcap --json -> DNS messages of a packet capture, see pcap --help")
 
-parser.add_argument("qname", type=str, help="Domain name to be queried")
+parser.add_argument("qname", type=str, nargs="?", help="Domain name to be queried")
 parser.add_argument("record_type", type=str, nargs="?", default="A", help="Record type e.g. A, AAAA, MX...")
 parser.add_argument("dns_server_ip", type=str, nargs="?", default="@1.1.1.1",
                     help="IPv4 address of a DNS server to ask e.g. @8.8.8.8 or @192.168.1.1")
 parser.add_argument("--norecurse", action="store_true", help="Queries with recursion_desired = False")
 parser.add_argument("-t", "--trace", action="store_true", help="Performs recursive lookup")
+parser.add_argument("--tcp", action="store_true", help="Queries over TCP instead of UDP")
+parser.add_argument("-i", "--input", type=str, help="File with one \"qname [record_type]\" per line, - for stdin")
+parser.add_argument("-c", "--concurrency", type=int, default=100, help="Queries in flight in bulk mode")
+parser.add_argument("--waterfall", action="store_true", help="Prints timing of every query as a waterfall chart")
+parser.add_argument("--trace-json", type=str, help="Writes spans of every query as JSON to the file, - for stdout")
+parser.add_argument("--stats", type=str, nargs="?", const="-",
+                    help="Writes query metrics in Prometheus text format to the file when done, stderr if omitted")
+
+serve_parser = ArgumentParser(prog="dns-tool.py serve", description="Caching DNS server answering over UDP and TCP")
+serve_parser.add_argument("--listen", type=str, default="127.0.0.1", help="Address to listen on")
+serve_parser.add_argument("--port", type=int, default=53, help="Port to listen on, both UDP and TCP")
+serve_parser.add_argument("--upstream", type=str, default=f"@{DEFAULT_DNS_SERVER}",
+                          help="Resolver to forward queries to e.g. @8.8.8.8 or @127.0.0.1:5300")
+serve_parser.add_argument("-t", "--trace", action="store_true",
+                          help="Resolves iteratively from the root instead of forwarding")
+serve_parser.add_argument("--max-pending", type=int, default=10000, help="Queries in flight before dropping more")
+serve_parser.add_argument("--workers", type=int, default=1,
+                          help="Worker processes sharing the port through SO_REUSEPORT, each with a cache of its own")
+serve_parser.add_argument("--cache-file", type=str,
+                          help="Snapshot of the caches restored on start and saved periodically and on exit")
+serve_parser.add_argument("--snapshot-interval", type=float, default=300.0, help="Seconds between cache snapshots")
+serve_parser.add_argument("--serve-stale", type=float, default=0.0, metavar="SECONDS",
+                          help="Answer with responses expired up to SECONDS ago when upstream is slow or failing")
+
+pcap_parser = ArgumentParser(prog="dns-tool.py pcap", description="Decodes DNS messages of a pcap or pcapng capture")
+pcap_parser.add_argument("file", type=str, help="Capture file")
+pcap_parser.add_argument("--json", action="store_true", help="Prints one JSON object per message instead of summaries")
+pcap_parser.add_argument("-p", "--port", type=int, action="append",
+                         help="Port carrying DNS, may be repeated, 53 if omitted")
+
+
+async def process_bulk(source, qtype: str, dns_ip: str, run_trace: bool, dont_recurse: bool, concurrency: int,
+                       transport: str):
+    async def resolve(qname, record_type):
+        if run_trace:
+            return await arecursive_lookup(qname, record_type, output=False)
+        return await alookup(qname, record_type, server_ip=dns_ip, recursive=(not dont_recurse), verbose=False,
+                             output=False, transport=transport)
+
+    summary = BulkSummary()
+    async for result in resolve_stream(source, resolve, concurrency, default_qtype=qtype):
+        summary.add(result)
+        print(result.concise_info(), flush=True)
+    print(summary.report(), file=sys.stderr)
+
+
+async def serve(resolve, host: str, port: int, max_pending: int, mode: str, cache_file: Optional[str],
+                snapshot_interval: float):
+    snapshot = asyncio.ensure_future(keep_snapshot(cache_file, snapshot_interval)) if cache_file else None
+    server = DnsServer(resolve, host, port, max_pending=max_pending)
+    await server.start()
+    print(f"Serving on {host}:{server.port} udp/tcp, {mode}", file=sys.stderr, flush=True)
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        if snapshot is not None:
+            snapshot.cancel()
+            await asyncio.gather(snapshot, return_exceptions=True)
+
+
+def process_serve(argv: list[str]):
+    arg = serve_parser.parse_args(argv)
+    response_cache.stale_window = arg.serve_stale
+    if arg.trace:
+        make_resolve, mode = recurse, "recursive"
+    else:
+        upstream_ip, _, upstream_port = arg.upstream.lstrip("@").partition(":")
+        make_resolve = functools.partial(forward_to, upstream_ip, int(upstream_port or 53))
+        mode = f"forwarding to {arg.upstream.lstrip('@')}"
+
+    if arg.workers <= 1:
+        asyncio.run(serve(make_resolve(), arg.listen, arg.port, arg.max_pending, mode, arg.cache_file,
+                          arg.snapshot_interval))
+        return
+
+    port = arg.port or free_port(arg.listen)
+    supervisor = Supervisor(functools.partial(serve_worker, make_resolve, arg.listen, port, arg.max_pending,
+                                              arg.cache_file, arg.snapshot_interval), arg.workers)
+    signal.signal(signal.SIGTERM, lambda *_: setattr(supervisor, "stopping", True))
+    print(f"Serving on {arg.listen}:{port} udp/tcp with {arg.workers} workers, {mode}", file=sys.stderr, flush=True)
+    supervisor.run()
+
+
+def process_pcap(argv: list[str]):
+    arg = pcap_parser.parse_args(argv)
+    summary = CaptureSummary()
+    try:
+        for captured in read_messages(arg.file, arg.port or DNS_PORTS, summary):
+            print(json.dumps(captured.to_dict()) if arg.json else captured.summary())
+    except (OSError, ValueError, struct.error) as e:
+        print(f"dns-tool.py pcap: {arg.file}: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(summary.report(), file=sys.stderr)
 
 
 def process_request():
+    if sys.argv[1:2] == ["pcap"]:
+        process_pcap(sys.argv[2:])
+        return
+
+    if sys.argv[1:2] == ["serve"]:
+        try:
+            process_serve(sys.argv[2:])
+        except KeyboardInterrupt:
+            pass
+        return
+
     arg = parser.parse_args()
 
     domain_name: str = arg.qname
@@ -30,6 +152,15 @@ def process_request():
     dns_ip: str = arg.dns_server_ip
     run_trace: bool = arg.trace
     dont_recurse: bool = arg.norecurse
+    transport = "tcp" if arg.tcp else "udp"
+
+    if arg.input:
+        # No qname in bulk mode, positionals hold record type and server only
+        positionals = [p for p in (domain_name, qtype, dns_ip) if p]
+        dns_ip = next((p for p in positionals if p.startswith("@")), f"@{DEFAULT_DNS_SERVER}")
+        qtype = positionals[0] if not positionals[0].startswith("@") else DEFAULT_RECORD_TYPE
+    elif domain_name is None:
+        parser.error("the following arguments are required: qname")
 
     if qtype.startswith("@"):
         if dns_ip:
@@ -39,10 +170,31 @@ def process_request():
 
     dns_ip = dns_ip.lstrip("@")
 
-    if run_trace:
-        _ = recursive_lookup(domain_name, qtype)
+    if arg.input:
+        source = sys.stdin if arg.input == "-" else open(arg.input)
+        with source:
+            asyncio.run(process_bulk(source, qtype, dns_ip, run_trace, dont_recurse, arg.concurrency, transport))
     else:
-        _ = lookup(domain_name, qtype, server_ip=dns_ip, recursive=(not dont_recurse))
+        trace = Span(f"{domain_name} {qtype.upper()}", kind="lookup") if arg.waterfall or arg.trace_json else None
+        if run_trace:
+            response = recursive_lookup(domain_name, qtype, trace=trace)
+        else:
+            response = lookup(domain_name, qtype, server_ip=dns_ip, recursive=(not dont_recurse),
+                              transport=transport, trace=trace)
+        if trace is not None:
+            trace.finish(response.header.response_code.name if response is not None else "TIMEOUT")
+            if arg.waterfall:
+                print(trace.waterfall())
+            if arg.trace_json == "-":
+                print(trace.to_json())
+            elif arg.trace_json:
+                with open(arg.trace_json, "w") as f:
+                    f.write(trace.to_json())
+
+    if arg.stats == "-":
+        print(query_metrics.to_prometheus(), file=sys.stderr, end="")
+    elif arg.stats:
+        query_metrics.write_prometheus(arg.stats)
 
 
 if __name__ == "__main__":
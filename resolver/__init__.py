@@ -1 +1,8 @@
-from resolver.resolver import lookup, recursive_lookup
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.metrics import MetricsRegistry, ResolverMetrics
+from resolver.policy import QueryPolicy
+from resolver.selection import ServerStatsTable
+from resolver.edns import EdnsProfileTable
+from resolver.resolver import lookup, recursive_lookup, alookup, arecursive_lookup, response_cache, delegation_cache, \
+    server_stats, query_metrics, query_policy, edns_profiles
+from resolver.trace import Span
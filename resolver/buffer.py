@@ -1,71 +1,217 @@
-from dataclasses import dataclass
+import struct
+import sys
+from dataclasses import dataclass, field
+
+UINT16 = struct.Struct("!H")
+UINT32 = struct.Struct("!I")
+MAX_POINTER = 0x3FFF  # Compression pointers hold 14 bit offsets
+MAX_NAME_LENGTH = 255  # Octets of a name in wire format including length prefixes and the root label, RFC1035 2.3.4
+
+
+def encode_name(domain_name: str) -> bytes:
+    """Returns uncompressed wire format of a domain name - length prefixed labels terminated by the root label"""
+    domain_name = domain_name.strip(".")  # Remove trailing and leading '.'
+    if not domain_name:
+        return b"\x00"
+    return b"".join([bytes((len(label),)) + label for label in domain_name.encode().split(b".")]) + b"\x00"
 
 
 @dataclass
 class ByteBuffer:
+    """Read cursor over a DNS datagram, parsing is done in place through a memoryview so no slices are copied
+    until a value is actually extracted"""
     buf: bytes
     pos: int = 0
+    view: memoryview = field(init=False, repr=False, compare=False)
+    names: dict[int, tuple[str, int, int]] = field(init=False, repr=False, compare=False)  # Offset -> name, size, end
+
+    def __post_init__(self):
+        self.view = memoryview(self.buf)
+        self.names = {}
 
     def skip(self, n: int):
         self.pos += n
         return self
 
     def read_uint8(self):
-        result = int.from_bytes(self.buf[self.pos:self.pos + 1], byteorder="big", signed=False)
+        result = self.view[self.pos]
         self.pos += 1
         return result
 
     def peek_uint16(self):
-        return int.from_bytes(self.buf[self.pos:self.pos + 2], byteorder="big", signed=False)
+        return UINT16.unpack_from(self.view, self.pos)[0]
 
     def read_uint16(self):
-        result = self.peek_uint16()
+        result = UINT16.unpack_from(self.view, self.pos)[0]
         self.pos += 2
         return result
 
     def peek_uint32(self):
-        part = self.buf[self.pos:self.pos + 4]
-        return int.from_bytes(part, byteorder="big", signed=False)
+        return UINT32.unpack_from(self.view, self.pos)[0]
 
     def read_uint32(self):
-        result = self.peek_uint32()
+        result = UINT32.unpack_from(self.view, self.pos)[0]
         self.pos += 4
         return result
 
-    def read_plain(self, num_bytes: int):
-        result = self.peek_plain(num_bytes)
+    def read_bytes(self, num_bytes: int) -> bytes:
+        result = self.peek_bytes(num_bytes)
         self.pos += num_bytes
         return result
 
-    def peek_plain(self, num_bytes: int):
-        return self.buf[self.pos:self.pos + num_bytes].hex()
+    def peek_bytes(self, num_bytes: int) -> bytes:
+        if self.pos + num_bytes > len(self.view):
+            raise ValueError(f"Cannot read {num_bytes} bytes at offset {self.pos}, buffer holds {len(self.view)}")
+        return self.view[self.pos:self.pos + num_bytes].tobytes()
 
-    # Jumps implemented but not error safe (loop jumps?)
-    def read_qname(self):
-        result: list[str] = []
-        has_jumped = False
-        pos_return = -1
+    def read_plain(self, num_bytes: int):
+        """Hex str compatibility wrapper around read_bytes"""
+        return self.read_bytes(num_bytes).hex()
+
+    def peek_plain(self, num_bytes: int):
+        """Hex str compatibility wrapper around peek_bytes"""
+        return self.peek_bytes(num_bytes).hex()
 
-        label_length = self.buf[self.pos]
+    def skip_qname(self):
+        """Moves the cursor past a possibly compressed name without decoding it or following pointers"""
+        view = self.view
+        label_length = view[self.pos]
         while label_length > 0:
-            self.pos += 1
             if (label_length & 0xC0) == 0xC0:
-                if not has_jumped:
-                    pos_return = self.pos + 1
-                offset1 = label_length
-                offset2 = self.buf[self.pos]
-                pos_target = ((offset1 ^ 0xC0) << 8) | offset2
-                self.pos = pos_target
-                has_jumped = True
-            else:
-                label = self.buf[self.pos:self.pos + label_length].decode()
-                result.append(label)
-                self.pos += label_length
-            label_length = self.buf[self.pos]
-
-        if has_jumped:
-            self.pos = pos_return
-        else:
-            self.pos += 1
-
-        return ".".join(result)
+                self.pos += 2
+                return self
+            self.pos += label_length + 1
+            label_length = view[self.pos]
+        self.pos += 1
+        return self
+
+    def read_qname(self):
+        """Decodes a possibly compressed name at the cursor and moves the cursor past it
+        Every suffix decoded is memoized by its offset, names pointing at a suffix already seen in the message reuse
+        it instead of decoding its labels again. Raises ValueError on compression pointers not leading strictly
+        before the labels they follow - these would allow loops - on names over MAX_NAME_LENGTH octets, reserved
+        label types and names running past the end of the message"""
+        view, names = self.view, self.names
+        size = len(view)
+        labels: list[tuple[int, str, int]] = []  # Offset, label and index of its run of every label read
+        run_ends: list[int] = []  # Offset following each run of labels up to a pointer or the root label
+        length = 0
+        pos = limit = self.pos
+        while True:
+            memo = names.get(pos)
+            if memo is not None:
+                suffix, suffix_length, memo_end = memo
+                run_ends.append(memo_end)
+                break
+            if pos >= size:
+                raise ValueError(f"Name at offset {self.pos} runs past the end of the message")
+            label_length = view[pos]
+            if label_length == 0:
+                suffix, suffix_length = "", 1
+                run_ends.append(pos + 1)
+                break
+            if label_length & 0xC0 == 0xC0:
+                if pos + 1 >= size:
+                    raise ValueError(f"Name at offset {self.pos} runs past the end of the message")
+                target = (label_length & 0x3F) << 8 | view[pos + 1]
+                if target >= limit:
+                    raise ValueError(f"Compression pointer at offset {pos} leads to {target}, not before {limit}")
+                run_ends.append(pos + 2)
+                pos = limit = target
+                continue
+            if label_length & 0xC0:
+                raise ValueError(f"Unsupported label type {label_length >> 6:#b} at offset {pos}")
+            length += label_length + 1
+            if length >= MAX_NAME_LENGTH:
+                raise ValueError(f"Name at offset {self.pos} is longer than {MAX_NAME_LENGTH} octets")
+            labels.append((pos, str(view[pos + 1:pos + 1 + label_length], "utf-8"), len(run_ends)))
+            pos += label_length + 1
+        if length + suffix_length > MAX_NAME_LENGTH:
+            raise ValueError(f"Name at offset {self.pos} is longer than {MAX_NAME_LENGTH} octets")
+        self.pos = run_ends[0]
+
+        name, name_length = suffix, suffix_length
+        for offset, label, run in reversed(labels):
+            name = f"{label}.{name}" if name else label
+            name_length += view[offset] + 1
+            names[offset] = (name, name_length, run_ends[run])
+        return sys.intern(name)  # Owner and target names repeat across records, share one str
+
+
+@dataclass
+class ByteWriter:
+    """Write cursor encoding a DNS datagram straight into a preallocated bytearray, grows on demand
+    Every name written with write_qname is recorded in a compression table shared by the whole message, so later
+    occurrences of the name or any of its suffixes are replaced by a pointer as defined in RFC1035 4.1.4"""
+    buf: bytearray = field(default_factory=lambda: bytearray(512))
+    pos: int = 0
+    compress: bool = True
+    names: dict[str, int] = field(default_factory=dict, repr=False)  # Lowercase name suffix -> message offset
+
+    def _reserve(self, n: int):
+        missing = self.pos + n - len(self.buf)
+        if missing > 0:
+            self.buf.extend(bytes(max(missing, len(self.buf))))
+
+    def write_uint8(self, value: int):
+        self._reserve(1)
+        self.buf[self.pos] = value
+        self.pos += 1
+        return self
+
+    def write_uint16(self, value: int):
+        self._reserve(2)
+        UINT16.pack_into(self.buf, self.pos, value)
+        self.pos += 2
+        return self
+
+    def write_uint32(self, value: int):
+        self._reserve(4)
+        UINT32.pack_into(self.buf, self.pos, value)
+        self.pos += 4
+        return self
+
+    def write_struct(self, fmt: struct.Struct, *values):
+        """Packs values with a precompiled struct at the cursor"""
+        self._reserve(fmt.size)
+        fmt.pack_into(self.buf, self.pos, *values)
+        self.pos += fmt.size
+        return self
+
+    def write_bytes(self, data: bytes):
+        n = len(data)
+        self._reserve(n)
+        self.buf[self.pos:self.pos + n] = data
+        self.pos += n
+        return self
+
+    def set_uint16(self, offset: int, value: int):
+        """Overwrites already written uint16 at offset e.g. to backfill RDLENGTH"""
+        UINT16.pack_into(self.buf, offset, value)
+        return self
+
+    def write_qname(self, domain_name: str):
+        """Writes domain name as a sequence of length prefixed labels terminated by the root label
+        The longest suffix already present in the message is replaced with a compression pointer"""
+        domain_name = domain_name.strip(".")
+        if not self.compress or not domain_name:
+            return self.write_bytes(encode_name(domain_name))
+
+        names = self.names
+        key = domain_name.lower()
+        offset = 0
+        for label, lowered in zip(domain_name.split("."), key.split(".")):
+            suffix = key[offset:]
+            pointer = names.get(suffix)
+            if pointer is not None:
+                return self.write_uint16(0xC000 | pointer)
+            if self.pos <= MAX_POINTER:
+                names[suffix] = self.pos
+            encoded = label.encode()
+            self.write_uint8(len(encoded))
+            self.write_bytes(encoded)
+            offset += len(lowered) + 1
+        return self.write_uint8(0)
+
+    def getvalue(self) -> bytes:
+        return bytes(memoryview(self.buf)[:self.pos])
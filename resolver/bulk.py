@@ -0,0 +1,125 @@
+import asyncio
+import itertools
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional
+
+from resolver.metrics import LatencyHistogram
+from resolver.packet import DnsMessage
+from resolver.record_type import QType
+
+READ_BATCH = 256  # Lines read from input per executor call
+
+Resolve = Callable[[str, QType], Awaitable[Optional[DnsMessage]]]
+
+
+@dataclass
+class BulkResult:
+    qname: str
+    qtype: str
+    response: Optional[DnsMessage] = None
+    latency: float = 0.0  # Seconds
+    error: Optional[str] = None  # Set when no response could be obtained, e.g. TIMEOUT
+
+    @property
+    def status(self) -> str:
+        if self.error:
+            return self.error
+        return self.response.header.response_code.name
+
+    def concise_info(self) -> str:
+        answers = [str(ans.rdata) for ans in self.response.answer] if self.response else []
+        return "\t".join([self.qname, self.qtype, self.status, f"{self.latency * 1000:.1f}ms", *answers])
+
+
+class BulkSummary:
+    """Aggregates results of a bulk run in constant memory"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statuses: Counter[str] = Counter()
+        self.latency = LatencyHistogram()
+
+    def add(self, result: BulkResult):
+        self.statuses[result.status] += 1
+        if result.response is not None:
+            self.latency.observe(result.latency)
+
+    @property
+    def total(self) -> int:
+        return sum(self.statuses.values())
+
+    @property
+    def errors(self) -> int:
+        return sum(n for status, n in self.statuses.items() if status != "NO_ERROR")
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        qps = self.total / elapsed if elapsed > 0 else 0.0
+        statuses = ", ".join(f"{status}: {n}" for status, n in self.statuses.most_common())
+        return f"<<SUMMARY>> {self.total} queries in {elapsed:.2f}s, {qps:.1f} qps\n" \
+               f"answered latency p50: {self.latency.quantile(0.5) * 1000:.1f}ms, " \
+               f"p99: {self.latency.quantile(0.99) * 1000:.1f}ms, max: {self.latency.max * 1000:.1f}ms\n" \
+               f"errors: {self.errors} ({statuses})"
+
+
+def parse_line(line: str, default_qtype: str = "A") -> Optional[tuple[str, str]]:
+    """Parses "qname [qtype]" input line, returns None for blank lines and # comments"""
+    fields = line.split("#", 1)[0].split()
+    if not fields:
+        return None
+    return fields[0], (fields[1] if len(fields) > 1 else default_qtype).upper()
+
+
+async def resolve_stream(lines: Iterable[str],
+                         resolve: Resolve,
+                         concurrency: int = 100,
+                         default_qtype: str = "A") -> AsyncIterator[BulkResult]:
+    """Resolves "qname [qtype]" lines with at most concurrency queries in flight and yields results as they
+    complete, in completion order. Input is consumed lazily so memory stays flat regardless of its size"""
+    loop = asyncio.get_running_loop()
+    source: Iterator[str] = iter(lines)
+    questions: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+
+    async def produce():
+        # Reading happens in an executor so that a slow stdin does not stall in-flight queries
+        try:
+            while batch := await loop.run_in_executor(None, lambda: list(itertools.islice(source, READ_BATCH))):
+                for line in batch:
+                    question = parse_line(line, default_qtype)
+                    if question is not None:
+                        await questions.put(question)
+        finally:
+            for _ in range(concurrency):
+                await questions.put(None)
+
+    async def work():
+        while (question := await questions.get()) is not None:
+            qname, qtype = question
+            if qtype not in QType.__members__:
+                await results.put(BulkResult(qname, qtype, error="BADTYPE"))
+                continue
+            started = time.perf_counter()
+            try:
+                response = await resolve(qname, QType[qtype])
+                error = None if response is not None else "TIMEOUT"
+            except Exception as e:
+                response, error = None, type(e).__name__
+            await results.put(BulkResult(qname, qtype, response, time.perf_counter() - started, error))
+        await results.put(None)
+
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        running = concurrency
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+        await tasks[0]  # Propagate input errors
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,364 @@
+import copy
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Optional, Union
+
+from resolver.packet import DnsMessage, DnsResourceRecord
+from resolver.record_type import QClass, QType, RCode
+from resolver.root_hints import ROOT_HINTS
+
+CacheKey = tuple[str, QType, QClass]
+
+
+def normalize_name(domain_name: str) -> str:
+    """Lowercase domain name without surrounding dots, root zone is represented by an empty str"""
+    return domain_name.strip(".").lower()
+
+
+def in_bailiwick(domain_name: str, zone: str) -> bool:
+    """Whether normalized domain_name equals or lies below normalized zone"""
+    return not zone or domain_name == zone or domain_name.endswith("." + zone)
+
+
+def cache_key(qname: str, qtype: Union[QType, str], qclass: QClass = QClass.IN) -> CacheKey:
+    """Normalizes a question into the key used by the caches - lowercase name without surrounding dots"""
+    if not isinstance(qtype, QType):
+        qtype = QType[qtype.upper()]
+    return normalize_name(qname), qtype, qclass
+
+
+@dataclass
+class CacheEntry:
+    message: DnsMessage
+    stored: float  # Clock reading at insertion, TTLs of the message are relative to it
+    expires: float
+    size: int  # Wire size of the message in bytes
+    negative: bool = False
+    hits: int = 0
+    prefetched: bool = False  # Stored by a background refresh rather than on behalf of a client
+
+
+class ResponseCache:
+    """In-process LRU cache of DNS responses keyed by (qname, qtype, qclass)
+
+    Positive answers live for the smallest TTL found in the answer section. NXDOMAIN and NODATA answers are cached
+    as defined in RFC2308 - for the smaller of the SOA record TTL and SOA MINIMUM field, responses without SOA in
+    authority section are not cached at all. Least recently used entries are evicted once either max_entries or
+    max_bytes (sum of wire sizes) budget is exceeded. Returned messages have their TTLs decreased by the time spent
+    in cache
+
+    Entries hit at least prefetch_hits times are due for prefetch once a hit falls within the last prefetch_window
+    fraction of their TTL, the caller then refreshes them in the background so that hot names never expire.
+    max_prefetches bounds refreshes running at once, prefetch_hits=None turns prefetching off
+
+    Expired entries are kept for stale_window more seconds, get misses them but get_stale still returns them with
+    TTLs of stale_ttl, for answering clients when the authoritative servers cannot be reached as in RFC8767"""
+
+    def __init__(self,
+                 max_entries: Optional[int] = 10000,
+                 max_bytes: Optional[int] = None,
+                 max_ttl: int = 86400,
+                 max_negative_ttl: int = 3600,
+                 clock: Callable[[], float] = time.monotonic,
+                 prefetch_hits: Optional[int] = 2,
+                 prefetch_window: float = 0.1,
+                 max_prefetches: int = 16,
+                 stale_window: float = 0.0,
+                 stale_ttl: int = 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.clock = clock
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_window = prefetch_window
+        self.max_prefetches = max_prefetches
+        self.stale_window = stale_window
+        self.stale_ttl = stale_ttl
+        self.entries: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched_hits = 0  # Hits served by entries a prefetch stored, the hits prefetching saved from a miss
+        self.stale_hits = 0
+
+    def get(self, qname: str, qtype: Union[QType, str], qclass: QClass = QClass.IN,
+            prefetch: Optional[Callable[[], None]] = None) -> Optional[DnsMessage]:
+        """Returns a copy of cached response with TTLs aged by the time spent in cache or None on miss
+        prefetch is called when the entry hit is due for prefetch"""
+        key = cache_key(qname, qtype, qclass)
+        entry = self.entries.get(key)
+        now = self.clock()
+        if entry is None or entry.expires <= now:
+            if entry is not None and entry.expires + self.stale_window <= now:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        entry.hits += 1
+        if entry.prefetched:
+            self.prefetched_hits += 1
+        if prefetch is not None and self.due_for_prefetch(entry, now):
+            prefetch()
+        return aged_message(entry.message, int(now - entry.stored))
+
+    def get_stale(self, qname: str, qtype: Union[QType, str], qclass: QClass = QClass.IN) -> Optional[DnsMessage]:
+        """Returns a copy of cached response expired less than stale_window seconds ago with its TTLs capped at
+        stale_ttl, a response that has not expired yet as get does, or None"""
+        key = cache_key(qname, qtype, qclass)
+        entry = self.entries.get(key)
+        now = self.clock()
+        if entry is None or entry.expires + self.stale_window <= now:
+            return None
+        if entry.expires > now:
+            return aged_message(entry.message, int(now - entry.stored))
+        self.stale_hits += 1
+        return stale_message(entry.message, self.stale_ttl)
+
+    def has_stale(self, qname: str, qtype: Union[QType, str], qclass: QClass = QClass.IN) -> bool:
+        """Whether an expired response to the question is kept within the stale window"""
+        entry = self.entries.get(cache_key(qname, qtype, qclass))
+        now = self.clock()
+        return entry is not None and entry.expires <= now < entry.expires + self.stale_window
+
+    def due_for_prefetch(self, entry: CacheEntry, now: float) -> bool:
+        return self.prefetch_hits is not None and entry.hits >= self.prefetch_hits and \
+            entry.expires - now <= (entry.expires - entry.stored) * self.prefetch_window
+
+    def put(self, message: DnsMessage, size: Optional[int] = None, prefetched: bool = False) -> bool:
+        """Stores response under the key of its first question, returns False if the response is not cacheable
+        prefetched marks responses of background refreshes, hits on them are counted as prefetched_hits"""
+        if not message.question or message.header.truncation:
+            return False
+        ttl, negative = self.cache_ttl(message)
+        if ttl <= 0:
+            return False
+
+        q = message.question[0]
+        key = cache_key(q.name, q.qtype, q.qclass)
+        if key in self.entries:
+            self._remove(key)
+
+        now = self.clock()
+        size = size if size is not None else len(message.build_bytes())
+        self.entries[key] = CacheEntry(message, stored=now, expires=now + ttl, size=size, negative=negative,
+                                       prefetched=prefetched)
+        self.size += size
+        self._evict()
+        return True
+
+    def restore(self, key: CacheKey, entry: CacheEntry):
+        """Inserts an entry saved earlier, e.g. by a snapshot, as the most recently used one"""
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        self._evict()
+
+    def cache_ttl(self, message: DnsMessage) -> tuple[int, bool]:
+        """Returns number of seconds the response may be cached for and whether it is a negative answer"""
+        rcode = message.header.response_code
+        if rcode == RCode.NO_ERROR and message.answer:
+            return min(min(rr.ttl for rr in message.answer), self.max_ttl), False
+        if rcode in (RCode.NO_ERROR, RCode.NXDOMAIN):
+            soa = [auth for auth in message.authority if auth.qtype == QType.SOA]
+            if soa:
+                return min(soa[0].ttl, soa[0].rdata.minimum_ttl, self.max_negative_ttl), True
+        return 0, False
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "prefetched_hits": self.prefetched_hits, "stale_hits": self.stale_hits}
+
+    def _remove(self, key: CacheKey):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+    def _evict(self):
+        while self.entries and ((self.max_entries is not None and len(self.entries) > self.max_entries) or
+                                (self.max_bytes is not None and self.size > self.max_bytes)):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def __contains__(self, key: CacheKey):
+        entry = self.entries.get(key)
+        return entry is not None and entry.expires > self.clock()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def aged_record(rr: DnsResourceRecord, elapsed: int) -> DnsResourceRecord:
+    if rr.qtype == QType.OPT or elapsed <= 0:
+        return rr
+    aged = copy.copy(rr)
+    aged.ttl = max(0, rr.ttl - elapsed)
+    return aged
+
+
+def aged_message(message: DnsMessage, elapsed: int) -> DnsMessage:
+    """Returns shallow copy of the message with TTLs of its records decreased by elapsed seconds"""
+    aged = copy.copy(message)
+    aged.header = copy.copy(message.header)
+    aged.question = list(message.question)
+    aged.answer = [aged_record(rr, elapsed) for rr in message.answer]
+    aged.authority = [aged_record(rr, elapsed) for rr in message.authority]
+    aged.additional = [aged_record(rr, elapsed) for rr in message.additional]
+    return aged
+
+
+def stale_message(message: DnsMessage, ttl: int) -> DnsMessage:
+    """Returns shallow copy of an expired message with TTLs of its records capped at ttl"""
+    stale = copy.copy(message)
+    stale.header = copy.copy(message.header)
+    stale.question = list(message.question)
+    stale.answer = [capped_record(rr, ttl) for rr in message.answer]
+    stale.authority = [capped_record(rr, ttl) for rr in message.authority]
+    stale.additional = [capped_record(rr, ttl) for rr in message.additional]
+    return stale
+
+
+def capped_record(rr: DnsResourceRecord, ttl: int) -> DnsResourceRecord:
+    if rr.qtype == QType.OPT or rr.ttl <= ttl:
+        return rr
+    capped = copy.copy(rr)
+    capped.ttl = ttl
+    return capped
+
+
+@dataclass
+class Delegation:
+    zone: str
+    nameservers: list[str]
+    expires: float
+
+
+@dataclass
+class AddressEntry:
+    addresses: list[str]
+    expires: float
+
+
+class DelegationCache:
+    """Infrastructure cache of zone cuts - NS names of every delegated zone seen in referrals along with addresses
+    of these nameservers harvested from glue in the additional section or resolved separately
+
+    Lets iterative resolution start at the deepest known ancestor zone of the queried name instead of the root.
+    Root zone is seeded from built-in root hints and never expires"""
+
+    def __init__(self, max_zones: int = 10000, max_ttl: int = 86400, clock: Callable[[], float] = time.monotonic):
+        self.max_zones = max_zones
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self.zones: OrderedDict[str, Delegation] = OrderedDict()
+        self.addresses: dict[str, AddressEntry] = {}
+        self._add_root_hints()
+
+    def _add_root_hints(self):
+        self.zones[""] = Delegation("", list(ROOT_HINTS), expires=math.inf)
+        for name, addr in ROOT_HINTS.items():
+            self.addresses[name] = AddressEntry([addr], expires=math.inf)
+
+    def add_referral(self, response: DnsMessage, bailiwick: str = "") -> Optional[str]:
+        """Records zone cut from NS records in authority section of a referral along with matching glue A records
+        Referrals for zones outside of the queried server's zone (bailiwick) or not below it are ignored
+        Returns the delegated zone or None if the response holds no acceptable delegation"""
+        ns_records = [auth for auth in response.authority if auth.qtype == QType.NS]
+        if not ns_records or not response.question:
+            return None
+
+        zone = normalize_name(ns_records[0].name)
+        bailiwick = normalize_name(bailiwick)
+        qname = normalize_name(response.question[0].name)
+        if zone == bailiwick or not in_bailiwick(zone, bailiwick) or not in_bailiwick(qname, zone):
+            return None
+
+        now = self.clock()
+        nameservers = [normalize_name(str(auth.rdata)) for auth in ns_records if normalize_name(auth.name) == zone]
+        ttl = min(min(auth.ttl for auth in ns_records), self.max_ttl)
+        self.zones[zone] = Delegation(zone, nameservers, expires=now + ttl)
+        self.zones.move_to_end(zone)
+
+        glue: dict[str, list[DnsResourceRecord]] = {}
+        for ar in response.additional:
+            if ar.qtype == QType.A and normalize_name(ar.name) in nameservers:
+                glue.setdefault(normalize_name(ar.name), []).append(ar)
+        for name, records in glue.items():
+            self.add_addresses(name, [str(ar.rdata) for ar in records], min(ar.ttl for ar in records))
+
+        if len(self.zones) > self.max_zones:
+            self._evict()
+        return zone
+
+    def add_addresses(self, ns_name: str, addresses: list[str], ttl: int):
+        """Stores IPv4 addresses of a nameserver valid for ttl seconds"""
+        if addresses and ttl > 0:
+            expires = self.clock() + min(ttl, self.max_ttl)
+            self.addresses[normalize_name(ns_name)] = AddressEntry(list(addresses), expires)
+
+    def closest(self, domain_name: str) -> tuple[str, list[tuple[str, str]]]:
+        """Returns deepest non-expired zone enclosing domain_name, for which an address of at least one nameserver
+        is known, along with (nameserver name, address) pairs to query. Falls back to root hints"""
+        labels = normalize_name(domain_name).split(".")
+        for i in range(len(labels) + 1):
+            zone = ".".join(labels[i:])
+            servers = self.servers(zone)
+            if servers:
+                self.zones.move_to_end(zone)
+                return zone, servers
+        return "", self.servers("")
+
+    def servers(self, zone: str) -> list[tuple[str, str]]:
+        """Returns (nameserver name, address) pairs of a zone with known and non-expired addresses"""
+        delegation = self.zones.get(normalize_name(zone))
+        now = self.clock()
+        if delegation is None:
+            return []
+        if delegation.expires <= now:
+            del self.zones[delegation.zone]
+            return []
+        result = []
+        for name in delegation.nameservers:
+            entry = self.addresses.get(name)
+            if entry is not None and entry.expires > now:
+                result.extend((name, addr) for addr in entry.addresses)
+        return result
+
+    def restore(self, delegation: Delegation):
+        """Inserts a zone cut saved earlier, e.g. by a snapshot, as the most recently used one"""
+        self.zones[delegation.zone] = delegation
+        self.zones.move_to_end(delegation.zone)
+        if len(self.zones) > self.max_zones:
+            self._evict()
+
+    def nameservers(self, zone: str) -> list[str]:
+        """Returns NS names of a cached zone cut or an empty list"""
+        delegation = self.zones.get(normalize_name(zone))
+        return list(delegation.nameservers) if delegation is not None else []
+
+    def clear(self):
+        self.zones.clear()
+        self.addresses.clear()
+        self._add_root_hints()
+
+    def _evict(self):
+        """Drops least recently used tenth of zones along with addresses no longer referenced by any zone"""
+        while len(self.zones) > max(self.max_zones - self.max_zones // 10, 1):
+            oldest = next(z for z in self.zones if z)  # Never evict root hints
+            del self.zones[oldest]
+        now = self.clock()
+        referenced = {name for delegation in self.zones.values() for name in delegation.nameservers}
+        for name in [name for name, entry in self.addresses.items() if entry.expires <= now or name not in referenced]:
+            del self.addresses[name]
+
+    def __len__(self):
+        return len(self.zones)
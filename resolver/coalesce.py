@@ -0,0 +1,62 @@
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, callers arriving while it is in flight await the same result
+    instead of starting a duplicate. The call runs as a task of its own so that cancelling or timing out one
+    waiting caller leaves the others and the call itself unaffected. Once every caller still waiting is cancelled
+    the call is cancelled as well, nobody is left to use its result"""
+
+    def __init__(self):
+        self.calls: dict[Hashable, asyncio.Task] = {}
+        self.waiters: dict[asyncio.Task, int] = {}  # Callers awaiting each call
+        self.coalesced = 0  # Callers served by a call started by someone else
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]], timeout: Optional[float] = None) -> T:
+        """Returns result of call() or of the call already in flight for key, raises asyncio.TimeoutError if it
+        does not complete within timeout"""
+        task = self.calls.get(key)
+        if task is None:
+            task = self.calls[key] = asyncio.ensure_future(call())
+
+            def forget(_):
+                if self.calls.get(key) is task:
+                    del self.calls[key]
+
+            task.add_done_callback(forget)
+        else:
+            self.coalesced += 1
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.CancelledError:
+            if self.waiters[task] == 1:
+                task.cancel()
+            raise
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.calls
+
+    def __len__(self):
+        return len(self.calls)
+
+
+_single_flights: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, SingleFlight]" = weakref.WeakKeyDictionary()
+
+
+def single_flight() -> SingleFlight:
+    """Returns in-flight calls of the running event loop, the sync API shares the background loop and so do all
+    threads using it"""
+    loop = asyncio.get_running_loop()
+    flight = _single_flights.get(loop)
+    if flight is None:
+        flight = _single_flights[loop] = SingleFlight()
+    return flight
@@ -0,0 +1,96 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Optional
+
+from resolver.packet import DnsMessage
+from resolver.record_type import RCode
+
+EDNS_PAYLOAD_SIZE = 1232  # Fits the IPv6 minimum MTU unfragmented, the default since DNS flag day 2020
+MIN_PAYLOAD_SIZE = 512  # Fits any path, RFC6891 requires responders to accept at least this
+
+
+@dataclass
+class EdnsProfile:
+    payload_size: int = EDNS_PAYLOAD_SIZE
+    enabled: bool = True  # False once the server rejected a query because of its OPT record
+    timeouts: int = 0  # Consecutive UDP timeouts of queries with EDNS
+    learned: float = 0.0  # Clock reading of the last change, the profile is forgotten max_age seconds later
+
+    def concise_info(self) -> str:
+        return f"edns: {'payload ' + str(self.payload_size) if self.enabled else 'disabled'}"
+
+
+class EdnsProfileTable:
+    """EDNS behaviour learned per server address, decides the payload size advertised in queries
+
+    Servers start at payload_size. After reduce_after consecutive UDP timeouts of queries with EDNS the server is
+    reduced to MIN_PAYLOAD_SIZE - large responses fragmented on the path and dropped look exactly like that.
+    A server answering a query with EDNS by FORMERR or NOTIMP without an OPT record does not implement EDNS and gets
+    queries without it. Learned profiles are forgotten after max_age seconds so that upgraded servers and repaired
+    paths are probed again"""
+
+    def __init__(self,
+                 payload_size: int = EDNS_PAYLOAD_SIZE,
+                 reduce_after: int = 2,
+                 max_age: float = 3600.0,
+                 max_entries: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.payload_size = payload_size
+        self.reduce_after = reduce_after
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.clock = clock
+        self.servers: OrderedDict[str, EdnsProfile] = OrderedDict()
+
+    def get(self, addr: str) -> EdnsProfile:
+        profile = self.servers.get(addr)
+        if profile is None or (profile.learned and profile.learned + self.max_age <= self.clock()):
+            profile = self.servers[addr] = EdnsProfile(self.payload_size)
+            if len(self.servers) > self.max_entries:
+                self.servers.popitem(last=False)
+        self.servers.move_to_end(addr)
+        return profile
+
+    def udp_payload_size(self, addr: str, requested: Optional[int]) -> Optional[int]:
+        """Payload size to advertise to addr, at most requested, None if the query should be sent without EDNS"""
+        if requested is None:
+            return None
+        profile = self.get(addr)
+        return min(requested, profile.payload_size) if profile.enabled else None
+
+    def record_response(self, addr: str, sent: Optional[int], response: DnsMessage) -> bool:
+        """Learns from the response to a query advertising sent payload size, None if it had no EDNS
+        Returns True if the server does not implement EDNS and the query should be sent again without it"""
+        if sent is None:
+            return False
+        profile = self.get(addr)
+        profile.timeouts = 0
+        if response.header.response_code in (RCode.FORMERR, RCode.NOTIMP) and response.edns() is None:
+            profile.enabled = False
+            profile.learned = self.clock()
+            return True
+        return False
+
+    def record_timeout(self, addr: str, sent: Optional[int]) -> bool:
+        """Learns from a UDP query advertising sent payload size left without response
+        Returns True if the payload size of the server has just been reduced"""
+        if sent is None or sent <= MIN_PAYLOAD_SIZE:
+            return False
+        profile = self.get(addr)
+        profile.timeouts += 1
+        if profile.timeouts < self.reduce_after or profile.payload_size <= MIN_PAYLOAD_SIZE:
+            return False
+        profile.payload_size = MIN_PAYLOAD_SIZE
+        profile.timeouts = 0
+        profile.learned = self.clock()
+        return True
+
+    def snapshot(self) -> dict[str, EdnsProfile]:
+        return {addr: replace(profile) for addr, profile in self.servers.items()}
+
+    def __str__(self):
+        return "\n".join(f"{addr.ljust(40)}{profile.concise_info()}" for addr, profile in self.servers.items())
+
+    def __len__(self):
+        return len(self.servers)
@@ -0,0 +1,247 @@
+import bisect
+import math
+import os
+import threading
+from typing import Callable
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> list[float]:
+    """Upper bounds of histogram buckets growing geometrically from start"""
+    return [start * factor ** i for i in range(count)]
+
+
+LATENCY_BUCKETS = exponential_buckets(0.0001, 1.1, 160)  # 100us up to ~400s, quantiles within 10% error
+
+
+class LatencyHistogram:
+    """Fixed size histogram of latencies in seconds, memory does not grow with the number of observations"""
+
+    def __init__(self, buckets: list[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last bucket holds observations above the highest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Returns upper bound of the bucket holding q-th quantile, 0 if nothing was observed"""
+        if self.count == 0:
+            return 0.0
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def merge(self, other: "LatencyHistogram"):
+        """Adds observations of other histogram sharing the same buckets"""
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+        return self
+
+
+INF_BOUND = 'le="+Inf"'
+EXPORT_STRIDE = 7  # Prometheus export keeps every 7th latency bucket, bounds roughly double between them
+
+CACHE_GAUGES = ("entries", "bytes")
+CACHE_COUNTERS = ("hits", "misses", "evictions", "prefetched_hits", "stale_hits")
+
+Labels = tuple[str, ...]
+Sample = tuple[str, dict[str, str], float]  # Metric name, labels, value as produced by collectors
+
+
+class Family:
+    """Metric with fixed label names whose values are recorded into per thread shards, so that recording from
+    several threads needs no lock - each shard has a single writer and shards are only merged on snapshot"""
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Labels = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.shards: list[dict] = []
+        self.local = threading.local()
+
+    def shard(self) -> dict:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            self.shards.append(shard)
+            return shard
+
+    def clear(self):
+        for shard in list(self.shards):
+            shard.clear()
+
+
+class CounterFamily(Family):
+    kind = "counter"
+
+    def inc(self, *label_values: str, value: int = 1):
+        shard = self.shard()
+        shard[label_values] = shard.get(label_values, 0) + value
+
+    def snapshot(self) -> dict[Labels, int]:
+        result = {}
+        for shard in list(self.shards):
+            for key, value in dict(shard).items():
+                result[key] = result.get(key, 0) + value
+        return result
+
+
+class HistogramFamily(Family):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Labels = (), buckets: list[float] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values: str):
+        shard = self.shard()
+        histogram = shard.get(label_values)
+        if histogram is None:
+            histogram = shard[label_values] = LatencyHistogram(self.buckets)
+        histogram.observe(value)
+
+    def snapshot(self) -> dict[Labels, LatencyHistogram]:
+        result = {}
+        for shard in list(self.shards):
+            for key, histogram in dict(shard).items():
+                result.setdefault(key, LatencyHistogram(self.buckets)).merge(histogram)
+        return result
+
+
+def format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """Named counter and histogram families plus collectors - callables returning samples computed on export,
+    e.g. sizes of caches. Exported in Prometheus text format"""
+
+    def __init__(self):
+        self.families: dict[str, Family] = {}
+        self.collectors: list[tuple[str, str, Callable[[], list[Sample]]]] = []  # Kind, description, callable
+
+    def counter(self, name: str, description: str, labels: Labels = ()) -> CounterFamily:
+        return self._register(CounterFamily(name, description, labels))
+
+    def histogram(self, name: str, description: str, labels: Labels = ()) -> HistogramFamily:
+        return self._register(HistogramFamily(name, description, labels))
+
+    def add_collector(self, collect: Callable[[], list[Sample]], kind: str = "gauge", description: str = ""):
+        self.collectors.append((kind, description, collect))
+
+    def _register(self, family):
+        if family.name in self.families:
+            raise ValueError(f"Metric {family.name} already registered")
+        self.families[family.name] = family
+        return family
+
+    def snapshot(self) -> dict[str, dict]:
+        """Returns current values of every family keyed by label values e.g. {"dns_timeouts_total": {("1.1.1.1",): 2}}
+        Histograms are returned as merged LatencyHistogram copies"""
+        return {name: family.snapshot() for name, family in self.families.items()}
+
+    def clear(self):
+        for family in self.families.values():
+            family.clear()
+
+    def to_prometheus(self) -> str:
+        """Returns all metrics in Prometheus text exposition format"""
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family.description}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for key, value in sorted(family.snapshot().items()):
+                if isinstance(value, LatencyHistogram):
+                    lines.extend(histogram_lines(name, family.labels, key, value))
+                else:
+                    lines.append(f"{name}{format_labels(family.labels, key)} {value}")
+        for kind, description, collect in self.collectors:
+            samples = collect()
+            for name in dict.fromkeys(sample[0] for sample in samples):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for sample_name, labels, value in samples:
+                    if sample_name == name:
+                        lines.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """Writes metrics for the node exporter textfile collector, the file is replaced atomically"""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+
+def histogram_lines(name: str, names: Labels, key: Labels, histogram: LatencyHistogram) -> list[str]:
+    lines = []
+    cumulative = 0
+    for i, n in enumerate(histogram.counts[:-1]):
+        cumulative += n
+        if i % EXPORT_STRIDE == EXPORT_STRIDE - 1:
+            bound = f'le="{histogram.buckets[i]:.6g}"'
+            lines.append(f"{name}_bucket{format_labels(names, key, bound)} {cumulative}")
+    lines.append(f"{name}_bucket{format_labels(names, key, INF_BOUND)} {histogram.count}")
+    lines.append(f"{name}_sum{format_labels(names, key)} {histogram.sum:.9g}")
+    lines.append(f"{name}_count{format_labels(names, key)} {histogram.count}")
+    return lines
+
+
+class ResolverMetrics(MetricsRegistry):
+    """Metrics recorded by lookups - queries, responses by RCODE, failures and latency per server and QType"""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = self.counter("dns_queries_total", "Queries sent upstream",
+                                    ("server", "qtype", "transport"))
+        self.responses = self.counter("dns_responses_total", "Responses received by RCODE", ("server", "rcode"))
+        self.timeouts = self.counter("dns_timeouts_total", "Queries left without response", ("server", "qtype"))
+        self.errors = self.counter("dns_errors_total", "Queries failed with a socket error or an undecodable response",
+                                   ("server",))
+        self.truncated = self.counter("dns_truncated_total", "UDP responses with TC flag set", ("server",))
+        self.retries = self.counter("dns_retries_total", "Queries sent again by reason", ("server", "reason"))
+        self.coalesced = self.counter("dns_coalesced_total", "Callers served by an identical call already in flight",
+                                      ("kind",))
+        self.prefetches = self.counter("dns_prefetches_total", "Background refreshes of hot cache entries by outcome",
+                                       ("outcome",))
+        self.edns_fallbacks = self.counter("dns_edns_fallbacks_total", "Servers whose EDNS payload size was reduced "
+                                           "or EDNS disabled", ("server", "action"))
+        self.stale = self.counter("dns_stale_answers_total", "Expired answers served instead of a slow or failed "
+                                  "resolution by reason", ("reason",))
+        self.latency = self.histogram("dns_query_duration_seconds", "Time from query sent to response received",
+                                      ("server", "qtype"))
+
+    def add_cache(self, name: str, stats: Callable[[], dict[str, int]]):
+        """Exports counters of a cache returning them from stats e.g. ResponseCache.stats"""
+        def collect(keys: tuple[str, ...], suffix: str = ""):
+            return lambda: [(f"dns_cache_{key}{suffix}", {"cache": name}, value) for key, value in stats().items()
+                            if key in keys]
+
+        self.add_collector(collect(CACHE_GAUGES), description="Current size of the cache")
+        self.add_collector(collect(CACHE_COUNTERS, "_total"), kind="counter", description="Cache lookups and evictions")
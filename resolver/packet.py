@@ -1,12 +1,18 @@
-import binascii
+import struct
 
 from dataclasses import dataclass, field
 from datetime import timedelta
 
-from typing import Union, Literal
-from resolver.buffer import ByteBuffer
-from resolver.record_type import RCode, QClass, QType, RData, RecordFactory
-from resolver.utility import to_qname, fqdn
+from collections.abc import Sequence
+from typing import Callable, Optional, Union, Literal
+from resolver.buffer import UINT16, ByteBuffer, ByteWriter
+from resolver.record_type import OPTRecord, RCode, QClass, QType, RData, RecordFactory
+from resolver.utility import fqdn, slotted
+
+HEADER = struct.Struct("!6H")  # ID, flags, QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT
+QUESTION_FIXED = struct.Struct("!2H")  # QTYPE, QCLASS
+RR_FIXED = struct.Struct("!2HIH")  # TYPE, CLASS, TTL, RDLENGTH
+EDNS_DO = 0x8000  # DNSSEC OK flag within the TTL of OPT record
 
 
 #   0  1  2  3  4  5  6  7  8  9  0  1  2  3  4  5
@@ -23,6 +29,7 @@ from resolver.utility import to_qname, fqdn
 # +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
 # |                    ARCOUNT                    |
 # +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+@slotted
 @dataclass
 class DnsHeader:
     ID: int = int("0xaaaa", 16)
@@ -40,43 +47,34 @@ class DnsHeader:
     arcount: int = 0
 
     def from_buffer(self, bb: ByteBuffer):
-        self.ID = bb.read_uint16()
-        flags = bb.read_uint16()
+        self.ID, flags, self.qdcount, self.ancount, self.nscount, self.arcount = HEADER.unpack_from(bb.view, bb.pos)
+        bb.skip(HEADER.size)
         self._parse_flags(flags)
-        self.qdcount = bb.read_uint16()
-        self.ancount = bb.read_uint16()
-        self.nscount = bb.read_uint16()
-        self.arcount = bb.read_uint16()
         return self
 
-    def build(self) -> str:
-        message = f"{self.ID:04x}"
-
-        params = f"{self.response:d}" \
-                 f"{bin(self.opcode)[2:].zfill(4)}" \
-                 f"{self.authoritative_answer:d}" \
-                 f"{self.truncation:d}" \
-                 f"{self.recursion_desired:d}" \
-                 f"{self.recursion_available:d}" \
-                 f"{bin(self.Z)[2:].zfill(3)}" \
-                 f"{bin(self.response_code.value)[2:].zfill(4)}"
+    def write(self, bw: ByteWriter):
+        """Encodes the header at the writer cursor"""
+        bw.write_struct(HEADER, self.ID, self._build_flags(), self.qdcount, self.ancount, self.nscount, self.arcount)
+        return bw
 
-        message += f"{int(params, 2):04x}"
-        message += f"{self.qdcount:04x}{self.ancount:04x}{self.nscount:04x}{self.arcount:04x}"
+    def build(self) -> str:
+        """Returns the header encoded as hex str"""
+        return self.write(ByteWriter(bytearray(HEADER.size))).getvalue().hex()
 
-        return message
+    def _build_flags(self) -> int:
+        return (self.response << 15) | (self.opcode << 11) | (self.authoritative_answer << 10) | \
+               (self.truncation << 9) | (self.recursion_desired << 8) | (self.recursion_available << 7) | \
+               (self.Z << 4) | self.response_code.value
 
     def _parse_flags(self, flags: int):
-        # Should change it to bin arithmetic /w flags
-        bin_repr = bin(flags)[2:].zfill(16)
-        self.response = bool(int(bin_repr[0]))
-        self.opcode = int(bin_repr[1:5], 2)
-        self.authoritative_answer = bool(int(bin_repr[5]))
-        self.truncation = bool(int(bin_repr[6]))
-        self.recursion_desired = bool(int(bin_repr[7]))
-        self.recursion_available = bool(int(bin_repr[8]))
-        self.Z = int(bin_repr[9:12], 2)
-        self.response_code = RCode(int(bin_repr[12:], 2))
+        self.response = bool(flags & 0x8000)
+        self.opcode = (flags >> 11) & 0xF
+        self.authoritative_answer = bool(flags & 0x0400)
+        self.truncation = bool(flags & 0x0200)
+        self.recursion_desired = bool(flags & 0x0100)
+        self.recursion_available = bool(flags & 0x0080)
+        self.Z = (flags >> 4) & 0x7
+        self.response_code = RCode(flags & 0xF)
 
     def concise_info(self):
         flags_present = f"{'AA ' if self.authoritative_answer else ''}" \
@@ -107,6 +105,7 @@ class DnsHeader:
 # +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
 # |                     QCLASS                    |
 # +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+@slotted
 @dataclass
 class DnsQuestion:
     name: str = "."
@@ -115,14 +114,21 @@ class DnsQuestion:
 
     def from_buffer(self, bb: ByteBuffer):
         self.name = bb.read_qname()
-        self.qtype = QType(bb.read_uint16())
-        self.qclass = QClass(bb.read_uint16())
+        qtype, qclass = QUESTION_FIXED.unpack_from(bb.view, bb.pos)
+        bb.skip(QUESTION_FIXED.size)
+        self.qtype = QType(qtype)
+        self.qclass = QClass(qclass)
         return self
 
+    def write(self, bw: ByteWriter):
+        """Encodes the question at the writer cursor"""
+        bw.write_qname(self.name)
+        bw.write_struct(QUESTION_FIXED, self.qtype.value, self.qclass.value)
+        return bw
+
     def build(self) -> str:
-        QNAME = to_qname(self.name)
-        message = f"{QNAME}{self.qtype.value:04x}{self.qclass.value:04x}"
-        return message
+        """Returns the question encoded as hex str"""
+        return self.write(ByteWriter(bytearray(len(self.name) + 6))).getvalue().hex()
 
     def concise_info(self, name_pad=54, type_just=8) -> str:
         return fqdn(self.name).ljust(name_pad) + self.qclass.name + self.qtype.name.rjust(type_just)
@@ -169,6 +175,7 @@ class DnsQuestion:
 # /                     RDATA                     /
 # /                                               /
 # +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+@slotted
 @dataclass
 class DnsResourceRecord:
     name: str = "."
@@ -176,39 +183,47 @@ class DnsResourceRecord:
     qclass: Union[QClass, int] = None  # Can be either QClass instance or UDP payload size when using OP pseudo-RR
     ttl: int = 0
     rdlength: int = 0  # Length of RDATA in octets
-    rdata: RData = RData("")
+    rdata: RData = field(default_factory=lambda: RData(b""))
 
     def from_buffer(self, bb: ByteBuffer):
         self.name = bb.read_qname()
-        self.qtype = QType(bb.read_uint16())
+        qtype, qclass_value, self.ttl, self.rdlength = RR_FIXED.unpack_from(bb.view, bb.pos)
+        bb.skip(RR_FIXED.size)
+        self.qtype = QType(qtype)
 
         # OPT pseudo RR -> QClass parsed as plain int as it represents UDP payload size
-        qclass_value = bb.read_uint16()
         if self.qtype == QType.OPT:
             self.qclass = qclass_value
         else:
             self.qclass = QClass(qclass_value)
 
-        self.ttl = bb.read_uint32()
-        self.rdlength = bb.read_uint16()
-
         self.rdata = RecordFactory.get_record(self.qtype, self.qclass, bb, self.rdlength)
 
         return self
 
+    def write(self, bw: ByteWriter):
+        """Encodes the record at the writer cursor, RDLENGTH is backfilled once RDATA has been written"""
+        bw.write_qname(self.name)
+        bw.write_struct(RR_FIXED, self.qtype.value, self.qclass_value(), self.ttl, 0)
+        rdata_start = bw.pos
+        self.rdata.write(bw)
+        self.rdlength = bw.pos - rdata_start
+        bw.set_uint16(rdata_start - 2, self.rdlength)
+        return bw
+
     def build(self) -> str:
-        qname = to_qname(self.name)
-        qclass_value = self.qclass_value()
-        return f"{qname}{self.qtype.value:04x}{qclass_value:04x}{self.ttl:08x}{self.rdlength:04x}{self.rdata.data}"
+        """Returns the record encoded as hex str"""
+        return self.write(ByteWriter()).getvalue().hex()
 
-    def pseudo_record(self, domain_name: str, udp_payload_size: int):
+    def pseudo_record(self, domain_name: str, udp_payload_size: int, dnssec_ok: bool = False,
+                      options: Sequence[tuple[int, bytes]] = ()):
         """Creates OPT pseudo record with given udp_payload_size allowing for larger DNS responses"""
         self.name = domain_name
         self.qtype = QType.OPT
         self.qclass = udp_payload_size
-        self.ttl = 0
-        self.rdlength = 0
-        self.rdata = RData(data="")
+        self.ttl = EDNS_DO if dnssec_ok else 0
+        self.rdata = OPTRecord.from_options(list(options))
+        self.rdlength = len(self.rdata.data)
         return self
 
     def qclass_value(self):
@@ -243,6 +258,34 @@ class DnsResourceRecord:
                f"\tData: {self.rdata}\n\n"
 
 
+# +----------------+---------------+----------------------+
+# | EXTENDED-RCODE | VERSION       | DO |        Z        |  TTL of OPT record
+# +----------------+---------------+----------------------+
+@dataclass
+class Edns:
+    """EDNS(0) parameters carried by the OPT pseudo record of a message, RFC6891"""
+    udp_payload_size: int = 512
+    extended_rcode: int = 0  # Upper 8 bits of the 12 bit RCODE, the lower 4 are in the header
+    version: int = 0
+    dnssec_ok: bool = False
+    options: list[tuple[int, bytes]] = field(default_factory=list)
+
+    @classmethod
+    def from_record(cls, rr: DnsResourceRecord) -> "Edns":
+        options = rr.rdata.options if isinstance(rr.rdata, OPTRecord) else OPTRecord(rr.rdata.data).options
+        return cls(udp_payload_size=rr.qclass_value(), extended_rcode=rr.ttl >> 24, version=rr.ttl >> 16 & 0xFF,
+                   dnssec_ok=bool(rr.ttl & EDNS_DO), options=list(options))
+
+    def to_record(self) -> DnsResourceRecord:
+        rr = DnsResourceRecord().pseudo_record(".", self.udp_payload_size, self.dnssec_ok, self.options)
+        rr.ttl |= self.extended_rcode << 24 | self.version << 16
+        return rr
+
+    def response_code(self, header: DnsHeader) -> int:
+        """Full 12 bit RCODE of a message with the given header"""
+        return self.extended_rcode << 4 | header.response_code.value
+
+
 # +---------------------+
 # |        Header       |
 # +---------------------+
@@ -256,7 +299,7 @@ class DnsResourceRecord:
 # +---------------------+
 @dataclass
 class DnsMessage:
-    header: DnsHeader = DnsHeader()
+    header: DnsHeader = field(default_factory=DnsHeader)
     question: list[DnsQuestion] = field(default_factory=list)
     answer: list[DnsResourceRecord] = field(default_factory=list)
     authority: list[DnsResourceRecord] = field(default_factory=list)
@@ -311,23 +354,33 @@ class DnsMessage:
         self.header.arcount += 1
         return self
 
-    def build(self) -> str:
-        """Returns a DNS datagram encoded as hex string, ready for transmission with UDP
-        NOTE: name compression scheme as defined in RFC1035 is not implemented"""
-        message = self.header.build()
+    def edns(self) -> Optional[Edns]:
+        """EDNS parameters of the OPT pseudo record in additional section or None if the message has none"""
+        for rr in self.additional:
+            if rr.qtype == QType.OPT:
+                return Edns.from_record(rr)
+        return None
+
+    def write(self, bw: ByteWriter):
+        """Encodes the whole message at the writer cursor, names are compressed unless disabled on the writer"""
+        self.header.write(bw)
         for q in self.question:
-            message += q.build()
+            q.write(bw)
         for ans in self.answer:
-            message += ans.build()
+            ans.write(bw)
         for auth in self.authority:
-            message += auth.build()
+            auth.write(bw)
         for ar in self.additional:
-            message += ar.build()
-        return message
+            ar.write(bw)
+        return bw
 
-    def build_bytes(self) -> bytes:
-        """Returns bytes representation of DNS datagram"""
-        return binascii.unhexlify(self.build())
+    def build(self) -> str:
+        """Returns a DNS datagram encoded as hex string, kept for compatibility - prefer build_bytes"""
+        return self.build_bytes().hex()
+
+    def build_bytes(self, compress: bool = True) -> bytes:
+        """Returns bytes representation of DNS datagram, ready for transmission with UDP"""
+        return self.write(ByteWriter(compress=compress)).getvalue()
 
     def resolved_ns(self, target_section: Literal["answer", "authority"] = "authority"):
         """For queries containing NS records in target_section looks for corresponding additional A type records
@@ -389,3 +442,118 @@ class DnsMessage:
         for ar in self.additional:
             result += str(ar)
         return result
+
+
+class LazySection(Sequence):
+    """Read-only view of a message section, each question or record is decoded from the wire on first access"""
+
+    def __init__(self, bb: ByteBuffer, offsets: list[int], factory: Callable):
+        self.bb = bb
+        self.offsets = offsets
+        self.factory = factory
+        self.items: list = [None] * len(offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self.offsets)))]
+        item = self.items[i]
+        if item is None:
+            self.bb.pos = self.offsets[i]
+            item = self.items[i] = self.factory().from_buffer(self.bb)
+        return item
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __eq__(self, other):
+        return isinstance(other, (list, LazySection)) and list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class LazyDnsMessage(DnsMessage):
+    """DnsMessage decoding only the header up front. The first access to any section indexes offsets of all
+    questions and records by skipping names and RDATA without decoding them, questions and records are then
+    decoded one at a time as they are accessed. Sections can be replaced by plain lists as in DnsMessage"""
+
+    def __init__(self):
+        self.header = DnsHeader()
+        self._bb: Optional[ByteBuffer] = None
+        self._sections: Optional[dict[str, Union[LazySection, list]]] = None
+
+    def from_buffer(self, bb: ByteBuffer):
+        """Decodes header of the message held by the buffer, sections are decoded on access"""
+        self.header = DnsHeader().from_buffer(bb)
+        self._bb = bb
+        self._sections = None
+        bb.pos = 0
+        return self
+
+    def _index(self) -> dict[str, Union[LazySection, list]]:
+        if self._sections is not None:
+            return self._sections
+        bb = ByteBuffer(self._bb.buf, pos=HEADER.size) if self._bb else ByteBuffer(b"")
+        size = len(bb.view)
+        counts = (self.header.qdcount, self.header.ancount, self.header.nscount, self.header.arcount)
+        sections = {}
+        for section, count in zip(("question", "answer", "authority", "additional"), counts):
+            offsets = []
+            for _ in range(count):
+                offsets.append(bb.pos)
+                try:
+                    bb.skip_qname()
+                    if section == "question":
+                        bb.skip(QUESTION_FIXED.size)
+                    else:
+                        bb.skip(RR_FIXED.size + UINT16.unpack_from(bb.view, bb.pos + RR_FIXED.size - 2)[0])
+                except (struct.error, IndexError):
+                    bb.pos = size + 1
+                if bb.pos > size:
+                    raise ValueError(f"Message truncated in {section} section at offset {offsets[-1]}")
+            sections[section] = LazySection(bb, offsets, DnsQuestion if section == "question" else DnsResourceRecord)
+        self._sections = sections
+        return sections
+
+    def _section_property(name: str):
+        def getter(self):
+            return self._index()[name]
+
+        def setter(self, value):
+            self._index()[name] = value
+
+        return property(getter, setter)
+
+    question = _section_property("question")
+    answer = _section_property("answer")
+    authority = _section_property("authority")
+    additional = _section_property("additional")
+    del _section_property
+
+    def __copy__(self):
+        # Copies share decoded records but not the section mapping, replacing a section of one leaves the other intact
+        clone = type(self).__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        clone._sections = dict(self._index())
+        return clone
+
+    def skip_sections(self) -> dict[str, int]:
+        """Indexes all sections without decoding any record, returns number of entries in each of them"""
+        return {section: len(items) for section, items in self._index().items()}
+
+    def add_question(self, q: DnsQuestion):
+        self.question = list(self.question)
+        return super().add_question(q)
+
+    def add_resource_record(self, rr: DnsResourceRecord, section: Literal["answer", "authority", "additional"]):
+        setattr(self, section, list(getattr(self, section)))
+        return super().add_resource_record(rr, section)
+
+    def add_pseudo_record(self, udp_payload_size: int):
+        self.additional = list(self.additional)
+        return super().add_pseudo_record(udp_payload_size)
+
+    def materialize(self) -> DnsMessage:
+        """Returns eagerly decoded DnsMessage holding the same content"""
+        return DnsMessage(header=self.header, question=list(self.question), answer=list(self.answer),
+                          authority=list(self.authority), additional=list(self.additional))
@@ -0,0 +1,370 @@
+"""Streaming reader of DNS messages in pcap and pcapng captures
+
+The capture is memory mapped and walked frame by frame, only DNS payloads are copied out of the mapping. Pages
+already read are dropped from the mapping as reading proceeds and TCP streams buffer at most one message each,
+so memory use stays flat however large the capture is. Supported link types are Ethernet (with VLAN tags),
+raw IP, BSD loopback and Linux cooked captures, over IPv4 and IPv6. IP fragments are skipped"""
+import mmap
+import os
+import socket
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator, Optional
+
+from resolver.buffer import UINT16
+from resolver.packet import LazyDnsMessage
+from resolver.utility import fqdn
+
+DNS_PORTS = frozenset({53})
+RELEASE_CHUNK = 64 * 1024 * 1024  # Bytes of the mapping read before its pages are released
+
+UINT32_LE = struct.Struct("<I")
+PCAP_HEADER_SIZE = 24  # Magic, version, zone, sigfigs, snap length, link type
+PCAP_RECORD = {"<": struct.Struct("<4I"), ">": struct.Struct(">4I")}  # seconds, fraction, captured, original length
+PCAPNG_SECTION = 0x0A0D0D0A
+PCAPNG_INTERFACE = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_TSRESOL = 9  # Option of interface description block, timestamp resolution
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = {12, 14, 101}
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = {0x8100, 0x88A8, 0x9100}
+IPV6_EXTENSIONS = {0, 43, 60}  # Hop-by-hop, routing and destination options, skipped over
+IPV6_FRAGMENT = 44
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+TCP_FIN, TCP_SYN, TCP_RST = 0x01, 0x02, 0x04
+UDP_HEADER = struct.Struct("!HHH2x")  # source port, destination port, length
+TCP_HEADER = struct.Struct("!HHIIB")  # source port, destination port, sequence number, ack, data offset
+
+
+@dataclass
+class Frame:
+    timestamp: float
+    linktype: int
+    offset: int  # Of the link layer header within the capture
+    length: int  # Captured bytes
+
+
+@dataclass
+class DnsPayload:
+    timestamp: float
+    src: str
+    sport: int
+    dst: str
+    dport: int
+    transport: str  # udp or tcp
+    data: bytes
+
+    def decode(self) -> LazyDnsMessage:
+        """Message with only its header decoded, sections are decoded on access"""
+        return LazyDnsMessage().from_bytes(self.data)
+
+
+@dataclass
+class CapturedMessage:
+    payload: DnsPayload
+    message: Optional[LazyDnsMessage] = None
+    error: Optional[str] = None  # Set when the payload is not a valid DNS message
+
+    def questions(self) -> list[tuple[str, str]]:
+        """Name and type of every question, types unknown to the parser are written as TYPE<number>"""
+        return [(fqdn(q.name), q.qtype.name) for q in self.message.question]
+
+    def summary(self) -> str:
+        p = self.payload
+        line = f"{p.timestamp:.6f} {p.src}:{p.sport} > {p.dst}:{p.dport} {p.transport}"
+        if self.message is None:
+            return f"{line} {self.error}"
+        header = self.message.header
+        questions = " ".join(f"{name} {qtype}" for name, qtype in self.questions())
+        if not header.response:
+            return f"{line} query {header.ID:#06x} {questions}"
+        return f"{line} response {header.ID:#06x} {header.response_code.name} {questions} " \
+               f"{header.ancount}/{header.nscount}/{header.arcount}"
+
+    def to_dict(self) -> dict:
+        p = self.payload
+        result = {"time": p.timestamp, "src": p.src, "sport": p.sport, "dst": p.dst, "dport": p.dport,
+                  "transport": p.transport, "size": len(p.data)}
+        if self.message is None:
+            return dict(result, error=self.error)
+        header, message = self.message.header, self.message
+        result.update(id=header.ID, response=header.response, opcode=header.opcode, rcode=header.response_code.name,
+                      flags=[flag for flag, on in (("aa", header.authoritative_answer), ("tc", header.truncation),
+                                                   ("rd", header.recursion_desired),
+                                                   ("ra", header.recursion_available)) if on],
+                      question=[{"name": name, "type": qtype} for name, qtype in self.questions()])
+        try:
+            for section in ("answer", "authority", "additional"):
+                result[section] = [{"name": fqdn(rr.name), "type": rr.qtype.name, "ttl": rr.ttl,
+                                    "data": str(rr.rdata)} for rr in getattr(message, section)]
+        except (struct.error, ValueError, IndexError):
+            result["error"] = "MALFORMED"  # Record of a type unknown to the parser or with broken RDATA
+        return result
+
+
+@dataclass
+class CaptureSummary:
+    """Counters of a capture read, decode throughput is measured from creation"""
+    started: float = field(default_factory=time.perf_counter)
+    frames: int = 0
+    bytes: int = 0  # Captured bytes of all frames
+    messages: int = 0
+    errors: int = 0  # Payloads which failed to decode
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        rate = 1 / elapsed if elapsed > 0 else 0.0
+        return f"<<SUMMARY>> {self.frames} frames, {self.bytes / 1e6:.1f} MB in {elapsed:.2f}s, " \
+               f"{self.frames * rate:.0f} frames/s, {self.bytes * rate / 1e6:.1f} MB/s\n" \
+               f"{self.messages} DNS messages, {self.messages * rate:.0f} messages/s, {self.errors} decode errors"
+
+
+def read_frames(mm: mmap.mmap) -> Iterator[Frame]:
+    """Frames of a pcap or pcapng capture held by the mapping, in file order. A truncated last frame is ignored
+    Raises ValueError if the mapping holds neither capture format"""
+    magic = mm[:4]
+    if len(magic) < 4:
+        raise ValueError("Not a pcap or pcapng capture")
+    if magic == UINT32_LE.pack(PCAPNG_SECTION):
+        yield from _pcapng_frames(mm)
+        return
+    for endian in "<>":
+        second = struct.unpack(f"{endian}I", magic)[0]
+        if second in (0xA1B2C3D4, 0xA1B23C4D):
+            if len(mm) < PCAP_HEADER_SIZE:
+                raise ValueError("Truncated pcap global header")
+            yield from _pcap_frames(mm, endian, 1e9 if second == 0xA1B23C4D else 1e6)
+            return
+    raise ValueError("Not a pcap or pcapng capture")
+
+
+def _pcap_frames(mm: mmap.mmap, endian: str, resolution: float) -> Iterator[Frame]:
+    linktype = struct.unpack_from(f"{endian}I", mm, 20)[0] & 0x0FFFFFFF  # Upper bits may hold FCS length
+    record = PCAP_RECORD[endian]
+    pos, size = PCAP_HEADER_SIZE, len(mm)
+    while pos + record.size <= size:
+        seconds, fraction, captured, _ = record.unpack_from(mm, pos)
+        pos += record.size
+        if pos + captured > size:
+            return
+        yield Frame(seconds + fraction / resolution, linktype, pos, captured)
+        pos += captured
+
+
+def _pcapng_frames(mm: mmap.mmap) -> Iterator[Frame]:
+    pos, size = 0, len(mm)
+    endian = "<"
+    interfaces: list[tuple[int, float]] = []  # Link type and timestamp units per second of every interface
+    while pos + 12 <= size:
+        block_type = struct.unpack_from(f"{endian}I", mm, pos)[0]
+        if block_type == PCAPNG_SECTION:
+            endian = "<" if mm[pos + 8:pos + 12] == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+        length = struct.unpack_from(f"{endian}I", mm, pos + 4)[0]
+        if length < 12 or pos + length > size:
+            return
+        body = pos + 8
+        if block_type == PCAPNG_INTERFACE and length >= 20:
+            linktype = struct.unpack_from(f"{endian}H", mm, body)[0]
+            interfaces.append((linktype, _tsresol(mm, endian, body + 8, pos + length - 4)))
+        elif block_type == PCAPNG_ENHANCED_PACKET and length >= 32:
+            interface, high, low, captured = struct.unpack_from(f"{endian}4I", mm, body)
+            if interface < len(interfaces):
+                linktype, resolution = interfaces[interface]
+                yield Frame(((high << 32) | low) / resolution, linktype, body + 20, captured)
+        elif block_type == PCAPNG_SIMPLE_PACKET and interfaces and length >= 16:
+            original = struct.unpack_from(f"{endian}I", mm, body)[0]
+            yield Frame(0.0, interfaces[0][0], body + 4, min(original, length - 16))
+        pos += length
+
+
+def _tsresol(mm: mmap.mmap, endian: str, pos: int, end: int) -> float:
+    """Timestamp units per second from the options of an interface description block, microseconds by default"""
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(f"{endian}HH", mm, pos)
+        if code == 0:
+            break
+        if code == PCAPNG_TSRESOL and length == 1:
+            value = mm[pos + 4]
+            return float(2 ** (value & 0x7F) if value & 0x80 else 10 ** value)
+        pos += 4 + (length + 3) // 4 * 4
+    return 1e6
+
+
+def network_offset(mm: mmap.mmap, frame: Frame) -> Optional[int]:
+    """Offset of the IP header within the frame or None if it does not carry IP"""
+    pos, linktype = frame.offset, frame.linktype
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = UINT16.unpack_from(mm, pos + 12)[0]
+        pos += 14
+        while ethertype in ETHERTYPE_VLAN:
+            ethertype = UINT16.unpack_from(mm, pos + 2)[0]
+            pos += 4
+        return pos if ethertype in (ETHERTYPE_IPV4, ETHERTYPE_IPV6) else None
+    if linktype in LINKTYPE_RAW or linktype in (LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return pos
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        return pos + 4
+    if linktype == LINKTYPE_LINUX_SLL:
+        return pos + 16
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return pos + 20
+    return None
+
+
+class TcpStreams:
+    """Splits length framed DNS messages out of TCP segments, RFC1035 4.2.2
+    Segments are put in order by sequence number, retransmitted bytes are dropped and a gap in the stream resyncs
+    at the next segment. Each stream buffers at most one incomplete message and only the max_streams most
+    recently active streams are kept, so memory is bounded whatever the capture holds"""
+
+    def __init__(self, max_streams: int = 1024):
+        self.max_streams = max_streams
+        self.streams: OrderedDict[tuple, list] = OrderedDict()  # Flow onto [next sequence number, buffer]
+
+    def feed(self, flow: tuple, seq: int, flags: int, data: bytes) -> list[bytes]:
+        """Adds a segment of the flow, returns messages it completes"""
+        if flags & TCP_SYN:
+            self.streams[flow] = [(seq + 1) & 0xFFFFFFFF, bytearray()]
+            self._evict()
+            return []
+        stream = self.streams.get(flow)
+        if stream is None:
+            stream = self.streams[flow] = [seq, bytearray()]  # Picked up mid-stream, assumed to start a message
+            self._evict()
+        else:
+            self.streams.move_to_end(flow)
+
+        messages = []
+        ahead = (seq - stream[0]) & 0xFFFFFFFF
+        if ahead >= 0x80000000:  # Retransmission, possibly carrying new bytes at its end
+            behind = 0x100000000 - ahead
+            data, seq = data[behind:], stream[0]
+        elif ahead and data:  # Bytes were lost, what is buffered can no longer be completed
+            stream[1].clear()
+        if data:
+            stream[0] = (seq + len(data)) & 0xFFFFFFFF
+            buffer = stream[1]
+            buffer += data
+            start = 0
+            while len(buffer) - start >= 2:
+                length = UINT16.unpack_from(buffer, start)[0]
+                if len(buffer) - start - 2 < length:
+                    break
+                messages.append(bytes(buffer[start + 2:start + 2 + length]))
+                start += 2 + length
+            del buffer[:start]
+        if flags & (TCP_FIN | TCP_RST):
+            del self.streams[flow]
+        return messages
+
+    def _evict(self):
+        while len(self.streams) > self.max_streams:
+            self.streams.popitem(last=False)
+
+
+def dns_payloads(path: str, ports: Iterable[int] = DNS_PORTS,
+                 summary: Optional[CaptureSummary] = None) -> Iterator[DnsPayload]:
+    """Streams DNS payloads sent over UDP or TCP from or to any of ports found in the capture at path
+    Raises ValueError if the file is empty or not a capture, OSError if it cannot be read"""
+    ports = frozenset(ports)
+    streams = TcpStreams()
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Empty capture file")  # Cannot be mapped
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, "madvise"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        released = 0
+        for frame in read_frames(mm):
+            if summary is not None:
+                summary.frames += 1
+                summary.bytes += frame.length
+            if frame.offset - released >= RELEASE_CHUNK and hasattr(mm, "madvise"):
+                upto = frame.offset - frame.offset % mmap.PAGESIZE
+                mm.madvise(mmap.MADV_DONTNEED, released, upto - released)
+                released = upto
+            try:
+                yield from _frame_payloads(mm, frame, ports, streams)
+            except (struct.error, IndexError, ValueError, OSError):
+                continue  # Frame cut short by the snap length or garbled
+    finally:
+        mm.close()
+
+
+def _frame_payloads(mm: mmap.mmap, frame: Frame, ports: frozenset, streams: TcpStreams) -> Iterator[DnsPayload]:
+    pos = network_offset(mm, frame)
+    if pos is None:
+        return
+    end = frame.offset + frame.length
+    version = mm[pos] >> 4
+    if version == 4:
+        header_length = (mm[pos] & 0x0F) * 4
+        total, fragment = struct.unpack_from("!H2xH", mm, pos + 2)
+        if fragment & 0x3FFF:  # More fragments flag or non-zero offset
+            return
+        protocol = mm[pos + 9]
+        src, dst = socket.inet_ntop(socket.AF_INET, mm[pos + 12:pos + 16]), \
+            socket.inet_ntop(socket.AF_INET, mm[pos + 16:pos + 20])
+        end = min(end, pos + total)  # Ethernet pads short frames
+        pos += header_length
+    elif version == 6:
+        payload_length = UINT16.unpack_from(mm, pos + 4)[0]
+        protocol = mm[pos + 6]
+        src, dst = socket.inet_ntop(socket.AF_INET6, mm[pos + 8:pos + 24]), \
+            socket.inet_ntop(socket.AF_INET6, mm[pos + 24:pos + 40])
+        pos += 40
+        end = min(end, pos + payload_length)
+        while protocol in IPV6_EXTENSIONS:
+            protocol, length = mm[pos], mm[pos + 1]
+            pos += (length + 1) * 8
+        if protocol == IPV6_FRAGMENT:
+            return
+    else:
+        return
+
+    if protocol == PROTO_UDP:
+        sport, dport, length = UDP_HEADER.unpack_from(mm, pos)
+        if sport in ports or dport in ports:
+            yield DnsPayload(frame.timestamp, src, sport, dst, dport, "udp", mm[pos + 8:min(end, pos + length)])
+    elif protocol == PROTO_TCP:
+        sport, dport, seq, _, offset = TCP_HEADER.unpack_from(mm, pos)
+        if sport in ports or dport in ports:
+            flags = mm[pos + 13]
+            data = mm[pos + (offset >> 4) * 4:end]
+            for message in streams.feed((src, sport, dst, dport), seq, flags, data):
+                yield DnsPayload(frame.timestamp, src, sport, dst, dport, "tcp", message)
+
+
+def read_messages(path: str, ports: Iterable[int] = DNS_PORTS,
+                  summary: Optional[CaptureSummary] = None) -> Iterator[CapturedMessage]:
+    """Streams DNS messages of the capture at path with header and question decoded, records decode on access
+    Payloads which are not DNS messages are yielded with error set"""
+    for payload in dns_payloads(path, ports, summary):
+        if summary is not None:
+            summary.messages += 1
+        try:
+            captured = CapturedMessage(payload, payload.decode())
+            captured.questions()  # Indexes all sections, which finds truncated messages, and decodes the questions
+        except (struct.error, ValueError, IndexError):
+            if summary is not None:
+                summary.errors += 1
+            yield CapturedMessage(payload, error="MALFORMED")
+        else:
+            yield captured
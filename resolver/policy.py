@@ -0,0 +1,37 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from resolver.packet import DnsMessage
+from resolver.record_type import RCode
+from resolver.selection import ServerStat
+
+
+@dataclass
+class QueryPolicy:
+    """How a query is retried - attempts are spread over all addresses of the nameserver set in order of preference,
+    each round over the set multiplies timeouts by backoff. Timeouts adapt to observed RTT as RTO in RFC6298,
+    servers without samples get initial_timeout. No attempt may run past the deadline of the whole resolution"""
+    initial_timeout: float = 1.0
+    min_timeout: float = 0.05
+    max_timeout: float = 4.0
+    backoff: float = 2.0
+    max_attempts: int = 3  # Queries per step of a resolution or per lookup, across all candidate servers
+    deadline: float = 10.0  # Seconds a resolution including its sub-resolutions may take
+    rttvar_weight: float = 4.0  # RTO = SRTT + rttvar_weight * RTTVAR
+    failover_rcodes: frozenset = frozenset({RCode.SERVFAIL, RCode.REFUSED, RCode.NOTIMP})
+    stale_timeout: float = 1.8  # Seconds to wait for a fresh answer when a stale one is at hand, RFC8767
+    glueless_fanout: int = 3  # Addresses of nameservers delegated to without glue resolved at once
+    max_glueless: int = 12  # Nameserver address resolutions a resolution may start, including nested ones
+
+    def timeout(self, stat: Optional[ServerStat], rounds: int = 0) -> float:
+        """Timeout of an attempt towards a server already tried rounds times in this step"""
+        if stat is None or (stat.responses == 0 and stat.timeouts == 0):
+            rto = self.initial_timeout
+        else:
+            rto = stat.srtt + self.rttvar_weight * stat.rttvar
+        return min(max(rto, self.min_timeout) * self.backoff ** rounds, self.max_timeout)
+
+    def should_failover(self, response: Optional[DnsMessage]) -> bool:
+        """Whether another server should be asked after this response, None stands for a timeout"""
+        return response is None or response.header.response_code in self.failover_rcodes
+
@@ -0,0 +1,53 @@
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Hashable, Optional
+
+from resolver.metrics import ResolverMetrics
+
+
+class Prefetcher:
+    """Runs background refreshes of cache entries, one per key at a time
+    A refresh requested while limit refreshes are running is dropped, its entry then expires and the next client
+    resolves it as usual. Refreshes are not awaited by anyone, a refresh failing leaves the entry as it is"""
+
+    def __init__(self):
+        self.tasks: dict[Hashable, asyncio.Task] = {}
+
+    def schedule(self, key: Hashable, refresh: Callable[[], Awaitable[bool]], limit: int,
+                 metrics: Optional[ResolverMetrics] = None) -> bool:
+        """Starts refresh() unless one is already running for key or limit is reached, returns whether it started
+        refresh returns whether it succeeded"""
+        if key in self.tasks:
+            return False
+        if len(self.tasks) >= limit:
+            if metrics is not None:
+                metrics.prefetches.inc("dropped")
+            return False
+        task = self.tasks[key] = asyncio.ensure_future(refresh())
+
+        def done(_):
+            del self.tasks[key]
+            refreshed = not task.cancelled() and task.exception() is None and task.result()
+            if metrics is not None:
+                metrics.prefetches.inc("refreshed" if refreshed else "failed")
+
+        task.add_done_callback(done)
+        return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+
+_prefetchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Prefetcher]" = weakref.WeakKeyDictionary()
+
+
+def prefetcher() -> Prefetcher:
+    """Returns background refreshes of the running event loop"""
+    loop = asyncio.get_running_loop()
+    running = _prefetchers.get(loop)
+    if running is None:
+        running = _prefetchers[loop] = Prefetcher()
+    return running
@@ -1,14 +1,27 @@
 import ipaddress
-from dataclasses import dataclass
+import struct
 from enum import Enum
 
-from resolver.buffer import ByteBuffer
+from resolver.buffer import ByteBuffer, ByteWriter
+
+SOA_TIMERS = struct.Struct("!5I")  # SERIAL, REFRESH, RETRY, EXPIRE, MINIMUM
+EDNS_OPTION = struct.Struct("!2H")  # OPTION-CODE, OPTION-LENGTH
+
+
+def _unknown_member(enum: type, value, prefix: str):
+    """Pseudo-member of enum standing for a 16 bit value it does not list, named <prefix><value> as written by RFC3597
+    Records of unknown types are carried as opaque RData. The member is kept, the same value yields the same member"""
+    if not isinstance(value, int) or not 0 <= value <= 0xFFFF:
+        return None
+    member = object.__new__(enum)
+    member._name_, member._value_ = f"{prefix}{value}", value
+    return enum._value2member_map_.setdefault(value, member)
 
 
 class QType(Enum):
     """
     Supported query QTypes
-    If parser encounters unknown RR type it falls back to base RData implementation which encapsulates a plain hex str
+    If parser encounters unknown RR type it falls back to base RData implementation which encapsulates plain bytes
     This list can be extended in which case parsing for new types shall be provided by introducing a RData subclass
     and modifying RecordFactory to accommodate a new resource record type
     """
@@ -20,6 +33,7 @@ class QType(Enum):
     CNAME = 5
     SOA = 6
     MB = 7
+    MG = 8
     MR = 9
     NULL = 10
     WKS = 11
@@ -32,10 +46,18 @@ class QType(Enum):
     OPT = 41
     RRSIG = 46
 
+    @classmethod
+    def _missing_(cls, value):
+        return _unknown_member(cls, value, "TYPE")
+
 
 class QClass(Enum):
     IN = 1
 
+    @classmethod
+    def _missing_(cls, value):
+        return _unknown_member(cls, value, "CLASS")
+
 
 class RCode(Enum):
     NO_ERROR = 0
@@ -50,94 +72,165 @@ class RCode(Enum):
     NOTZONE = 9
 
 
-@dataclass
 class RData:
     """Base class for storing and interpreting different DNS RRs types
-    data MUST hold a hex stream, no other representation is valid"""
-    data: str  # Hex stream
+    data MUST hold the raw wire format RDATA bytes, no other representation is valid
+    Instances are slotted as caches keep millions of them resident, presentation form is computed once"""
+    __slots__ = ("data", "_text")
+
+    def __init__(self, data: bytes):
+        self.data = data  # Wire format RDATA
+        self._text = None
+
+    def hex(self) -> str:
+        """Returns plain hex string representation of RDATA"""
+        return self.data.hex()
+
+    def write(self, bw: ByteWriter):
+        """Encodes RDATA at the writer cursor. Subclasses holding domain names re-encode them from the parsed
+        representation, as raw data may contain compression pointers relative to the message it was read from"""
+        bw.write_bytes(self.data)
+
+    def text(self) -> str:
+        """Returns parsed RDATA. Subclasses are free to implement whatever parsing they wish
+        If no parsing mechanism is provided children fall back to plain hex string"""
+        return self.hex()
+
+    def __eq__(self, other):
+        return other.__class__ is self.__class__ and other.data == self.data
+
+    def __hash__(self):
+        return hash((self.__class__, self.data))
 
     def __repr__(self):
         """Returns plain hex string representation of RDATA"""
-        return self.data
+        return self.hex()
 
     def __str__(self):
-        """Returns parsed RDATA. Subclasses are free to implement whatever parsing they wish
-        If no parsing mechanism is provided children fall back to parent implementation of __str__"""
-        return self.data
+        """Returns parsed RDATA, memoized after the first call"""
+        text = self._text
+        if text is None:
+            text = self._text = self.text()
+        return text
 
 
 class OPTRecord(RData):
-    """OPT pseudo record - no specialized parsing implementing due to brevity"""
-    pass
+    """OPT pseudo record RDATA - EDNS options as (OPTION-CODE, OPTION-DATA) pairs, RFC6891
+    Raises ValueError if an option overruns RDATA"""
+    __slots__ = ("options",)
+
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.options: list[tuple[int, bytes]] = []
+        pos = 0
+        while pos < len(data):
+            if pos + EDNS_OPTION.size > len(data):
+                raise ValueError(f"Truncated EDNS option at offset {pos} of OPT RDATA")
+            code, length = EDNS_OPTION.unpack_from(data, pos)
+            pos += EDNS_OPTION.size
+            if pos + length > len(data):
+                raise ValueError(f"EDNS option {code} of {length} bytes overruns OPT RDATA")
+            self.options.append((code, data[pos:pos + length]))
+            pos += length
+
+    @classmethod
+    def from_options(cls, options: list[tuple[int, bytes]]) -> "OPTRecord":
+        return cls(b"".join(EDNS_OPTION.pack(code, len(value)) + value for code, value in options))
+
+    def text(self):
+        return " ".join(f"{code}:{value.hex()}" for code, value in self.options)
 
 
 class ARecord(RData):
-    def __str__(self):
-        addr = ipaddress.ip_address(
-            f"{int(self.data[:2], 16)}.{int(self.data[2:4], 16)}.{int(self.data[4:6], 16)}.{int(self.data[6:], 16)}")
-        return str(addr)
+    __slots__ = ()
+
+    def text(self):
+        return str(ipaddress.IPv4Address(self.data))
 
 
 class AAAARecord(RData):
-    def __str__(self):
-        raw_addr = ":".join((self.data[i:i + 4]) for i in range(0, len(self.data), 4))
-        addr = ipaddress.ip_address(raw_addr)
-        return str(addr)
+    __slots__ = ()
+
+    def text(self):
+        return str(ipaddress.IPv6Address(self.data))
 
 
 class NameRecord(RData):
-    name: str = "INVALID"
+    __slots__ = ("name",)
 
     def __init__(self, bb: ByteBuffer, num_bytes: int):
         """NS record is initialized by byte buffer as it has to read name which may have been compressed"""
-        self.data = bb.peek_plain(num_bytes)
+        super().__init__(bb.peek_bytes(num_bytes))
         self.name = bb.read_qname()
 
+    def write(self, bw: ByteWriter):
+        bw.write_qname(self.name)
+
     def __str__(self):
         return self.name
 
 
 class NSRecord(NameRecord):
-    pass
+    __slots__ = ()
 
 
 class CNAMERecord(NameRecord):
-    pass
+    __slots__ = ()
+
+
+class PTRRecord(NameRecord):
+    __slots__ = ()
+
+
+class MINFORecord(RData):
+    __slots__ = ("responsible_mailbox", "error_mailbox")
+
+    def __init__(self, bb: ByteBuffer, num_bytes: int):
+        super().__init__(bb.peek_bytes(num_bytes))
+        self.responsible_mailbox = bb.read_qname()
+        self.error_mailbox = bb.read_qname()
+
+    def write(self, bw: ByteWriter):
+        bw.write_qname(self.responsible_mailbox)
+        bw.write_qname(self.error_mailbox)
+
+    def text(self):
+        return f"{self.responsible_mailbox}. {self.error_mailbox}."
 
 
 class SOARecord(RData):
-    primary_ns: str = "INVALID"
-    responsible_mx: str = "INVALID"
-    serial: int = 0
-    refresh: int = 0
-    retry: int = 0
-    expire_limit: int = 0
-    minimum_ttl: int = 0
+    __slots__ = ("primary_ns", "responsible_mx", "serial", "refresh", "retry", "expire_limit", "minimum_ttl")
 
     def __init__(self, bb: ByteBuffer, num_bytes: int):
-        self.data = bb.peek_plain(num_bytes)
+        super().__init__(bb.peek_bytes(num_bytes))
         self.primary_ns = bb.read_qname()
         self.responsible_mx = bb.read_qname()
-        self.serial = bb.read_uint32()
-        self.refresh = bb.read_uint32()
-        self.retry = bb.read_uint32()
-        self.expire_limit = bb.read_uint32()
-        self.minimum_ttl = bb.read_uint32()
+        self.serial, self.refresh, self.retry, self.expire_limit, self.minimum_ttl = \
+            SOA_TIMERS.unpack_from(bb.view, bb.pos)
+        bb.skip(SOA_TIMERS.size)
 
-    def __str__(self):
+    def write(self, bw: ByteWriter):
+        bw.write_qname(self.primary_ns)
+        bw.write_qname(self.responsible_mx)
+        bw.write_struct(SOA_TIMERS, self.serial, self.refresh, self.retry, self.expire_limit, self.minimum_ttl)
+
+    def text(self):
         return f"{self.primary_ns}.\t{self.responsible_mx}." \
                f" {self.serial} {self.retry} {self.expire_limit} {self.minimum_ttl}"
 
 
 class MXRecord(RData):
-    mx_preference: int = 0
-    name: str = "INVALID"
+    __slots__ = ("mx_preference", "name")
 
     def __init__(self, bb: ByteBuffer, num_bytes: int):
-        self.data = bb.peek_plain(num_bytes)
+        super().__init__(bb.peek_bytes(num_bytes))
         self.mx_preference = bb.read_uint16()
         self.name = bb.read_qname()
 
+    def write(self, bw: ByteWriter):
+        bw.write_uint16(self.mx_preference)
+        bw.write_qname(self.name)
+
     def __str__(self):
         return self.name
 
@@ -145,25 +238,32 @@ class MXRecord(RData):
 class RecordFactory:
     @staticmethod
     def get_record(qtype: QType, qclass: QClass, bb: ByteBuffer, rdlength: int) -> RData:
+        """Parses RDATA of known types of class IN, RDATA of other types and classes is kept opaque, RFC3597"""
         if qclass == QClass.IN or qtype == QType.OPT:
 
             if qtype == QType.A:
-                rdata = ARecord(bb.read_plain(rdlength))
+                rdata = ARecord(bb.read_bytes(rdlength))
             elif qtype == QType.NS:
                 rdata = NSRecord(bb, num_bytes=rdlength)
             elif qtype == QType.CNAME:
                 rdata = CNAMERecord(bb, num_bytes=rdlength)
+            elif qtype == QType.PTR:
+                rdata = PTRRecord(bb, num_bytes=rdlength)
+            elif qtype in (QType.MD, QType.MF, QType.MB, QType.MG, QType.MR):
+                rdata = NameRecord(bb, num_bytes=rdlength)
+            elif qtype == QType.MINFO:
+                rdata = MINFORecord(bb, num_bytes=rdlength)
             elif qtype == QType.MX:
                 rdata = MXRecord(bb, num_bytes=rdlength)
             elif qtype == QType.AAAA:
-                rdata = AAAARecord(bb.read_plain(rdlength))
+                rdata = AAAARecord(bb.read_bytes(rdlength))
             elif qtype == QType.SOA:
                 rdata = SOARecord(bb, num_bytes=rdlength)
             elif qtype == QType.OPT:
-                rdata = OPTRecord(bb.read_plain(rdlength))
+                rdata = OPTRecord(bb.read_bytes(rdlength))
             else:
-                rdata = RData(bb.read_plain(rdlength))
+                rdata = RData(bb.read_bytes(rdlength))
 
             return rdata
         else:
-            raise NotImplementedError("Can only handle RRs of class IN or OPT qtype")
+            return RData(bb.read_bytes(rdlength))
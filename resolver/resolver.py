@@ -1,27 +1,136 @@
-import binascii
+import asyncio
+import copy
 import random
-import socket
-from typing import Union, Optional
+import struct
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable, Literal, Union, Optional
 
+from resolver.cache import DelegationCache, ResponseCache, in_bailiwick, normalize_name
+from resolver.coalesce import single_flight
+from resolver.edns import EDNS_PAYLOAD_SIZE, EdnsProfileTable
+from resolver.metrics import ResolverMetrics
 from resolver.packet import DnsHeader, QType, DnsMessage, DnsQuestion, QClass, DnsResourceRecord, RCode
+from resolver.policy import QueryPolicy
+from resolver.prefetch import prefetcher
+from resolver.selection import ServerStatsTable
+from resolver.trace import Span
+from resolver.transport import is_truncated, run_sync, tcp_transport, udp_transport
+from resolver.utility import fqdn
 
 BASE_DNS_SERVER_IP = "1.1.1.1"
-BASE_DNS_SERVER_LABEL = "Cloudflare"
 SOCKET_TIMEOUT = 2.0
+DNS_PORT = 53
+MAX_CNAME_HOPS = 8
 
+response_cache = ResponseCache()  # Shared by lookup and recursive_lookup unless cache=None is passed
+delegation_cache = DelegationCache()  # Zone cuts and nameserver addresses learned by recursive_lookup
+server_stats = ServerStatsTable()  # Smoothed RTT of every queried server address, drives nameserver selection
+edns_profiles = EdnsProfileTable()  # EDNS payload size and support learned per server address
+query_policy = QueryPolicy()  # Retries, failover and adaptive timeouts of lookups and recursive resolutions
+query_metrics = ResolverMetrics()  # Counters and latency histograms of all queries sent
+query_metrics.add_cache("response", response_cache.stats)
+query_metrics.add_collector(lambda: [("dns_server_srtt_seconds", {"server": addr}, stat.srtt)
+                                     for addr, stat in server_stats.snapshot().items()],
+                            description="Smoothed round trip time of upstream servers")
 
-def recursive_lookup(domain_name: str, record_type: Union[QType, str] = QType.A, output: bool = True):
-    # Begin by choosing one of the root name servers - ask base DNS for IPs of root name servers and choose one
-    root_ns = lookup(".", "NS", server_ip=BASE_DNS_SERVER_IP, server_label=BASE_DNS_SERVER_LABEL,
-                     recursive=False, verbose=False)
-    resolved_root_ns = root_ns.resolved_ns(target_section="answer")  # Assumes root NS will supply additional A records
-    name, addr = random.choice(list(resolved_root_ns.items()))
+
+@dataclass
+class Resolution:
+    """Settings and state shared by a recursive resolution and all of its sub-resolutions"""
+    output: bool
+    cache: Optional[ResponseCache]
+    delegations: DelegationCache
+    stats: ServerStatsTable
+    metrics: Optional[ResolverMetrics]
+    policy: QueryPolicy
+    deadline: float  # time.monotonic reading after which no more queries are sent
+    edns: Optional[EdnsProfileTable] = None
+    glueless: int = 0  # Nameserver address resolutions started so far, bounded by policy.max_glueless
+
+
+async def arecursive_lookup(domain_name: str,
+                            record_type: Union[QType, str] = QType.A,
+                            output: bool = True,
+                            cache: Optional[ResponseCache] = response_cache,
+                            delegations: DelegationCache = delegation_cache,
+                            stats: ServerStatsTable = server_stats,
+                            metrics: Optional[ResolverMetrics] = query_metrics,
+                            trace: Optional[Span] = None,
+                            policy: QueryPolicy = query_policy,
+                            edns: Optional[EdnsProfileTable] = edns_profiles) -> Optional[DnsMessage]:
+    """Resolves the name iteratively starting at the closest known zone cut, following referrals and CNAMEs
+    Each step queries the nameservers of the zone in order of their smoothed RTT, failing over to the next address
+    on timeouts and server failures as allowed by policy. The whole resolution must finish within policy.deadline
+    If trace is given the resolution is recorded as its child span holding spans of every query and sub-resolution
+    An expired answer kept in cache is returned if the resolution fails or takes over policy.stale_timeout"""
+    try:
+        record_type = parse_qtype(record_type)
+    except ValueError:
+        return None
+
+    resolution = Resolution(output, cache, delegations, stats, metrics, policy, time.monotonic() + policy.deadline,
+                            edns)
+    return await _stale_fallback(_resolve(resolution, domain_name, record_type, trace), domain_name, record_type,
+                                 cache, policy, metrics, follow_cnames=True)
+
+
+async def _resolve(resolution: Resolution, domain_name: str, record_type: QType, trace: Optional[Span],
+                   path: frozenset = frozenset()) -> Optional[DnsMessage]:
+    """Resolves the name unless the same resolution is already in flight, in which case waits for its result
+    path holds resolutions this one is nested in, a name depending on itself is given up on straight away"""
+    key = ("resolve", normalize_name(domain_name), record_type, id(resolution.cache), id(resolution.delegations))
+    if key in path:
+        return None
+    path = path | {key}
+    name = f"{fqdn(domain_name)} {record_type.name}"
+    return await _coalesce(key, lambda: _traced_iterate(resolution, domain_name, record_type, trace, path),
+                           resolution.deadline - time.monotonic(), resolution.metrics, trace, name)
+
+
+async def _traced_iterate(resolution: Resolution, domain_name: str, record_type: QType, trace: Optional[Span],
+                          path: frozenset) -> Optional[DnsMessage]:
+    if trace is None:
+        return await _iterate(resolution, domain_name, record_type, None, path)
+    span = trace.child(f"resolve {fqdn(domain_name)} {record_type.name}", kind="resolve")
+    response = await _iterate(resolution, domain_name, record_type, span, path)
+    span.finish(response.header.response_code.name if response is not None else "TIMEOUT")
+    return response
+
+
+async def _iterate(resolution: Resolution, domain_name: str, record_type: QType, span: Optional[Span],
+                   path: frozenset, refresh: bool = False) -> Optional[DnsMessage]:
+    """refresh resolves the question past its cached answer and stores the response as prefetched"""
+    output, cache, delegations = resolution.output, resolution.cache, resolution.delegations
+
+    # Answer straight from cache if this question has already been resolved and has not expired yet
+    cached = None
+    if cache is not None and not refresh:
+        cached = cache.get(domain_name, record_type,
+                           prefetch=lambda: _prefetch_resolution(resolution, domain_name, record_type))
+    if cached is not None:
+        if span is not None:
+            span.child(f"cache {fqdn(domain_name)} {record_type.name}", kind="cache").finish("CACHED")
+        if output:
+            cached.print_concise_info(sections={"answer"} if cached.answer else {"authority"})
+        return await _follow_cnames(resolution, cached, domain_name, record_type, span, path)
+
+    # Begin at the deepest zone cut known for the name, root hints if nothing below the root is cached
+    zone, servers = delegations.closest(domain_name)
 
     if output:
-        root_ns.print_concise_info(sections={"answer"})
+        print(f"<<DELEGATION>> {fqdn(zone)} NS {', '.join(sorted({ns for ns, _ in servers}))}\n")
 
     while True:
-        response = lookup(domain_name, record_type, server_ip=addr, server_label=name, recursive=False, verbose=False)
+        # The question was looked up in cache above, steps only store their responses
+        response = await _failover(domain_name, record_type, servers, resolution.policy, resolution.deadline,
+                                   recursive=False, verbose=False, cache=None, output=output, stats=resolution.stats,
+                                   metrics=resolution.metrics, trace=span, edns=resolution.edns)
+        if response is None:
+            return None
+        if cache is not None:
+            cache.put(response, prefetched=refresh)
 
         if output:
             if response.answer:
@@ -33,83 +142,548 @@ def recursive_lookup(domain_name: str, record_type: Union[QType, str] = QType.A,
         if response.header.response_code == RCode.NXDOMAIN:
             return response
 
-        # Found response in answer section
+        # Found response in answer section, CNAMEs it holds are followed and only the name they end at is resolved
         if response.header.response_code == RCode.NO_ERROR and len(response.answer) > 0:
-            # If CNAME is encountered it necessitates lookup to jump to given canonical name
-            # For now assumes no corresponding A records were supplied for CNAME and runs recursive query regardless
-            cname_records = response.answer_records(filter_by_type=QType.CNAME)
-            if cname_records:
-                return recursive_lookup(cname_records[0], record_type)
-            else:
-                return response
+            return await _follow_cnames(resolution, response, domain_name, record_type, span, path,
+                                        cache=cache, prefetched=refresh)
+
+        # Referral - remember the zone cut and its glue, stop on lame referrals not leading below the current zone
+        referral_zone = delegations.add_referral(response, bailiwick=zone)
+        if referral_zone is None:
+            return response
+        zone = referral_zone
 
         # CASE I: Server responds with corresponding A records in additional section
-        resolved_ns = response.resolved_ns()
-        if resolved_ns:
-            name, addr = random.choice(list(resolved_ns.items()))  # Get IPv4Address of random resolved NS
+        servers = delegations.servers(zone)
+        if servers:
             continue
 
-        # CASE II: No matching additional A records were supplied, therefore we need to ask the same addr for A of NS
+        # CASE II: No matching additional A records were supplied, therefore we need to resolve A of NS separately
         unresolved_ns = response.authority_ns()
-        if unresolved_ns:
-            ns_name = random.choice(unresolved_ns)
-        else:
+        if not unresolved_ns:
             return response
-
-        # If no additional A records were supplied query for NS IP and pick one if it is resolved
-        ns_a_response = recursive_lookup(ns_name, QType.A)
-        ns_a_ips = ns_a_response.answer_records(filter_by_type=QType.A)
-        if ns_a_ips:
-            addr = random.choice(ns_a_ips)
-        else:
+        servers = await _resolve_nameservers(resolution, unresolved_ns, span, path)
+        if not servers:
             return response
 
 
-def lookup(domain_name: str,
-           record_type: Union[str, QType],
-           server_ip: str = "1.1.1.1",
-           server_label: Optional[str] = None,
-           recursive: bool = True,
-           opt_size: Optional[int] = 4096,
-           verbose: bool = True) -> Optional[DnsMessage]:
-    print(f"Querying {record_type} {domain_name} @{server_ip}{'(' + server_label + ')' if server_label else ''}...")
-    server = (server_ip, 53)
+async def _follow_cnames(resolution: Resolution, response: DnsMessage, domain_name: str, record_type: QType,
+                         span: Optional[Span], path: frozenset, cache: Optional[ResponseCache] = None,
+                         prefetched: bool = False) -> Optional[DnsMessage]:
+    """Follows the CNAME chain of the answer from domain_name and resolves only the name it ends at, unless the
+    answer already holds its records or the server denied they exist. Returns the response with the whole chain in
+    its answer, None if the chain loops or takes over MAX_CNAME_HOPS links
+    cache stores every link of the chain and the records it ends at on their own, each expiring with its own TTL"""
+    if record_type == QType.CNAME:
+        return response
+    try:
+        chain, tail = cname_chain(response.answer, domain_name, record_type)
+    except ValueError:
+        return None
+    if not chain:
+        return response
+
+    if cache is not None:
+        for rr in chain:
+            cache.put(_message_like(response, rr.name, record_type, [rr]), prefetched=prefetched)
+        if tail is None:
+            target = normalize_name(str(chain[-1].rdata))
+            records = [rr for rr in response.answer if rr.qtype == record_type and normalize_name(rr.name) == target]
+            cache.put(_message_like(response, target, record_type, records), prefetched=prefetched)
+
+    # NODATA for the name the chain ends at comes with SOA of its zone
+    if tail is None or any(rr.qtype == QType.SOA and in_bailiwick(tail, normalize_name(rr.name))
+                                for rr in response.authority):
+        return response
+    tail_response = await _resolve(resolution, tail, record_type, span, path)
+    if tail_response is None:
+        return None
+    answer = chain + list(tail_response.answer)
+    if sum(rr.qtype == QType.CNAME for rr in answer) > MAX_CNAME_HOPS:
+        return None
+    return _message_like(tail_response, response.question[0].name, record_type, answer, tail_response.authority,
+                         tail_response.additional)
+
+
+def cname_chain(answer: Sequence[DnsResourceRecord], domain_name: str,
+                record_type: QType) -> tuple[list[DnsResourceRecord], Optional[str]]:
+    """Returns CNAME records of the answer leading from domain_name on and the name the chain ends at, None instead
+    of the name if the answer holds its record_type records. Raises ValueError if the chain loops or takes over
+    MAX_CNAME_HOPS links"""
+    cnames, owners = {}, set()
+    for rr in answer:
+        owner = normalize_name(rr.name)
+        if rr.qtype == QType.CNAME:
+            cnames.setdefault(owner, rr)
+        elif rr.qtype == record_type:
+            owners.add(owner)
+
+    name = normalize_name(domain_name)
+    chain, seen = [], {name}
+    while name not in owners and name in cnames:
+        chain.append(cnames[name])
+        name = normalize_name(str(cnames[name].rdata))
+        if name in seen:
+            raise ValueError(f"CNAME loop at {fqdn(name)}")
+        if len(chain) > MAX_CNAME_HOPS:
+            raise ValueError(f"CNAME chain of {fqdn(domain_name)} is longer than {MAX_CNAME_HOPS}")
+        seen.add(name)
+    return chain, None if name in owners else name
 
+
+def _message_like(response: DnsMessage, domain_name: str, record_type: QType, answer: Sequence[DnsResourceRecord],
+                  authority: Sequence[DnsResourceRecord] = (),
+                  additional: Sequence[DnsResourceRecord] = ()) -> DnsMessage:
+    """Response to the question with header flags of response, section counts follow the records given"""
+    msg = DnsMessage(header=replace(response.header, qdcount=0, ancount=0, nscount=0, arcount=0))
+    msg.add_question(DnsQuestion(domain_name, record_type))
+    for section, records in (("answer", answer), ("authority", authority), ("additional", additional)):
+        for rr in records:
+            msg.add_resource_record(rr, section)
+    return msg
+
+
+async def _resolve_nameservers(resolution: Resolution, ns_names: list[str], span: Optional[Span],
+                               path: frozenset) -> list[tuple[str, str]]:
+    """Resolves addresses of nameservers in random order, policy.glueless_fanout at a time, and returns
+    (nameserver name, address) pairs of the first one resolved - resolutions still running are cancelled
+    Every resolution started counts against policy.max_glueless of the whole resolution, so that deep chains of
+    glueless delegations cannot multiply into a flood of queries"""
+    policy, delegations = resolution.policy, resolution.delegations
+    candidates = iter(random.sample(ns_names, len(ns_names)))
+    pending: dict[asyncio.Future, str] = {}
+
+    def start_next():
+        while len(pending) < policy.glueless_fanout and resolution.glueless < policy.max_glueless:
+            ns_name = next(candidates, None)
+            if ns_name is None:
+                return
+            resolution.glueless += 1
+            pending[asyncio.ensure_future(_resolve(resolution, ns_name, QType.A, span, path))] = ns_name
+
+    start_next()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                ns_name = pending.pop(task)
+                ns_a_response = task.result()
+                ns_a_records = [ans for ans in ns_a_response.answer if ans.qtype == QType.A] if ns_a_response else []
+                if ns_a_records:
+                    delegations.add_addresses(ns_name, [str(ans.rdata) for ans in ns_a_records],
+                                              ttl=min(ans.ttl for ans in ns_a_records))
+                    return [(ns_name, str(ans.rdata)) for ans in ns_a_records]
+            start_next()
+        return []
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def _prefetch_resolution(resolution: Resolution, domain_name: str, record_type: QType):
+    """Resolves a hot cached question again in the background, within a deadline of its own"""
+    refreshing = replace(resolution, output=False, deadline=time.monotonic() + resolution.policy.deadline)
+
+    async def refresh() -> bool:
+        return await _iterate(refreshing, domain_name, record_type, None, frozenset(), refresh=True) is not None
+
+    key = ("prefetch", normalize_name(domain_name), record_type, id(resolution.cache), id(resolution.delegations))
+    prefetcher().schedule(key, refresh, resolution.cache.max_prefetches, resolution.metrics)
+
+
+async def _failover(domain_name: str,
+                    record_type: QType,
+                    servers: Sequence[tuple[Optional[str], str]],
+                    policy: QueryPolicy,
+                    deadline: float,
+                    recursive: bool,
+                    verbose: bool,
+                    cache: Optional[ResponseCache],
+                    output: bool,
+                    stats: Optional[ServerStatsTable],
+                    metrics: Optional[ResolverMetrics],
+                    trace: Optional[Span],
+                    opt_size: Optional[int] = EDNS_PAYLOAD_SIZE,
+                    port: int = DNS_PORT,
+                    transport: Literal["udp", "tcp"] = "udp",
+                    edns: Optional[EdnsProfileTable] = None) -> Optional[DnsMessage]:
+    """Queries (label, address) servers from the most preferred one until a response not calling for failover
+    arrives, at most policy.max_attempts times and never past deadline. Returns the last response or None
+    cache stores the response, the question is expected to have been looked up in it by the caller"""
+    ordered = stats.order(servers) if stats is not None else list(servers)
+    response = None
+    if not ordered:
+        return None
+    for attempt in range(policy.max_attempts):
+        label, addr = ordered[attempt % len(ordered)]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        timeout = min(policy.timeout(stats.get(addr) if stats is not None else None, attempt // len(ordered)),
+                      remaining)
+        if attempt and metrics is not None:
+            metrics.retries.inc(addr, "timeout" if response is None else response.header.response_code.name)
+        response = await alookup(domain_name, record_type, server_ip=addr, server_label=label, recursive=recursive,
+                                 opt_size=opt_size, verbose=verbose, cache=None, timeout=timeout, port=port,
+                                 output=output, transport=transport, stats=stats, metrics=metrics, trace=trace,
+                                 policy=None, edns=edns)
+        if not policy.should_failover(response):
+            break
+    if cache is not None and response is not None:
+        cache.put(response)
+    return response
+
+
+async def alookup(domain_name: str,
+                  record_type: Union[str, QType],
+                  server_ip: str = BASE_DNS_SERVER_IP,
+                  server_label: Optional[str] = None,
+                  recursive: bool = True,
+                  opt_size: Optional[int] = EDNS_PAYLOAD_SIZE,
+                  verbose: bool = True,
+                  cache: Optional[ResponseCache] = response_cache,
+                  timeout: Optional[float] = None,
+                  port: int = DNS_PORT,
+                  output: bool = True,
+                  transport: Literal["udp", "tcp"] = "udp",
+                  stats: Optional[ServerStatsTable] = server_stats,
+                  metrics: Optional[ResolverMetrics] = query_metrics,
+                  trace: Optional[Span] = None,
+                  policy: Optional[QueryPolicy] = query_policy,
+                  edns: Optional[EdnsProfileTable] = edns_profiles) -> Optional[DnsMessage]:
+    """Queries server_ip over the shared UDP socket pool of the running event loop, truncated responses are
+    retried over a pooled TCP connection. transport="tcp" skips UDP altogether
+    Timeouts and server failures are retried with adaptive timeouts and backoff as set by policy, timeout then
+    bounds the whole lookup. With policy=None a single query is sent and timeout applies to it
+    With a policy an expired answer kept in cache is returned if the lookup fails or takes over policy.stale_timeout
+    Returns the response or None if the query type is not supported or the request timed out
+    output controls progress lines e.g. "Querying...", verbose controls printing of the whole response
+    If trace is given every query is recorded as its child span with encode, network and decode phases
+    opt_size is the largest EDNS payload size advertised, edns lowers it or leaves EDNS out for servers known to
+    lose large responses or to reject EDNS, opt_size=None sends queries without EDNS"""
+    if policy is None and edns is not None:
+        opt_size = edns.udp_payload_size(server_ip, opt_size)
     try:
         msg = create_query(domain_name, record_type, opt_size)
     except ValueError:
         return None
-
+    qtype = msg.question[0].qtype
     msg.header.recursion_desired = recursive
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(SOCKET_TIMEOUT)
 
+    # Callers asking the same server the same question while a query is in flight wait for its response
+    key = ("lookup", normalize_name(domain_name), qtype, server_ip, port, recursive, opt_size, transport, id(cache),
+           policy is None)
+    name = f"{fqdn(domain_name)} {qtype.name} @{server_label or server_ip}"
+    if policy is not None:
+        timeout = timeout if timeout is not None else policy.deadline
+        cached = _cached(msg, domain_name, record_type, server_ip, server_label, verbose, cache, timeout, port, output,
+                         transport, stats, metrics, trace, edns)
+        if cached is not None:
+            return cached
+        deadline = time.monotonic() + timeout
+        return await _stale_fallback(_coalesce(key, lambda: _failover(domain_name, qtype, [(server_label, server_ip)],
+                                                                      policy, deadline, recursive, verbose, cache,
+                                                                      output, stats, metrics, trace, opt_size, port,
+                                                                      transport, edns),
+                                               timeout, metrics, trace, name),
+                                     domain_name, qtype, cache, policy, metrics)
+    timeout = timeout if timeout is not None else SOCKET_TIMEOUT
+    cached = _cached(msg, domain_name, record_type, server_ip, server_label, verbose, cache, timeout, port, output,
+                     transport, stats, metrics, trace, edns)
+    if cached is not None:
+        return cached
+    return await _coalesce(key, lambda: _query(msg, domain_name, record_type, server_ip, server_label, verbose, cache,
+                                               timeout, port, output, transport, stats, metrics, trace, edns),
+                           timeout, metrics, trace, name)
+
+
+async def _stale_fallback(call: Awaitable[Optional[DnsMessage]], domain_name: str, record_type: QType,
+                          cache: Optional[ResponseCache], policy: QueryPolicy, metrics: Optional[ResolverMetrics],
+                          follow_cnames: bool = False) -> Optional[DnsMessage]:
+    """Returns result of call unless an expired answer to the question is kept in cache and call fails or does not
+    finish within policy.stale_timeout - then answers with the stale response while call goes on in the background
+    and refreshes the cache, RFC8767. follow_cnames looks up stale answers of CNAME targets as resolutions do"""
+    if cache is None or not cache.has_stale(domain_name, record_type):
+        return await call
+    task = asyncio.ensure_future(call)
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())  # Outcome of an abandoned call
     try:
-        sock.sendto(msg.build_bytes(), server)
-        data, _ = sock.recvfrom(4096)
-        response = DnsMessage().from_bytes(data)
+        response = await asyncio.wait_for(asyncio.shield(task), policy.stale_timeout)
+        if response is not None and response.header.response_code != RCode.SERVFAIL:
+            return response
+        reason = "failure"
+    except asyncio.TimeoutError:
+        response, reason = None, "timeout"
+
+    stale = cache.get_stale(domain_name, record_type)
+    for _ in range(MAX_CNAME_HOPS if follow_cnames and record_type != QType.CNAME else 0):
+        cname_records = stale.answer_records(filter_by_type=QType.CNAME) if stale is not None else []
+        if not cname_records:
+            break
+        stale = cache.get_stale(cname_records[0], record_type)
+    if stale is None:
+        return await task if reason == "timeout" else response
+    if metrics is not None:
+        metrics.stale.inc(reason)
+    return stale
+
+
+async def _coalesce(key: tuple, call: Callable[[], Awaitable[Optional[DnsMessage]]], timeout: Optional[float],
+                    metrics: Optional[ResolverMetrics], trace: Optional[Span], name: str) -> Optional[DnsMessage]:
+    """Runs call unless an identical call is in flight on this event loop, then waits up to timeout for its result
+    A coalesced wait is recorded as a span of its own, queries are traced by the caller that sent them"""
+    flight = single_flight()
+    if key not in flight:
+        return await flight.do(key, call)
+    if metrics is not None:
+        metrics.coalesced.inc(key[0])
+    span = trace.child(f"coalesced {name}", kind="coalesced") if trace is not None else None
+    try:
+        response = await flight.do(key, call, timeout)
+    except asyncio.TimeoutError:
+        response = None
+    if span is not None:
+        span.finish(response.header.response_code.name if response is not None else "TIMEOUT")
+    return response
+
+
+def _cached(msg: DnsMessage,
+            domain_name: str,
+            record_type: Union[str, QType],
+            server_ip: str,
+            server_label: Optional[str],
+            verbose: bool,
+            cache: Optional[ResponseCache],
+            timeout: float,
+            port: int,
+            output: bool,
+            transport: Literal["udp", "tcp"],
+            stats: Optional[ServerStatsTable],
+            metrics: Optional[ResolverMetrics],
+            trace: Optional[Span],
+            edns: Optional[EdnsProfileTable]) -> Optional[DnsMessage]:
+    """Cached response to msg or None, a hot entry about to expire is refreshed by sending msg in the background
+    Looked up once per lookup so that retries and failover do not count as cache misses of their own"""
+    if cache is None:
+        return None
+    cached = cache.get(domain_name, msg.question[0].qtype,
+                       prefetch=lambda: _prefetch_query(msg, domain_name, record_type, server_ip, server_label, cache,
+                                                        timeout, port, transport, stats, metrics, edns))
+    if cached is not None:
+        if trace is not None:
+            trace.child(f"cache {fqdn(domain_name)} {msg.question[0].qtype.name}", kind="cache").finish("CACHED")
+        if output:
+            print(f"Cached {record_type} {domain_name}")
         if verbose:
-            response.print_concise_info()
-        return response
-    except socket.timeout:
-        print("\tThe request timed out")
-    finally:
-        sock.close()
+            cached.print_concise_info()
+    return cached
+
+
+async def _query(msg: DnsMessage,
+                 domain_name: str,
+                 record_type: Union[str, QType],
+                 server_ip: str,
+                 server_label: Optional[str],
+                 verbose: bool,
+                 cache: Optional[ResponseCache],
+                 timeout: float,
+                 port: int,
+                 output: bool,
+                 transport: Literal["udp", "tcp"],
+                 stats: Optional[ServerStatsTable],
+                 metrics: Optional[ResolverMetrics],
+                 trace: Optional[Span],
+                 edns: Optional[EdnsProfileTable] = None) -> Optional[DnsMessage]:
+    """Sends msg once, recursion desired flag is expected to be set by the caller
+    A server rejecting EDNS is asked once more without it, edns learns from every response and UDP timeout
+    cache stores the response, the question is expected to have been looked up in it by the caller"""
+    qtype = msg.question[0].qtype.name
+    if output:
+        print(f"Querying {record_type} {domain_name} @{server_ip}{'(' + server_label + ')' if server_label else ''}...")
+
+    server = (server_ip, port)
+    span = None
+    if trace is not None:
+        # Transports encode the message themselves, the trace measures a separate encoding of the same query
+        span = trace.child(f"query {fqdn(domain_name)} {qtype} @{server_label or server_ip}", server=server_ip)
+        span.bytes_out = len(msg.build_bytes())
+        span.phase("encode", span.start)
+    started = sent = time.perf_counter()
+    truncated = False
+    try:
+        if metrics is not None:
+            metrics.queries.inc(server_ip, qtype, transport)
+        if transport == "tcp":
+            data = await tcp_transport().query(msg, server, timeout)
+        else:
+            data = await udp_transport().query(msg, server, timeout)
+            if is_truncated(data):
+                truncated = True
+                if output:
+                    print("\tResponse truncated, retrying over TCP")
+                if metrics is not None:
+                    metrics.truncated.inc(server_ip)
+                    metrics.retries.inc(server_ip, "truncated")
+                    metrics.queries.inc(server_ip, qtype, "tcp")
+                if span is not None:
+                    span.bytes_out *= 2  # The same query is sent again over TCP
+                    span.bytes_in += len(data)
+                    sent = span.phase("network", sent)
+                data = await tcp_transport().query(msg, server, timeout)
+    except asyncio.TimeoutError:
+        if stats is not None:
+            stats.record_timeout(server_ip, timeout)
+        if metrics is not None:
+            metrics.timeouts.inc(server_ip, qtype)
+        if edns is not None and transport == "udp" and not truncated and \
+                edns.record_timeout(server_ip, _payload_size(msg)) and metrics is not None:
+            metrics.edns_fallbacks.inc(server_ip, "reduced")
+        if span is not None:
+            span.phase("tcp" if "network" in span.phases else "network", sent)
+            span.finish("TIMEOUT")
+        if output:
+            print("\tThe request timed out")
+        return None
+    except OSError as e:
+        if stats is not None:
+            stats.record_timeout(server_ip, timeout)
+        if metrics is not None:
+            metrics.errors.inc(server_ip)
+        if span is not None:
+            span.phase("tcp" if "network" in span.phases else "network", sent)
+            span.finish("ERROR")
+        if output:
+            print(f"\tThe request failed: {e}")
+        return None
+    rtt = time.perf_counter() - started
+    if stats is not None:
+        stats.record_rtt(server_ip, rtt)
+
+    if span is not None:
+        decoding = span.phase("tcp" if "network" in span.phases else "network", sent)
+    try:
+        response = DnsMessage().from_bytes(data)
+    except (struct.error, ValueError, IndexError, KeyError, TypeError) as e:
+        # Records or rcodes the parser does not know fail the attempt like a lost response would
+        if metrics is not None:
+            metrics.errors.inc(server_ip)
+        if span is not None:
+            span.finish("MALFORMED")
+        if output:
+            print(f"\tThe response could not be decoded: {e}")
+        return None
+    if span is not None:
+        span.phase("decode", decoding)
+        span.bytes_in += len(data)
+        span.finish(response.header.response_code.name)
+    if metrics is not None:
+        metrics.responses.inc(server_ip, response.header.response_code.name)
+        metrics.latency.observe(rtt, server_ip, qtype)
+    if edns is not None and edns.record_response(server_ip, _payload_size(msg), response):
+        if metrics is not None:
+            metrics.edns_fallbacks.inc(server_ip, "disabled")
+        if output:
+            print("\tServer rejected EDNS, retrying without it")
+        plain = copy.copy(msg)
+        plain.header = copy.copy(msg.header)
+        plain.additional = [rr for rr in msg.additional if rr.qtype != QType.OPT]
+        plain.header.arcount = len(plain.additional)
+        return await _query(plain, domain_name, record_type, server_ip, server_label, verbose, cache, timeout, port,
+                            output, transport, stats, metrics, trace, edns)
+    if cache is not None:
+        cache.put(response, size=len(data))
+    if verbose:
+        response.print_concise_info()
+    return response
+
+
+def _payload_size(msg: DnsMessage) -> Optional[int]:
+    """EDNS payload size advertised by a query or None if it has no OPT record"""
+    opt = msg.edns()
+    return opt.udp_payload_size if opt is not None else None
+
+
+def _prefetch_query(msg: DnsMessage,
+                    domain_name: str,
+                    record_type: Union[str, QType],
+                    server_ip: str,
+                    server_label: Optional[str],
+                    cache: ResponseCache,
+                    timeout: float,
+                    port: int,
+                    transport: Literal["udp", "tcp"],
+                    stats: Optional[ServerStatsTable],
+                    metrics: Optional[ResolverMetrics],
+                    edns: Optional[EdnsProfileTable]):
+    """Sends a hot cached query again in the background, once, and stores its response"""
+    async def refresh() -> bool:
+        query = copy.copy(msg)
+        query.header = copy.copy(msg.header)
+        query.header.ID = random.getrandbits(16)
+        response = await _query(query, domain_name, record_type, server_ip, server_label, False, None, timeout, port,
+                                False, transport, stats, metrics, None, edns)
+        return response is not None and cache.put(response, prefetched=True)
 
+    key = ("prefetch", normalize_name(domain_name), msg.question[0].qtype, server_ip, port, id(cache))
+    prefetcher().schedule(key, refresh, cache.max_prefetches, metrics)
 
-def create_query(domain_name: str, record_type: Union[str, QType], opt_size: Optional[int] = 4096) -> DnsMessage:
+
+def recursive_lookup(domain_name: str,
+                     record_type: Union[QType, str] = QType.A,
+                     output: bool = True,
+                     cache: Optional[ResponseCache] = response_cache,
+                     delegations: DelegationCache = delegation_cache,
+                     stats: ServerStatsTable = server_stats,
+                     metrics: Optional[ResolverMetrics] = query_metrics,
+                     trace: Optional[Span] = None,
+                     policy: QueryPolicy = query_policy,
+                     edns: Optional[EdnsProfileTable] = edns_profiles) -> Optional[DnsMessage]:
+    """Blocking wrapper around arecursive_lookup"""
+    return run_sync(arecursive_lookup(domain_name, record_type, output, cache, delegations, stats, metrics, trace,
+                                      policy, edns))
+
+
+def lookup(domain_name: str,
+           record_type: Union[str, QType],
+           server_ip: str = BASE_DNS_SERVER_IP,
+           server_label: Optional[str] = None,
+           recursive: bool = True,
+           opt_size: Optional[int] = EDNS_PAYLOAD_SIZE,
+           verbose: bool = True,
+           cache: Optional[ResponseCache] = response_cache,
+           timeout: Optional[float] = None,
+           port: int = DNS_PORT,
+           output: bool = True,
+           transport: Literal["udp", "tcp"] = "udp",
+           stats: Optional[ServerStatsTable] = server_stats,
+           metrics: Optional[ResolverMetrics] = query_metrics,
+           trace: Optional[Span] = None,
+           policy: Optional[QueryPolicy] = query_policy,
+           edns: Optional[EdnsProfileTable] = edns_profiles) -> Optional[DnsMessage]:
+    """Blocking wrapper around alookup"""
+    return run_sync(alookup(domain_name, record_type, server_ip, server_label, recursive, opt_size, verbose, cache,
+                            timeout, port, output, transport, stats, metrics, trace, policy, edns))
+
+
+def parse_qtype(record_type: Union[str, QType]) -> QType:
+    """Returns QType for given name e.g. "mx" or "TYPE65" as written by RFC3597, raises ValueError if the type is not
+    supported"""
     if isinstance(record_type, QType):
-        query_type = record_type
-    else:
-        try:
-            record_type = record_type.upper()
-            query_type = QType[record_type]
-        except KeyError:
-            print(f"QType {record_type} not supported")
-            query_type = QType.A
-            raise ValueError
-
-    transaction_id = int(binascii.hexlify(random.randbytes(2)), 16)
+        return record_type
+    try:
+        return QType[record_type.upper()]
+    except KeyError:
+        if record_type.upper().startswith("TYPE") and record_type[4:].isdigit() and int(record_type[4:]) <= 0xFFFF:
+            return QType(int(record_type[4:]))
+        print(f"QType {record_type} not supported")
+        raise ValueError
+
+
+def create_query(domain_name: str, record_type: Union[str, QType],
+                 opt_size: Optional[int] = EDNS_PAYLOAD_SIZE) -> DnsMessage:
+    query_type = parse_qtype(record_type)
+
+    transaction_id = random.getrandbits(16)
     additional_count = 1 if opt_size else 0
 
     header = DnsHeader(ID=transaction_id,
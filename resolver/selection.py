@@ -0,0 +1,109 @@
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Sequence, TypeVar
+
+T = TypeVar("T")
+
+RTT_ALPHA = 0.3  # Weight of the newest sample in smoothed RTT
+RTTVAR_BETA = 0.25  # Weight of the newest deviation in RTT variance, as in RFC6298
+UNKNOWN_SRTT = 0.032  # Servers never queried get a random SRTT below this so that each of them is probed early
+MAX_SRTT = 10.0
+
+
+@dataclass
+class ServerStat:
+    srtt: float  # Smoothed round trip time in seconds
+    rttvar: float = 0.0  # Smoothed mean deviation of round trip time
+    queries: int = 0
+    responses: int = 0
+    timeouts: int = 0
+    consecutive_timeouts: int = 0
+    backoff_until: float = 0.0  # Clock reading before which the server is only used as a last resort
+
+    def concise_info(self) -> str:
+        return f"srtt: {self.srtt * 1000:.1f}ms, rttvar: {self.rttvar * 1000:.1f}ms, queries: {self.queries}, " \
+               f"responses: {self.responses}, timeouts: {self.timeouts}"
+
+
+class ServerStatsTable:
+    """Per server address statistics shared across resolutions, used to pick the nameserver to query next
+
+    Every response updates exponentially smoothed RTT and its variance. A timeout doubles SRTT and, after repeated
+    timeouts, puts the server into exponentially growing backoff during which it is only chosen if all candidates
+    are backed off. Selection prefers the lowest SRTT but with probability explore picks another available server
+    so that estimates of slower servers are refreshed as they recover"""
+
+    def __init__(self,
+                 explore: float = 0.05,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 max_entries: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.explore = explore
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_entries = max_entries
+        self.clock = clock
+        self.servers: OrderedDict[str, ServerStat] = OrderedDict()
+
+    def get(self, addr: str) -> ServerStat:
+        stat = self.servers.get(addr)
+        if stat is None:
+            stat = self.servers[addr] = ServerStat(srtt=random.uniform(0, UNKNOWN_SRTT))
+            if len(self.servers) > self.max_entries:
+                self.servers.popitem(last=False)
+        else:
+            self.servers.move_to_end(addr)
+        return stat
+
+    def record_rtt(self, addr: str, rtt: float):
+        stat = self.get(addr)
+        if stat.responses == 0 and stat.timeouts == 0:
+            stat.srtt, stat.rttvar = rtt, rtt / 2
+        else:
+            stat.rttvar = (1 - RTTVAR_BETA) * stat.rttvar + RTTVAR_BETA * abs(stat.srtt - rtt)
+            stat.srtt = (1 - RTT_ALPHA) * stat.srtt + RTT_ALPHA * rtt
+        stat.queries += 1
+        stat.responses += 1
+        stat.consecutive_timeouts = 0
+        stat.backoff_until = 0.0
+
+    def record_timeout(self, addr: str, timeout: float):
+        stat = self.get(addr)
+        stat.srtt = min(max(stat.srtt * 2, timeout), MAX_SRTT)
+        stat.queries += 1
+        stat.timeouts += 1
+        stat.consecutive_timeouts += 1
+        if stat.consecutive_timeouts > 1:
+            delay = min(self.backoff * 2 ** (stat.consecutive_timeouts - 2), self.max_backoff)
+            stat.backoff_until = self.clock() + delay
+
+    def order(self, candidates: Sequence[tuple[T, str]]) -> list[tuple[T, str]]:
+        """Returns (label, address) candidates from the most to the least preferred one
+        Servers in backoff come last, ordered by the end of their backoff"""
+        now = self.clock()
+        stats = {addr: self.get(addr) for _, addr in candidates}
+        available = sorted((c for c in candidates if stats[c[1]].backoff_until <= now), key=lambda c: stats[c[1]].srtt)
+        backed_off = sorted((c for c in candidates if stats[c[1]].backoff_until > now),
+                            key=lambda c: stats[c[1]].backoff_until)
+        if len(available) > 1 and random.random() < self.explore:
+            probe = available.pop(random.randrange(1, len(available)))
+            available.insert(0, probe)
+        return available + backed_off
+
+    def select(self, candidates: Sequence[tuple[T, str]]) -> tuple[T, str]:
+        """Returns the preferred (label, address) candidate"""
+        return self.order(candidates)[0]
+
+    def snapshot(self) -> dict[str, ServerStat]:
+        """Returns copies of statistics of every known server address"""
+        return {addr: replace(stat) for addr, stat in self.servers.items()}
+
+    def __str__(self):
+        return "\n".join(f"{addr.ljust(40)}{stat.concise_info()}" for addr, stat in
+                         sorted(self.servers.items(), key=lambda item: item[1].srtt))
+
+    def __len__(self):
+        return len(self.servers)
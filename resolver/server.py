@@ -0,0 +1,211 @@
+import asyncio
+import struct
+from typing import Awaitable, Callable, Optional
+
+from resolver.buffer import UINT16, ByteBuffer
+from resolver.cache import ResponseCache
+from resolver.packet import DnsHeader, DnsMessage, DnsQuestion, DnsResourceRecord
+from resolver.record_type import QType, RCode
+from resolver.policy import QueryPolicy
+from resolver.resolver import DNS_PORT, alookup, arecursive_lookup, query_policy, response_cache
+
+UDP_PAYLOAD_SIZE = 1232  # Largest UDP response sent to EDNS clients, avoids IP fragmentation as advised by DNS flag day
+CLASSIC_UDP_SIZE = 512  # Limit for clients without EDNS, RFC1035
+
+Resolve = Callable[[DnsQuestion], Awaitable[Optional[DnsMessage]]]
+
+
+def forward_to(server_ip: str,
+               port: int = DNS_PORT,
+               cache: Optional[ResponseCache] = response_cache,
+               policy: Optional[QueryPolicy] = query_policy) -> Resolve:
+    """Answers questions from cache or by asking the recursive resolver at server_ip"""
+    async def resolve(question: DnsQuestion) -> Optional[DnsMessage]:
+        return await alookup(question.name, question.qtype, server_ip=server_ip, port=port, verbose=False,
+                             output=False, cache=cache, policy=policy)
+
+    return resolve
+
+
+def recurse(cache: Optional[ResponseCache] = response_cache, policy: QueryPolicy = query_policy) -> Resolve:
+    """Answers questions from cache or by iterating from the closest known zone cut"""
+    async def resolve(question: DnsQuestion) -> Optional[DnsMessage]:
+        return await arecursive_lookup(question.name, question.qtype, output=False, cache=cache, policy=policy)
+
+    return resolve
+
+
+def client_payload_size(query: DnsMessage) -> int:
+    """Largest UDP response the client accepts, advertised in its OPT record"""
+    edns = query.edns()
+    return max(CLASSIC_UDP_SIZE, min(edns.udp_payload_size, UDP_PAYLOAD_SIZE)) if edns is not None else CLASSIC_UDP_SIZE
+
+
+def build_reply(query: DnsMessage, response: Optional[DnsMessage], rcode: RCode = RCode.NO_ERROR,
+                max_size: Optional[int] = None) -> bytes:
+    """Encodes response as the answer to query - with the ID, question and RD flag of the query and OPT record
+    only if the client sent one. Replies larger than max_size are truncated to the question with TC flag set
+    response is not modified, it may be shared with other callers"""
+    header = DnsHeader(ID=query.header.ID, response=True, opcode=query.header.opcode,
+                       recursion_desired=query.header.recursion_desired, recursion_available=True, Z=0,
+                       response_code=response.header.response_code if response is not None else rcode)
+    reply = DnsMessage(header=header, question=list(query.question))
+    if response is not None:
+        reply.answer = list(response.answer)
+        reply.authority = list(response.authority)
+        reply.additional = [rr for rr in response.additional if rr.qtype != QType.OPT]
+    if any(rr.qtype == QType.OPT for rr in query.additional):
+        reply.additional.append(DnsResourceRecord().pseudo_record(".", UDP_PAYLOAD_SIZE))
+    data = _encode(reply)
+    if max_size is not None and len(data) > max_size:
+        header.truncation = True
+        reply.answer, reply.authority = [], []
+        reply.additional = [rr for rr in reply.additional if rr.qtype == QType.OPT]
+        data = _encode(reply)
+    return data
+
+
+def _encode(reply: DnsMessage) -> bytes:
+    header = reply.header
+    header.qdcount, header.ancount = len(reply.question), len(reply.answer)
+    header.nscount, header.arcount = len(reply.authority), len(reply.additional)
+    return reply.build_bytes()
+
+
+class ServerDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: "DnsServer"):
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        self.server.spawn(self.reply(data, addr))
+
+    async def reply(self, data: bytes, addr):
+        reply = await self.server.handle(data, udp=True)
+        if reply is not None and self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(reply, addr)
+
+    def error_received(self, exc: Exception):
+        pass
+
+
+class DnsServer:
+    """Caching DNS server answering clients over UDP and TCP on the same address and port
+    Every query is handled by a task of its own so that slow upstream answers do not hold up other clients,
+    queries above max_pending in flight are dropped for clients to retry. TCP connections carry pipelined
+    queries as in RFC7766 and are closed after idle_timeout seconds without a query
+    With reuse_port several processes may serve the same address, the kernel spreads clients among them"""
+
+    def __init__(self,
+                 resolve: Resolve,
+                 host: str = "127.0.0.1",
+                 port: int = DNS_PORT,
+                 max_pending: int = 10000,
+                 idle_timeout: float = 10.0,
+                 reuse_port: bool = False):
+        self.resolve = resolve
+        self.host = host
+        self.port = port
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.reuse_port = reuse_port
+        self.tasks: set[asyncio.Task] = set()
+        self.dropped = 0  # Queries dropped because max_pending were in flight
+        self._udp: Optional[asyncio.DatagramTransport] = None
+        self._tcp: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        """Binds the sockets, port 0 picks a free port which is then stored in port"""
+        loop = asyncio.get_running_loop()
+        self._udp, _ = await loop.create_datagram_endpoint(lambda: ServerDatagramProtocol(self),
+                                                           local_addr=(self.host, self.port),
+                                                           reuse_port=self.reuse_port)
+        self.port = self._udp.get_extra_info("sockname")[1]
+        self._tcp = await asyncio.start_server(self._serve_connection, self.host, self.port,
+                                               reuse_port=self.reuse_port)
+        return self
+
+    async def serve_forever(self):
+        if self._tcp is None:
+            await self.start()
+        await self._tcp.serve_forever()
+
+    def close(self):
+        if self._udp is not None:
+            self._udp.close()
+        if self._tcp is not None:
+            self._tcp.close()
+        for task in self.tasks:
+            task.cancel()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def spawn(self, coro: Awaitable):
+        if len(self.tasks) >= self.max_pending:
+            self.dropped += 1
+            coro.close()
+            return
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, data: bytes, udp: bool) -> Optional[bytes]:
+        """Returns encoded reply to the query in data or None if it should be dropped"""
+        try:
+            query = DnsMessage().from_bytes(data)
+        except (struct.error, ValueError, IndexError, KeyError, TypeError):
+            try:
+                header = DnsHeader().from_buffer(ByteBuffer(data))
+            except (struct.error, ValueError):
+                return None  # Not even a header to reply to
+            if header.response:
+                return None
+            return build_reply(DnsMessage(header=header), None, RCode.FORMERR)
+
+        if query.header.response:
+            return None
+        max_size = client_payload_size(query) if udp else None
+        if query.header.opcode != 0:
+            return build_reply(query, None, RCode.NOTIMP, max_size)
+        if len(query.question) != 1:
+            return build_reply(query, None, RCode.FORMERR, max_size)
+        try:
+            response = await self.resolve(query.question[0])
+        except Exception:
+            response = None
+        return build_reply(query, response, RCode.SERVFAIL, max_size)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending = 0  # Queries of this connection still being answered, the connection is idle only without them
+
+        async def reply(data: bytes):
+            nonlocal pending
+            pending += 1
+            try:
+                result = await self.handle(data, udp=False)
+                if result is not None and not writer.is_closing():
+                    writer.write(UINT16.pack(len(result)) + result)
+            finally:
+                pending -= 1
+
+        try:
+            while True:
+                try:
+                    prefix = await asyncio.wait_for(reader.readexactly(2), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if pending:
+                        continue
+                    break
+                data = await asyncio.wait_for(reader.readexactly(UINT16.unpack(prefix)[0]), self.idle_timeout)
+                self.spawn(reply(data))
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,158 @@
+"""Binary snapshot of the response and delegation caches for warm restarts
+
+Layout, all integers in network order:
+    header      magic, version, wall clock time of saving, entry counts, offset of the message data
+    responses   per cached response - absolute expiry and store time, qtype, qclass, negative flag, offset and length
+                of its wire format within the message data, followed by the length prefixed cache key name
+    zones       per zone cut - absolute expiry, NS count, zone name and NS names
+    addresses   per nameserver - absolute expiry, address count, name and IPv4 addresses as 4 bytes each
+    messages    wire format of every cached response including RDATA, TTLs as when stored
+
+Loading maps the file and reads the fixed size index only, responses are wrapped in LazyDnsMessage views of the
+mapping and decoded on their first cache hit. Times are saved as wall clock readings and translated into the
+clock of the caches on load, entries which expired in the meantime are skipped unless still within the stale
+window of the response cache"""
+import asyncio
+import math
+import mmap
+import os
+import socket
+import struct
+import time
+from typing import Optional
+
+from resolver.cache import AddressEntry, CacheEntry, Delegation, DelegationCache, ResponseCache
+from resolver.packet import LazyDnsMessage
+from resolver.record_type import QClass, QType
+from resolver.resolver import delegation_cache, response_cache
+
+MAGIC = b"DNSC"
+VERSION = 1
+HEADER = struct.Struct("!4sHHdIIIQ")  # magic, version, reserved, saved, responses, zones, addresses, data offset
+RESPONSE = struct.Struct("!ddHHBII")  # expires, stored, qtype, qclass, negative, offset, length
+EXPIRING = struct.Struct("!dB")  # expires, count of NS names or addresses
+NAME_LENGTH = struct.Struct("!B")
+
+
+def encode_text(name: str) -> bytes:
+    data = name.encode()
+    return NAME_LENGTH.pack(len(data)) + data
+
+
+def decode_text(view: memoryview, pos: int) -> tuple[str, int]:
+    length = view[pos]
+    return bytes(view[pos + 1:pos + 1 + length]).decode(), pos + 1 + length
+
+
+def save_snapshot(path: str, cache: Optional[ResponseCache] = None,
+                  delegations: Optional[DelegationCache] = None) -> int:
+    """Writes entries of the caches to path leaving out expired ones, the file is replaced atomically
+    Responses expired within the stale window of the response cache are kept
+    Responses are written least recently used first so that loading restores their order
+    Returns the number of responses and zone cuts written"""
+    wall = time.time()
+    index, zones, addresses, messages = [], [], [], []
+    data_size = 0
+    if cache is not None:
+        offset = wall - cache.clock()
+        now = cache.clock()
+        for (name, qtype, qclass), entry in cache.entries.items():
+            if entry.expires + cache.stale_window <= now:
+                continue
+            wire = entry.message.build_bytes()
+            index.append(RESPONSE.pack(entry.expires + offset, entry.stored + offset, qtype.value, qclass.value,
+                                       entry.negative, data_size, len(wire)) + encode_text(name))
+            messages.append(wire)
+            data_size += len(wire)
+
+    if delegations is not None:
+        offset = wall - delegations.clock()
+        now = delegations.clock()
+        for delegation in delegations.zones.values():
+            if delegation.expires <= now or math.isinf(delegation.expires):  # Root hints are built in
+                continue
+            zones.append(EXPIRING.pack(delegation.expires + offset, len(delegation.nameservers)) +
+                         encode_text(delegation.zone) + b"".join(encode_text(ns) for ns in delegation.nameservers))
+        for name, entry in delegations.addresses.items():
+            if entry.expires <= now or math.isinf(entry.expires):
+                continue
+            addresses.append(EXPIRING.pack(entry.expires + offset, len(entry.addresses)) + encode_text(name) +
+                             b"".join(socket.inet_aton(addr) for addr in entry.addresses))
+
+    data_offset = HEADER.size + sum(map(len, index)) + sum(map(len, zones)) + sum(map(len, addresses))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, wall, len(index), len(zones), len(addresses), data_offset))
+        for part in (index, zones, addresses, messages):
+            f.writelines(part)
+    os.replace(tmp, path)
+    return len(index) + len(zones)
+
+
+def load_snapshot(path: str, cache: Optional[ResponseCache] = None,
+                  delegations: Optional[DelegationCache] = None) -> int:
+    """Restores entries saved by save_snapshot into the caches, entries expired by now are dropped
+    Raises ValueError if path does not hold a snapshot. Returns the number of responses and zone cuts restored"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError(f"{path} is not a cache snapshot")
+        view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))  # Mapping outlives the file object
+    magic, version, _, _, responses, zone_count, address_count, data_offset = HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a cache snapshot of version {VERSION}")
+
+    wall = time.time()
+    restored = 0
+    pos = HEADER.size
+    clock_offset = wall - cache.clock() if cache is not None else 0.0
+    for _ in range(responses):
+        expires, stored, qtype, qclass, negative, offset, length = RESPONSE.unpack_from(view, pos)
+        name, pos = decode_text(view, pos + RESPONSE.size)
+        if cache is None or expires + cache.stale_window <= wall:
+            continue
+        try:
+            key = name, QType(qtype), QClass(qclass)
+        except ValueError:
+            continue  # Type unknown to this version
+        start = data_offset + offset
+        message = LazyDnsMessage().from_bytes(view[start:start + length])
+        cache.restore(key,
+                      CacheEntry(message, stored=stored - clock_offset, expires=expires - clock_offset, size=length,
+                                 negative=bool(negative)))
+        restored += 1
+
+    for _ in range(zone_count):
+        expires, count = EXPIRING.unpack_from(view, pos)
+        zone, pos = decode_text(view, pos + EXPIRING.size)
+        nameservers = []
+        for _ in range(count):
+            ns, pos = decode_text(view, pos)
+            nameservers.append(ns)
+        if delegations is not None and expires > wall:
+            delegations.restore(Delegation(zone, nameservers, expires - wall + delegations.clock()))
+            restored += 1
+
+    for _ in range(address_count):
+        expires, count = EXPIRING.unpack_from(view, pos)
+        name, pos = decode_text(view, pos + EXPIRING.size)
+        addresses = [socket.inet_ntoa(view[pos + 4 * i:pos + 4 * i + 4]) for i in range(count)]
+        pos += 4 * count
+        if delegations is not None and expires > wall:
+            delegations.addresses[name] = AddressEntry(addresses, expires - wall + delegations.clock())
+    return restored
+
+
+async def keep_snapshot(path: str, interval: float = 300.0, cache: Optional[ResponseCache] = response_cache,
+                        delegations: Optional[DelegationCache] = delegation_cache):
+    """Restores the caches from path, then saves them every interval seconds and once more when cancelled
+    A missing or unreadable snapshot is ignored, the server then starts cold rather than not at all"""
+    try:
+        load_snapshot(path, cache, delegations)
+    except (OSError, ValueError, struct.error):
+        pass
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            save_snapshot(path, cache, delegations)
+    finally:
+        save_snapshot(path, cache, delegations)
@@ -0,0 +1,72 @@
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class Span:
+    """Timed step of a resolution - "resolve" for a whole (sub-)resolution, "query" for a single upstream query
+    Timestamps are time.perf_counter readings, phases map e.g. encode, network and decode onto their durations"""
+    name: str
+    kind: str = "resolve"
+    start: float = field(default_factory=time.perf_counter)
+    end: Optional[float] = None
+    server: Optional[str] = None
+    bytes_out: int = 0
+    bytes_in: int = 0
+    outcome: str = ""  # RCODE name, CACHED, TIMEOUT, ERROR...
+    phases: dict[str, float] = field(default_factory=dict)
+    children: list["Span"] = field(default_factory=list)
+
+    def child(self, name: str, kind: str = "query", server: Optional[str] = None) -> "Span":
+        span = Span(name, kind, server=server)
+        self.children.append(span)
+        return span
+
+    def finish(self, outcome: str):
+        self.outcome = outcome
+        self.end = time.perf_counter()
+        return self
+
+    def phase(self, name: str, started: float) -> float:
+        """Adds time since started to the phase, returns the current clock reading to start the next phase"""
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - started
+        return now
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def walk(self, depth: int = 0):
+        """Yields (depth, span) for this span and all of its descendants in start order"""
+        yield depth, self
+        for span in self.children:
+            yield from span.walk(depth + 1)
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "kind": self.kind, "start": self.start, "end": self.end,
+                "duration": self.duration, "server": self.server, "bytes_out": self.bytes_out,
+                "bytes_in": self.bytes_in, "outcome": self.outcome, "phases": self.phases,
+                "children": [span.to_dict() for span in self.children]}
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def waterfall(self, width: int = 40, name_pad: int = 48) -> str:
+        """Renders the span tree as a waterfall chart, one line per span with a bar placed on the shared time axis"""
+        total = self.duration or 1e-9
+        lines = [f"<<TRACE>> {self.name} {self.duration * 1000:.1f}ms"]
+        for depth, span in self.walk():
+            offset = int((span.start - self.start) / total * width)
+            length = max(1, round(span.duration / total * width))
+            bar = (" " * offset + "#" * length)[:width].ljust(width)
+            label = ("  " * depth + span.name)[:name_pad].ljust(name_pad)
+            details = [span.outcome or "PENDING"]
+            if span.kind == "query" and span.server:
+                details.append(f"out {span.bytes_out}B in {span.bytes_in}B")
+            if span.phases:
+                details.append(" ".join(f"{phase} {seconds * 1000:.2f}ms" for phase, seconds in span.phases.items()))
+            lines.append(f"{label}|{bar}|{span.duration * 1000:9.1f}ms  {', '.join(details)}")
+        return "\n".join(lines)
@@ -0,0 +1,304 @@
+import asyncio
+import random
+import struct
+import threading
+import weakref
+from typing import Awaitable, Optional, TypeVar
+
+from resolver.buffer import UINT16, ByteBuffer
+from resolver.packet import HEADER, QUESTION_FIXED, DnsMessage
+
+T = TypeVar("T")
+
+ServerAddress = tuple[str, int]
+QuestionKey = tuple[str, int, int]  # Lowercase QNAME, QTYPE, QCLASS values
+
+
+def question_key(data: bytes) -> tuple[int, int, int, Optional[QuestionKey]]:
+    """Decodes only what is needed to match a response with its query - ID, flags, QDCOUNT and the first question"""
+    bb = ByteBuffer(data)
+    ID, flags, qdcount, _, _, _ = HEADER.unpack_from(bb.view, 0)
+    if qdcount == 0:
+        return ID, flags, qdcount, None
+    bb.skip(HEADER.size)
+    name = bb.read_qname().lower()
+    qtype, qclass = QUESTION_FIXED.unpack_from(bb.view, bb.pos)
+    return ID, flags, qdcount, (name, qtype, qclass)
+
+
+def deliver(pending: dict, key, data: bytes, question: Optional[QuestionKey], qdcount: int, flags: int):
+    """Completes the future waiting under key if the response echoes its question
+    Servers may omit the question in FORMERR style responses, otherwise it has to match the query"""
+    waiter = pending.get(key)
+    if waiter is None:
+        return
+    expected, future = waiter
+    if question != expected and not (qdcount == 0 and flags & 0xF):
+        return
+    if not future.done():
+        future.set_result(data)
+
+
+def expected_question(message: DnsMessage) -> QuestionKey:
+    q = message.question[0]
+    return q.name.strip(".").lower(), q.qtype.value, q.qclass.value
+
+
+def is_truncated(data: bytes) -> bool:
+    """Whether TC flag is set in the header of an encoded message"""
+    return len(data) > 2 and bool(data[2] & 0x02)
+
+
+class DnsDatagramProtocol(asyncio.DatagramProtocol):
+    """Single UDP socket shared by many in-flight queries, responses are demultiplexed by server address,
+    transaction ID and question. Datagrams which do not match any pending query are dropped"""
+
+    def __init__(self):
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: dict[tuple[ServerAddress, int], tuple[QuestionKey, asyncio.Future]] = {}
+        self.opened = asyncio.get_running_loop().time()
+        self.queries = 0  # Queries sent from this socket
+        self.closed = False
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: ServerAddress):
+        try:
+            ID, flags, qdcount, question = question_key(data)
+        except (struct.error, ValueError, IndexError):
+            return  # Malformed datagram, cannot belong to any query
+        deliver(self.pending, (addr[:2], ID), data, question, qdcount, flags)
+
+    def error_received(self, exc: Exception):
+        # ICMP errors e.g. port unreachable are reported without the offending address, queries will time out
+        pass
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        for _, future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("UDP socket closed"))
+
+
+class UdpTransport:
+    """Small pool of UDP sockets multiplexing any number of concurrent queries
+    Each query gets a transaction ID unique among queries pending on its socket towards the same server
+    A socket is replaced by one bound to a new random port once it sent max_queries queries or is max_age seconds
+    old, so that spoofed responses have to guess the source port as well as the ID. Retired sockets are closed once
+    their pending queries are answered, sockets closed by errors are dropped from the pool"""
+
+    def __init__(self, pool_size: int = 4, bind_address: str = "0.0.0.0", max_queries: int = 100,
+                 max_age: float = 10.0):
+        self.pool_size = pool_size
+        self.bind_address = bind_address
+        self.max_queries = max_queries
+        self.max_age = max_age
+        self.protocols: list[DnsDatagramProtocol] = []
+        self.retired: set[DnsDatagramProtocol] = set()  # Out of the pool, still waiting for responses
+        self._lock: Optional[asyncio.Lock] = None
+        self._next = 0
+
+    def _retire(self, protocol: DnsDatagramProtocol):
+        self.protocols.remove(protocol)
+        if protocol.pending and not protocol.closed:
+            self.retired.add(protocol)
+        else:
+            protocol.transport.close()
+
+    async def _protocol(self) -> DnsDatagramProtocol:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        expired = asyncio.get_running_loop().time() - self.max_age
+        for protocol in [p for p in self.protocols if p.closed or p.queries >= self.max_queries or p.opened <= expired]:
+            self._retire(protocol)
+        # While a socket is being opened queries use those already open instead of queueing on the lock
+        if len(self.protocols) < self.pool_size and not (self.protocols and self._lock.locked()):
+            async with self._lock:
+                if len(self.protocols) < self.pool_size:
+                    loop = asyncio.get_running_loop()
+                    _, protocol = await loop.create_datagram_endpoint(DnsDatagramProtocol,
+                                                                      local_addr=(self.bind_address, 0))
+                    self.protocols.append(protocol)
+                    return protocol
+        self._next = (self._next + 1) % len(self.protocols)
+        return self.protocols[self._next]
+
+    async def query(self, message: DnsMessage, server: ServerAddress, timeout: float) -> bytes:
+        """Sends the query and waits for the matching response at most timeout seconds
+        Transaction ID of the message is replaced if it collides with another pending query
+        Raises asyncio.TimeoutError if no response arrived in time"""
+        protocol = await self._protocol()
+        protocol.queries += 1
+        expected = expected_question(message)
+        while (server, message.header.ID) in protocol.pending:
+            message.header.ID = random.getrandbits(16)
+
+        key = (server, message.header.ID)
+        future = asyncio.get_running_loop().create_future()
+        protocol.pending[key] = (expected, future)
+        try:
+            protocol.transport.sendto(message.build_bytes(), server)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del protocol.pending[key]
+            if protocol in self.retired and not protocol.pending:
+                self.retired.discard(protocol)
+                protocol.transport.close()
+
+    def close(self):
+        for protocol in self.protocols + list(self.retired):
+            protocol.transport.close()
+        self.protocols.clear()
+        self.retired.clear()
+
+
+class TcpConnection:
+    """Persistent TCP connection to a single server carrying pipelined queries framed with 2 byte length prefix
+    as defined in RFC7766. Responses may arrive in any order and are matched by transaction ID and question"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, idle_timeout: float):
+        self.reader = reader
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+        self.pending: dict[int, tuple[QuestionKey, asyncio.Future]] = {}
+        self.closed = False
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    async def _read_responses(self):
+        error: Exception = ConnectionError("TCP connection closed by server")
+        try:
+            while True:
+                length = UINT16.unpack(await self.reader.readexactly(2))[0]
+                data = await self.reader.readexactly(length)
+                try:
+                    ID, flags, qdcount, question = question_key(data)
+                except (struct.error, ValueError, IndexError):
+                    continue
+                deliver(self.pending, ID, data, question, qdcount, flags)
+        except asyncio.IncompleteReadError:
+            pass
+        except OSError as e:
+            error = e
+        finally:
+            self.close()
+            for _, future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+
+    async def query(self, message: DnsMessage, timeout: float) -> bytes:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        while message.header.ID in self.pending:
+            message.header.ID = random.getrandbits(16)
+
+        key = message.header.ID
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = (expected_question(message), future)
+        try:
+            data = message.build_bytes()
+            self.writer.write(UINT16.pack(len(data)) + data)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[key]
+            if not self.pending and not self.closed:
+                self._idle_handle = asyncio.get_running_loop().call_later(self.idle_timeout, self.close)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            if self._reader_task is not asyncio.current_task():
+                self._reader_task.cancel()
+
+
+class TcpTransport:
+    """Pool of persistent TCP connections, one per server, reused by subsequent queries and closed once idle
+    for idle_timeout seconds. Concurrent queries to the same server are pipelined on a single connection"""
+
+    def __init__(self, idle_timeout: float = 10.0):
+        self.idle_timeout = idle_timeout
+        self.connections: dict[ServerAddress, TcpConnection] = {}
+        self._connecting: dict[ServerAddress, asyncio.Task] = {}
+
+    async def _connect(self, server: ServerAddress) -> TcpConnection:
+        reader, writer = await asyncio.open_connection(*server)
+        connection = TcpConnection(reader, writer, self.idle_timeout)
+        self.connections[server] = connection
+        return connection
+
+    async def connection(self, server: ServerAddress, timeout: float) -> TcpConnection:
+        connection = self.connections.get(server)
+        if connection is not None and not connection.closed:
+            return connection
+        task = self._connecting.get(server)
+        if task is None:
+            task = self._connecting[server] = asyncio.create_task(self._connect(server))
+            task.add_done_callback(lambda _: self._connecting.pop(server, None))
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    async def query(self, message: DnsMessage, server: ServerAddress, timeout: float) -> bytes:
+        """Sends the query over a pooled connection and waits for the matching response at most timeout seconds
+        in total, connection setup included. Raises asyncio.TimeoutError or OSError on failure"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        connection = await self.connection(server, timeout)
+        return await connection.query(message, max(deadline - loop.time(), 0))
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+
+_udp_transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, UdpTransport]" = weakref.WeakKeyDictionary()
+_tcp_transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, TcpTransport]" = weakref.WeakKeyDictionary()
+
+
+def udp_transport() -> UdpTransport:
+    """Returns the UDP socket pool of the running event loop, sockets cannot be shared across loops"""
+    loop = asyncio.get_running_loop()
+    transport = _udp_transports.get(loop)
+    if transport is None:
+        transport = _udp_transports[loop] = UdpTransport()
+    return transport
+
+
+def tcp_transport() -> TcpTransport:
+    """Returns the TCP connection pool of the running event loop"""
+    loop = asyncio.get_running_loop()
+    transport = _tcp_transports.get(loop)
+    if transport is None:
+        transport = _tcp_transports[loop] = TcpTransport()
+    return transport
+
+
+class BackgroundLoop:
+    """Event loop running in a daemon thread, lets blocking code await coroutines even when the calling thread
+    already runs its own loop e.g. in a notebook"""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="resolver-loop", daemon=True).start()
+                self.loop = loop
+        return self.loop
+
+    def run(self, coro: Awaitable[T]) -> T:
+        """Runs coroutine on the background loop and blocks until it completes"""
+        loop = self.loop or self._start()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+background_loop = BackgroundLoop()
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    return background_loop.run(coro)
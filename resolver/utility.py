@@ -1,21 +1,27 @@
-import binascii
+from dataclasses import fields
 
+from resolver.buffer import ByteWriter
 
-def to_qname(domain_name: str):
-    qname = ""
-    domain_name = domain_name.strip(".")    # Remove trailing and leading '.'
-
-    labels = domain_name.split(".")
-    for label in labels:
-        address_hex = binascii.hexlify(label.encode()).decode()
-        qname += f"{len(label):02x}{address_hex}"
-
-    if not (len(labels) == 1 and labels[0] == ""):  # Fixes query for "" root
-        qname += "00"
 
-    return qname
+def to_qname(domain_name: str):
+    """Returns domain name encoded as length prefixed labels in a hex str, kept for compatibility
+    with the hex based API - the encoder itself uses ByteWriter.write_qname"""
+    return ByteWriter(bytearray(len(domain_name) + 2)).write_qname(domain_name).getvalue().hex()
 
 
 def fqdn(domain_name: str):
     """Creates fully qualified domain name"""
     return f"{domain_name}."
+
+
+def slotted(cls):
+    """Recreates a dataclass with __slots__ holding its fields so that instances carry no per-instance __dict__
+    Equivalent of @dataclass(slots=True) which is not available before Python 3.10"""
+    cls_dict = dict(cls.__dict__)
+    field_names = tuple(f.name for f in fields(cls))
+    cls_dict["__slots__"] = field_names
+    for name in field_names:
+        cls_dict.pop(name, None)  # Defaults are kept by the generated __init__, class attributes would clash
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
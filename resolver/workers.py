@@ -0,0 +1,141 @@
+import asyncio
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from typing import Callable, Optional
+
+from resolver.server import DnsServer, Resolve
+from resolver.snapshot import keep_snapshot
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    """Port currently free for both UDP and TCP on host, workers cannot share a port picked by binding to port 0"""
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.bind((host, 0))
+            port = udp.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+                try:
+                    tcp.bind((host, port))
+                except OSError:
+                    continue
+        return port
+
+
+def serve_worker(make_resolve: Callable[[], Resolve], host: str, port: int, max_pending: int = 10000,
+                 cache_file: Optional[str] = None, snapshot_interval: float = 300.0):
+    """Body of a worker process - serves host:port sharing it with the other workers through SO_REUSEPORT
+    make_resolve is called in the worker, so every worker has a cache of its own. The kernel hashes each client
+    address onto one worker, with N workers a name is looked up upstream and cached up to N times and the hit ratio
+    drops accordingly while the cache is cold. Sharing a cache between processes would cost a lock or copying on
+    every hit, which is the overhead workers are there to avoid. With cache_file every worker restores the shared
+    snapshot of the default caches on start and saves its own caches into it, the last one saving wins"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole process group, the supervisor stops us
+
+    async def serve():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        snapshot = asyncio.ensure_future(keep_snapshot(cache_file, snapshot_interval)) if cache_file else None
+        server = DnsServer(make_resolve(), host, port, max_pending=max_pending, reuse_port=True)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            if snapshot is not None:
+                snapshot.cancel()
+                await asyncio.gather(snapshot, return_exceptions=True)
+
+    try:
+        asyncio.run(serve())
+    except asyncio.CancelledError:
+        pass
+
+
+class Supervisor:
+    """Keeps workers processes running target, a worker that exits for any reason is started again
+    A worker that exits within min_uptime seconds of its start is restarted only after restart_delay seconds,
+    so that one failing at startup does not spin. Workers are forked, target may be any callable"""
+
+    def __init__(self, target: Callable[[], None], workers: int, min_uptime: float = 1.0,
+                 restart_delay: float = 1.0):
+        self.target = target
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        self.context = multiprocessing.get_context("fork")
+        self.processes: list[Optional[BaseProcess]] = [None] * workers
+        self.started = [0.0] * workers
+        self.due: dict[int, float] = {}  # Slots of exited workers onto the time they may be restarted
+        self.restarts = 0
+        self.stopping = False
+
+    def start(self):
+        for slot in range(len(self.processes)):
+            self._spawn(slot)
+        return self
+
+    def _spawn(self, slot: int):
+        process = self.context.Process(target=self.target, name=f"dns-worker-{slot}", daemon=True)
+        process.start()
+        self.processes[slot] = process
+        self.started[slot] = time.monotonic()
+
+    def supervise(self, timeout: Optional[float] = None) -> int:
+        """Waits up to timeout seconds for workers to exit and restarts those due, returns number restarted"""
+        now = time.monotonic()
+        if self.due:
+            wake = max(0.0, min(self.due.values()) - now)
+            timeout = wake if timeout is None else min(timeout, wake)
+        sentinels = {p.sentinel: slot for slot, p in enumerate(self.processes) if p is not None}
+        for sentinel in wait(list(sentinels), timeout):
+            slot = sentinels[sentinel]
+            self.processes[slot].join()
+            self.processes[slot] = None
+            now = time.monotonic()
+            quick = now - self.started[slot] < self.min_uptime
+            self.due[slot] = now + self.restart_delay if quick else now
+
+        restarted = 0
+        now = time.monotonic()
+        for slot, due in list(self.due.items()):
+            if due <= now and not self.stopping:
+                del self.due[slot]
+                self._spawn(slot)
+                restarted += 1
+        self.restarts += restarted
+        return restarted
+
+    def run(self):
+        """Starts the workers and supervises them until stop() is called from a signal handler or another thread"""
+        if all(p is None for p in self.processes):
+            self.start()
+        try:
+            while not self.stopping:
+                self.supervise(0.5)
+        finally:
+            self.stop()
+
+    def stop(self, timeout: float = 5.0):
+        """Terminates all workers, killing those still alive after timeout seconds"""
+        self.stopping = True
+        running = [p for p in self.processes if p is not None]
+        for process in running:
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in running:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.processes = [None] * len(self.processes)
+        self.due.clear()
+
+    def alive(self) -> int:
+        return sum(1 for p in self.processes if p is not None and p.is_alive())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
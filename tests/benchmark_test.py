@@ -0,0 +1,37 @@
+import unittest
+
+from benchmarks import snapshot
+from benchmarks.codec import Result, large_response, mixed_response, regressions, run
+from resolver.packet import DnsMessage
+
+
+class CodecBenchmarkTest(unittest.TestCase):
+    def test_generated_packets_round_trip(self):
+        for data in (large_response(300), mixed_response(50)):
+            self.assertEqual(data, DnsMessage().from_bytes(data).build_bytes())
+
+    def test_run_reports_selected_cases(self):
+        results = run("a_with_jump/parse", min_time=0.001, repeat=1)
+        self.assertEqual(["a_with_jump/parse"], [r.case for r in results])
+        self.assertGreater(results[0].ns_per_op, 0)
+        self.assertGreater(results[0].blocks, 0)
+
+    def test_regressions_above_threshold(self):
+        baseline = {"results": [{"case": "a/parse", "ns_per_op": 1000.0}, {"case": "a/build", "ns_per_op": 1000.0}]}
+        results = [Result("a/parse", 10, 1200.0, 0, 0), Result("a/build", 10, 1050.0, 0, 0),
+                   Result("b/parse", 10, 5000.0, 0, 0)]
+        found = regressions(results, baseline, threshold=0.1)
+        self.assertEqual(1, len(found))
+        self.assertTrue(found[0].startswith("a/parse: 1000 -> 1200"))
+
+
+class SnapshotBenchmarkTest(unittest.TestCase):
+    def test_restored_cache_is_warm(self):
+        result, = snapshot.run([50])
+        self.assertEqual(50, result.entries)
+        self.assertLessEqual(result.load_ms, result.first_answer_ms)
+        self.assertLessEqual(result.first_answer_ms, result.warm_ms)
+
+
+if __name__ == '__main__':
+    unittest.main()
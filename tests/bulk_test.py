@@ -0,0 +1,74 @@
+import asyncio
+import io
+import unittest
+
+from resolver.bulk import BulkSummary, parse_line, resolve_stream
+from resolver.metrics import LatencyHistogram
+from resolver.record_type import QType
+from resolver.resolver import alookup
+from tests.fixtures import StubServer, a_record, answer_with
+
+
+class BulkTest(unittest.IsolatedAsyncioTestCase):
+    def test_parse_line(self):
+        self.assertEqual(("example.com", "MX"), parse_line("example.com mx\n"))
+        self.assertEqual(("example.com", "AAAA"), parse_line("  example.com  # comment", default_qtype="aaaa"))
+        self.assertIsNone(parse_line("# only a comment"))
+        self.assertIsNone(parse_line("\n"))
+
+    def test_latency_histogram_quantiles(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.observe(ms / 1000)
+        self.assertAlmostEqual(0.5, histogram.quantile(0.5), delta=0.05)
+        self.assertAlmostEqual(0.99, histogram.quantile(0.99), delta=0.099)
+        self.assertEqual(1.0, histogram.quantile(1.0))
+        self.assertAlmostEqual(0.5005, histogram.mean())
+
+    async def test_bounded_concurrency(self):
+        in_flight, peak = 0, 0
+
+        async def resolve(qname, qtype):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.001)
+            in_flight -= 1
+            return None
+
+        lines = (f"host{i}.example.com\n" for i in range(1000))
+        results = [result async for result in resolve_stream(lines, resolve, concurrency=7)]
+        self.assertEqual(1000, len(results))
+        self.assertEqual(7, peak)
+        self.assertEqual({"TIMEOUT"}, {result.status for result in results})
+
+    async def test_resolve_against_stub(self):
+        def handler(query):
+            if query.question[0].name == "slow.example.com":
+                return None
+            return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+        source = io.StringIO("a.example.com\nb.example.com aaaa\n\nslow.example.com\nc.example.com bogus\n")
+        with StubServer(handler) as stub:
+            async def resolve(qname, qtype):
+                return await alookup(qname, qtype, "127.0.0.1", verbose=False, cache=None, timeout=0.2,
+                                     port=stub.port, output=False)
+
+            summary = BulkSummary()
+            results = {}
+            async for result in resolve_stream(source, resolve, concurrency=2):
+                summary.add(result)
+                results[result.qname] = result
+
+        self.assertEqual("NO_ERROR", results["a.example.com"].status)
+        self.assertEqual(QType.AAAA, results["b.example.com"].response.question[0].qtype)
+        self.assertEqual("TIMEOUT", results["slow.example.com"].status)
+        self.assertEqual("BADTYPE", results["c.example.com"].status)
+        self.assertEqual("a.example.com\tA\tNO_ERROR", results["a.example.com"].concise_info().rsplit("\t", 2)[0])
+        self.assertEqual((4, 2), (summary.total, summary.errors))
+        self.assertEqual(2, summary.latency.count)
+        self.assertIn("4 queries", summary.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
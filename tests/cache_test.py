@@ -0,0 +1,154 @@
+import unittest
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.packet import DnsHeader, DnsQuestion, DnsMessage
+from resolver.record_type import QType, RCode
+from resolver.resolver import lookup, recursive_lookup
+from resolver.root_hints import ROOT_HINTS
+from tests.fixtures import RESPONSE_A_NS_BERKELEY, RESPONSE_DNS_FRAME_A_WITH_JUMP, FakeClock, negative_response, \
+    referral, response
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(clock=self.clock)
+
+    def test_positive_ttl_and_aging(self):
+        response = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        self.assertTrue(self.cache.put(response))
+
+        self.clock.now += 100
+        cached = self.cache.get("ADNS3.berkeley.edu.", QType.A)
+        self.assertEqual(10800 - 100, cached.answer[0].ttl)
+        self.assertEqual(10800, response.answer[0].ttl)  # Stored message is left untouched
+        self.assertEqual(["192.107.102.142"], cached.answer_records(QType.A))
+
+        self.clock.now += 10800
+        self.assertIsNone(self.cache.get("adns3.berkeley.edu", "a"))
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_negative_caching_uses_soa_minimum(self):
+        self.assertTrue(self.cache.put(negative_response("nope.example.com", RCode.NXDOMAIN)))
+        self.clock.now += 59
+        self.assertEqual(RCode.NXDOMAIN, self.cache.get("nope.example.com", QType.A).header.response_code)
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get("nope.example.com", QType.A))
+
+        # NODATA is bound by SOA TTL when it is lower than MINIMUM
+        self.assertTrue(self.cache.put(negative_response("www.example.com", RCode.NO_ERROR, soa_ttl=30)))
+        self.assertEqual((30, True), self.cache.cache_ttl(negative_response("x", RCode.NO_ERROR, soa_ttl=30)))
+
+    def test_uncacheable_responses(self):
+        no_soa = DnsMessage(header=DnsHeader(response=True, response_code=RCode.NXDOMAIN))
+        no_soa.add_question(DnsQuestion("nope.example.com", QType.A))
+        self.assertFalse(self.cache.put(no_soa))
+
+        servfail = negative_response("x.example.com", RCode.SERVFAIL)
+        self.assertFalse(self.cache.put(servfail))
+
+        truncated = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        truncated.header.truncation = True
+        self.assertFalse(self.cache.put(truncated))
+        self.assertEqual(0, len(self.cache))
+
+    def test_lru_eviction_by_entries_and_bytes(self):
+        cache = ResponseCache(max_entries=2, clock=self.clock)
+        first = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        second = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_DNS_FRAME_A_WITH_JUMP))
+        cache.put(first)
+        cache.put(second)
+        cache.get("adns3.berkeley.edu", QType.A)  # Touch first so that second is least recently used
+        cache.put(negative_response("nope.example.com", RCode.NXDOMAIN))
+        self.assertIsNone(cache.get("h.root-servers.net", QType.A))
+        self.assertIsNotNone(cache.get("adns3.berkeley.edu", QType.A))
+        self.assertEqual(1, cache.evictions)
+
+        cache = ResponseCache(max_entries=None, max_bytes=100, clock=self.clock)
+        cache.put(first, size=60)
+        cache.put(second, size=60)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(60, cache.stats()["bytes"])
+
+    def test_stale_entries_kept_within_window(self):
+        cache = ResponseCache(clock=self.clock, stale_window=600, stale_ttl=30)
+        cache.put(DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY)))
+        self.assertEqual(10800, cache.get_stale("adns3.berkeley.edu", QType.A).answer[0].ttl)
+        self.assertFalse(cache.has_stale("adns3.berkeley.edu", QType.A))
+
+        self.clock.now += 10800 + 300
+        self.assertIsNone(cache.get("adns3.berkeley.edu", QType.A))
+        self.assertTrue(cache.has_stale("adns3.berkeley.edu", QType.A))
+        stale = cache.get_stale("adns3.berkeley.edu", QType.A)
+        self.assertEqual([30], [rr.ttl for rr in stale.answer])
+        self.assertEqual((1, 1), (cache.stale_hits, len(cache)))
+
+        self.clock.now += 300
+        self.assertIsNone(cache.get_stale("adns3.berkeley.edu", QType.A))
+        self.assertIsNone(cache.get("adns3.berkeley.edu", QType.A))
+        self.assertEqual(0, len(cache))
+
+    def test_lookup_served_from_cache(self):
+        response = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        self.cache.put(response)
+        # Server address is unroutable - a network round trip would time out instead of answering
+        cached = lookup("adns3.berkeley.edu", "A", server_ip="192.0.2.1", verbose=False, output=False, cache=self.cache)
+        self.assertEqual(["192.107.102.142"], cached.answer_records(QType.A))
+        resolved = recursive_lookup("adns3.berkeley.edu", QType.A, output=False, cache=self.cache)
+        self.assertEqual(["192.107.102.142"], resolved.answer_records(QType.A))
+        self.assertEqual(2, self.cache.hits)
+
+
+class DelegationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.delegations = DelegationCache(clock=self.clock)
+
+    def test_root_hints_bootstrap(self):
+        zone, servers = self.delegations.closest("www.example.com")
+        self.assertEqual("", zone)
+        self.assertEqual(set(ROOT_HINTS.items()), set(servers))
+
+    def test_closest_enclosing_zone(self):
+        com = referral("www.example.com", "com", {"a.gtld-servers.net": "192.5.6.30"}, ttl=172800)
+        example = referral("www.example.com", "example.com", {"ns1.example.com": "192.0.2.53"}, ttl=300)
+        self.assertEqual("com", self.delegations.add_referral(com, bailiwick=""))
+        self.assertEqual("example.com", self.delegations.add_referral(example, bailiwick="com"))
+
+        self.assertEqual(("example.com", [("ns1.example.com", "192.0.2.53")]),
+                         self.delegations.closest("mail.EXAMPLE.com."))
+        self.assertEqual(("com", [("a.gtld-servers.net", "192.5.6.30")]), self.delegations.closest("other.com"))
+
+        # Zone cut expires with NS TTL, resolution falls back to the parent
+        self.clock.now += 300
+        self.assertEqual("com", self.delegations.closest("mail.example.com")[0])
+
+    def test_rejects_out_of_bailiwick_and_upward_referrals(self):
+        foreign = referral("www.example.com", "example.net", {"ns.example.net": "192.0.2.1"})
+        upward = referral("www.example.com", "com", {"a.gtld-servers.net": "192.5.6.30"})
+        self.assertIsNone(self.delegations.add_referral(foreign, bailiwick=""))
+        self.assertIsNone(self.delegations.add_referral(upward, bailiwick="example.com"))
+        self.assertEqual(1, len(self.delegations))
+
+    def test_glueless_delegation_needs_addresses(self):
+        glueless = referral("www.example.com", "example.com", {"ns.example.net": None})
+        self.assertEqual("example.com", self.delegations.add_referral(glueless))
+        self.assertEqual([], self.delegations.servers("example.com"))
+        self.assertEqual("", self.delegations.closest("www.example.com")[0])
+
+        self.delegations.add_addresses("ns.example.net.", ["192.0.2.7"], ttl=60)
+        self.assertEqual(("example.com", [("ns.example.net", "192.0.2.7")]),
+                         self.delegations.closest("www.example.com"))
+
+    def test_eviction_keeps_root(self):
+        delegations = DelegationCache(max_zones=3, clock=self.clock)
+        for tld in ("com", "net", "org", "io"):
+            delegations.add_referral(referral(f"x.{tld}", tld, {f"ns.nic.{tld}": "192.0.2.1"}))
+        self.assertLessEqual(len(delegations), 3)
+        self.assertIn("", delegations.zones)
+        self.assertIn("io", delegations.zones)
+
+
+if __name__ == '__main__':
+    unittest.main()
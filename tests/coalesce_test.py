@@ -0,0 +1,136 @@
+import asyncio
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.coalesce import SingleFlight
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsMessage
+from resolver.record_type import QType
+from resolver.resolver import alookup, arecursive_lookup, lookup
+from resolver.root_hints import ROOT_HINTS
+from tests.fixtures import COM_NS, StubServer, a_record, answer_with, referral, response
+
+
+def slow_answer(query: DnsMessage):
+    time.sleep(0.1)
+    return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    async def test_identical_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def call(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value
+
+        results = await asyncio.gather(*(flight.do("a", lambda: call(1)) for _ in range(10)),
+                                       flight.do("b", lambda: call(2)))
+        self.assertEqual([1] * 10 + [2], results)
+        self.assertEqual([1, 2], calls)
+        self.assertEqual(9, flight.coalesced)
+        self.assertEqual(0, len(flight))
+
+    async def test_waiter_timeout_leaves_call_running(self):
+        flight = SingleFlight()
+
+        async def call():
+            await asyncio.sleep(0.1)
+            return "done"
+
+        leader = asyncio.ensure_future(flight.do("a", call))
+        await asyncio.sleep(0)
+        with self.assertRaises(asyncio.TimeoutError):
+            await flight.do("a", call, timeout=0.01)
+        self.assertEqual("done", await leader)
+
+    async def test_call_cancelled_with_its_last_caller(self):
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def call():
+            started.set()
+            await asyncio.sleep(10)
+
+        callers = [asyncio.ensure_future(flight.do("a", call)) for _ in range(2)]
+        await started.wait()
+        callers[0].cancel()
+        await asyncio.sleep(0)
+        self.assertFalse(flight.calls["a"].cancelled())
+        task = flight.calls["a"]
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        self.assertTrue(task.cancelled())
+        self.assertEqual((0, 0), (len(flight), len(flight.waiters)))
+
+
+class LookupCoalescingTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_identical_lookups_send_one_query(self):
+        metrics = ResolverMetrics()
+        with StubServer(slow_answer) as stub:
+            responses = await asyncio.gather(*(alookup(name, QType.A, "127.0.0.1", verbose=False, output=False,
+                                                       cache=None, port=stub.port, stats=None, metrics=metrics)
+                                               for name in ["www.example.com"] * 20 + ["WWW.example.com.", "a.test"]))
+        self.assertEqual(22, len([r for r in responses if r is not None]))
+        self.assertEqual(2, len(stub.queries))
+        self.assertEqual({("lookup",): 20}, metrics.snapshot()["dns_coalesced_total"])
+
+    def test_sync_lookups_from_threads_share_query(self):
+        with StubServer(slow_answer) as stub:
+            with ThreadPoolExecutor(8) as pool:
+                responses = list(pool.map(lambda _: lookup("www.example.com", QType.A, "127.0.0.1", verbose=False,
+                                                           output=False, cache=None, port=stub.port, stats=None,
+                                                           metrics=None), range(8)))
+        self.assertEqual(8, len([r for r in responses if r is not None]))
+        self.assertEqual(1, len(stub.queries))
+
+
+class ResolutionCoalescingTest(unittest.IsolatedAsyncioTestCase):
+    def glueless_network(self, nameservers: dict):
+        """Referrals from .com for every example name to nameservers, a mapping of NS names onto NS names of their
+        own .net zones, all without glue. NS names served by no nameserver are answered by the .net server"""
+        async def fake_lookup(domain_name, record_type, server_ip, **kwargs):
+            await asyncio.sleep(0.01)
+            if server_ip in ROOT_HINTS.values():
+                if domain_name.endswith(".net"):
+                    return referral(domain_name, "net", {"ns.nic.net": "192.0.2.99"})
+                return referral(domain_name, "com", COM_NS)
+            if server_ip == "192.5.6.30":
+                return referral(domain_name, "example.com", {ns: None for ns in nameservers})
+            if server_ip == "192.0.2.99" and nameservers[domain_name]:
+                return referral(domain_name, domain_name.split(".", 1)[1],
+                                {ns: None for ns in nameservers[domain_name]})
+            return response(domain_name, answer=[a_record(domain_name, "192.0.2.80")])
+
+        return mock.AsyncMock(side_effect=fake_lookup)
+
+    async def test_shared_glueless_nameserver_resolved_once(self):
+        network = self.glueless_network({"ns.hosting.net": []})
+        cache, delegations = ResponseCache(), DelegationCache()
+        with mock.patch("resolver.resolver.alookup", network):
+            results = await asyncio.gather(*(arecursive_lookup(f"host{i}.example.com", QType.A, output=False,
+                                                               cache=cache, delegations=delegations)
+                                             for i in range(5)))
+        self.assertEqual(5, len([r for r in results if r is not None]))
+        ns_queries = [call for call in network.call_args_list if call.args[0] == "ns.hosting.net"]
+        self.assertEqual(2, len(ns_queries))  # Root then .net, once for all five resolutions
+
+    async def test_nameserver_depending_on_itself_gives_up(self):
+        # ns.loop.net is only served by itself
+        network = self.glueless_network({"ns.loop.net": ["ns.loop.net"]})
+        with mock.patch("resolver.resolver.alookup", network):
+            result = await asyncio.wait_for(arecursive_lookup("www.example.com", QType.A, output=False,
+                                                              cache=ResponseCache(), delegations=DelegationCache()),
+                                            timeout=2)
+        self.assertIsNotNone(result)
+        self.assertEqual([], result.answer)  # Referral returned as the nameserver address cannot be found
+
+
+if __name__ == '__main__':
+    unittest.main()
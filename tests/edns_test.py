@@ -0,0 +1,94 @@
+import unittest
+
+from resolver.edns import MIN_PAYLOAD_SIZE, EdnsProfileTable
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsMessage, Edns
+from resolver.policy import QueryPolicy
+from resolver.record_type import QType, RCode
+from resolver.resolver import create_query, lookup
+from tests.fixtures import FakeClock, StubServer, a_record, answer_with, ask
+
+COOKIE = 10
+
+
+class EdnsTest(unittest.TestCase):
+    def test_opt_record_round_trip(self):
+        query = create_query("www.example.com", QType.A, opt_size=None)
+        query.additional.append(Edns(4096, extended_rcode=1, dnssec_ok=True,
+                                     options=[(COOKIE, bytes(range(8)))]).to_record())
+        query.header.arcount = 1
+        parsed = DnsMessage().from_bytes(query.build_bytes())
+        edns = parsed.edns()
+        self.assertEqual(Edns(4096, 1, 0, True, [(COOKIE, bytes(range(8)))]), edns)
+        self.assertEqual(16, edns.response_code(parsed.header))  # BADVERS
+        self.assertEqual("10:0001020304050607", str(parsed.additional[0].rdata))
+
+    def test_default_query_advertises_safe_payload_size(self):
+        edns = DnsMessage().from_bytes(create_query("www.example.com", QType.A).build_bytes()).edns()
+        self.assertEqual((1232, False, []), (edns.udp_payload_size, edns.dnssec_ok, edns.options))
+        self.assertIsNone(create_query("www.example.com", QType.A, opt_size=None).edns())
+
+    def test_blocking_lookup_advertises_safe_payload_size(self):
+        with StubServer(lambda query: answer_with(query, [a_record("www.example.com", "192.0.2.1")])) as stub:
+            lookup("www.example.com", QType.A, "127.0.0.1", port=stub.port, verbose=False, output=False, cache=None,
+                   stats=None, metrics=None, policy=None, edns=None)
+        self.assertEqual(1232, DnsMessage().from_bytes(stub.queries[0]).edns().udp_payload_size)
+
+    def test_truncated_option_is_malformed(self):
+        query = create_query("www.example.com", QType.A, opt_size=None)
+        query.additional.append(Edns(1232, options=[(COOKIE, bytes(8))]).to_record())
+        query.header.arcount = 1
+        with self.assertRaises(ValueError):
+            DnsMessage().from_bytes(query.build_bytes()[:-2])
+
+    def test_profile_reduced_after_timeouts_and_forgotten(self):
+        clock = FakeClock()
+        profiles = EdnsProfileTable(max_age=600, clock=clock)
+        self.assertEqual(1232, profiles.udp_payload_size("192.0.2.1", 4096))
+        self.assertFalse(profiles.record_timeout("192.0.2.1", 1232))
+        self.assertTrue(profiles.record_timeout("192.0.2.1", 1232))
+        self.assertEqual(MIN_PAYLOAD_SIZE, profiles.udp_payload_size("192.0.2.1", 4096))
+        self.assertFalse(profiles.record_timeout("192.0.2.1", MIN_PAYLOAD_SIZE))
+        self.assertIsNone(profiles.udp_payload_size("192.0.2.1", None))
+        clock.now += 600
+        self.assertEqual(1232, profiles.udp_payload_size("192.0.2.1", 4096))
+
+
+class EdnsFallbackTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.profiles = EdnsProfileTable()
+        self.metrics = ResolverMetrics()
+
+    async def ask(self, port: int, policy=None):
+        return await ask(port, metrics=self.metrics, timeout=1, policy=policy, edns=self.profiles)
+
+    async def test_server_rejecting_edns_is_asked_without_it(self):
+        def no_edns(query: DnsMessage):
+            if query.edns() is not None:
+                return answer_with(query, rcode=RCode.FORMERR)
+            return answer_with(query, [a_record("www.example.com", "192.0.2.1")])
+
+        with StubServer(no_edns) as stub:
+            self.assertEqual(["192.0.2.1"], (await self.ask(stub.port)).answer_records(QType.A))
+            self.assertEqual(["192.0.2.1"], (await self.ask(stub.port)).answer_records(QType.A))
+            sent = [DnsMessage().from_bytes(data).edns() is not None for data in stub.queries]
+        self.assertEqual([True, False, False], sent)
+        self.assertEqual({("127.0.0.1", "disabled"): 1}, self.metrics.snapshot()["dns_edns_fallbacks_total"])
+
+    async def test_payload_size_reduced_when_large_queries_are_lost(self):
+        def fragmenting_path(query: DnsMessage):
+            if query.edns().udp_payload_size > MIN_PAYLOAD_SIZE:
+                return None
+            return answer_with(query, [a_record("www.example.com", "192.0.2.1")])
+
+        policy = QueryPolicy(initial_timeout=0.1, max_attempts=3, deadline=2.0)
+        with StubServer(fragmenting_path) as stub:
+            response = await self.ask(stub.port, policy)
+            sizes = [DnsMessage().from_bytes(data).edns().udp_payload_size for data in stub.queries]
+        self.assertEqual(["192.0.2.1"], response.answer_records(QType.A))
+        self.assertEqual([1232, 1232, 512], sizes)
+        self.assertEqual({("127.0.0.1", "reduced"): 1}, self.metrics.snapshot()["dns_edns_fallbacks_total"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import asyncio
+import ipaddress
+import socketserver
+import struct
+import threading
+
+from resolver.buffer import ByteBuffer, encode_name
+from resolver.packet import DnsHeader, DnsQuestion, DnsResourceRecord, DnsMessage
+from resolver.record_type import QType, QClass, RCode, ARecord, CNAMERecord, NSRecord, SOARecord
+from resolver.resolver import alookup
+
+# Messages captured from real servers
+RESPONSE_NS_ROOT = "1b9d81800001000e0000001a0000020001000002000100070bf2001401660c726f6f742d73657276657273036e657400" \
+                   "000002000100070bf200040163c01e000002000100070bf20004016ac01e000002000100070bf20004016dc01e000002" \
+                   "000100070bf20004016bc01e000002000100070bf200040165c01e000002000100070bf20004016cc01e000002000100" \
+                   "070bf200040162c01e000002000100070bf200040161c01e000002000100070bf200040164c01e000002000100070bf2" \
+                   "00040169c01e000002000100070bf200040167c01e000002000100070bf200040168c01e00002e000100070bf2011300" \
+                   "0208000007e9006243e3d06232b2402647001dfbd924aea41fac479152a8b01572487d61d43af61a4f15a0a07d6c5dc2" \
+                   "0430493b9a4789368867f773c73e53c44fba1d36483e8680c5d16be32c9b300e899471acecc115330ebedb2613904bf0" \
+                   "9c460ee514fa3a7548f0c62d628312d3e170fe204767d56966e0f66c71ee81c88a560d36f4db9e155549cfb18d8e3037" \
+                   "3b7309b7b3776fc739156e745a08fb981dce58fee3c5a4a6a3738ae406d1ff1c93544a6e8f1b2473e6ddeb32170c8662" \
+                   "502dcc5b381c77d4517217550da09d6e17f5fac200b661a91869caf5fc93eebef1eaeece2e22c88665cce9462610ffcd" \
+                   "17e1554f43e56eb4fe0c21a9a09655e7696643f4b6f48b9e0743a49167a5f02a6a09c0e000010001000860680004c661" \
+                   "be35c0e0001c000100086068001020010500000100000000000000000053c01c00010001000861050004c00505f1c01c" \
+                   "001c000100088d14001020010500002f0000000000000000000fc03b0001000100085dc00004c021040cc03b001c0001" \
+                   "000888ee00102001050000020000000000000000000cc04a0001000100085f590004c03a801ec04a001c0001000861f4" \
+                   "0010200105030c2700000000000000020030c0590001000100085d980004ca0c1b21c059001c000100085dd000102001" \
+                   "0dc3000000000000000000000035c0680001000100085d740004c1000e81c068001c0001000860d10010200107fd0000" \
+                   "00000000000000000001c07700010001000881750004c0cbe60ac077001c00010008675400102001050000a800000000" \
+                   "00000000000ec086000100010008609f0004c707532ac086001c000100087009001020010500009f0000000000000000" \
+                   "0042c0950001000100085dbb0004c7090ec9c0a40001000100085d700004c6290004c0a4001c0001000861a300102001" \
+                   "0503ba3e00000000000000020030c0b300010001000861f00004c7075b0dc0b3001c0001000861f0001020010500002d" \
+                   "0000000000000000000dc0c200010001000861ec0004c0249411c0c2001c000100085ff90010200107fe000000000000" \
+                   "000000000053c0d10001000100089b130004c0702404c0d1001c000100088d1400102001050000120000000000000000" \
+                   "0d0d0000290200000080000000"
+
+QUERY_A_ROOT_SERVER = "e2b40100000100000000000001630c726f6f742d73657276657273036e65740000010001"
+
+QUERY_A_BERKELEY = "026373086265726b656c6579036564750000010001"
+
+RESPONSE_DNS_FRAME_A_WITH_JUMP = "08758180000100010000000001680c726f6f742d73657276657273036e65740000010001c00c0" \
+                                 "0010001000882c00004c661be35"
+
+RESPONSE_A_NS_BERKELEY = "62a6818000010001000000000561646e7333086265726b656c6579036564750000010001c00c0001000100002a" \
+                         "300004c06b668e"
+
+RR_A_WITH_JUMP__ = "c00c00010001000882c00004c661be35"
+
+COM_NS = {"a.gtld-servers.net": "192.5.6.30"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def a_record(name: str, addr: str, ttl: int = 3600) -> DnsResourceRecord:
+    return DnsResourceRecord(name, QType.A, QClass.IN, ttl, rdata=ARecord(ipaddress.IPv4Address(addr).packed))
+
+
+def ns_record(zone: str, ns_name: str, ttl: int = 3600) -> DnsResourceRecord:
+    raw = encode_name(ns_name)
+    return DnsResourceRecord(zone, QType.NS, QClass.IN, ttl, rdata=NSRecord(ByteBuffer(raw), len(raw)))
+
+
+def cname_record(name: str, target: str, ttl: int = 3600) -> DnsResourceRecord:
+    raw = encode_name(target)
+    return DnsResourceRecord(name, QType.CNAME, QClass.IN, ttl, rdata=CNAMERecord(ByteBuffer(raw), len(raw)))
+
+
+def soa_record(zone: str, ttl: int = 900, minimum_ttl: int = 60) -> DnsResourceRecord:
+    raw = encode_name(f"ns1.{zone}") + encode_name(f"hostmaster.{zone}") + \
+        (1).to_bytes(4, "big") * 4 + minimum_ttl.to_bytes(4, "big")
+    return DnsResourceRecord(zone, QType.SOA, QClass.IN, ttl, rdata=SOARecord(ByteBuffer(raw), len(raw)))
+
+
+def raw_query(qname: str, qtype: int, ID: int = 0xaaaa) -> bytes:
+    """Wire query asking recursively for a type number which need not be known to the parser"""
+    return struct.pack("!6H", ID, 0x0100, 1, 0, 0, 0) + encode_name(qname) + struct.pack("!2H", qtype, 1)
+
+
+def compressed_ptr(query: DnsMessage, targets: tuple[str, str]) -> bytes:
+    """Answer with owner names written out in full and the second PTR target compressed into the first one, offsets
+    which a re-encoded message does not keep"""
+    qname = encode_name(query.question[0].name)
+    header = struct.pack("!6H", query.header.ID, 0x8180, 1, 2, 0, 0)
+    question = qname + struct.pack("!2H", QType.PTR.value, 1)
+    first, (label, suffix) = encode_name(targets[0]), targets[1].split(".", 1)
+    pointer = len(header) + len(question) + len(qname) + 10 + first.index(encode_name(suffix))
+    second = bytes([len(label)]) + label.encode() + struct.pack("!H", 0xC000 | pointer)
+    return header + question + b"".join(qname + struct.pack("!2HIH", QType.PTR.value, 1, 3600, len(rdata)) + rdata
+                                        for rdata in (first, second))
+
+
+def response(qname: str, qtype: QType = QType.A, rcode: RCode = RCode.NO_ERROR, answer=(), authority=(),
+             additional=(), ID: int = 0xaaaa) -> DnsMessage:
+    msg = DnsMessage(header=DnsHeader(ID=ID, response=True, response_code=rcode))
+    msg.add_question(DnsQuestion(qname, qtype))
+    for rr in answer:
+        msg.add_resource_record(rr, "answer")
+    for rr in authority:
+        msg.add_resource_record(rr, "authority")
+    for rr in additional:
+        msg.add_resource_record(rr, "additional")
+    return msg
+
+
+def negative_response(qname: str, rcode: RCode, soa_ttl: int = 900, minimum_ttl: int = 60) -> DnsMessage:
+    return response(qname, rcode=rcode, authority=[soa_record("example.com", soa_ttl, minimum_ttl)])
+
+
+def referral(qname: str, zone: str, nameservers: dict, qtype: QType = QType.A, ttl: int = 3600) -> DnsMessage:
+    """Referral to zone, nameservers maps NS names onto glue addresses or None for glueless delegations"""
+    return response(qname, qtype,
+                    authority=[ns_record(zone, ns, ttl) for ns in nameservers],
+                    additional=[a_record(ns, addr, ttl) for ns, addr in nameservers.items() if addr])
+
+
+class ReusableTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class StubServer:
+    """Threaded UDP DNS server on localhost answering queries with handler(query) -> DnsMessage, raw bytes,
+    list of either (several datagrams) or None to drop the query
+    If tcp_handler is given the same port also accepts TCP connections carrying length framed queries"""
+
+    def __init__(self, handler, tcp_handler=None):
+        stub = self
+
+        def replies(result):
+            for reply in (result if isinstance(result, list) else [result]):
+                if reply is not None:
+                    yield reply if isinstance(reply, bytes) else reply.build_bytes()
+
+        class UdpHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                stub.queries.append(data)
+                for reply in replies(handler(DnsMessage().from_bytes(data))):
+                    sock.sendto(reply, self.client_address)
+
+        class TcpHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stub.tcp_connections += 1
+                while len(prefix := self.rfile.read(2)) == 2:
+                    data = self.rfile.read(int.from_bytes(prefix, "big"))
+                    stub.tcp_queries.append(data)
+                    for reply in replies(tcp_handler(DnsMessage().from_bytes(data))):
+                        self.wfile.write(len(reply).to_bytes(2, "big") + reply)
+
+        self.queries: list[bytes] = []
+        self.tcp_queries: list[bytes] = []
+        self.tcp_connections = 0
+        self.servers: list[socketserver.BaseServer] = []
+        if tcp_handler is not None:
+            self.servers.append(ReusableTCPServer(("127.0.0.1", 0), TcpHandler))
+        port = self.servers[0].server_address[1] if self.servers else 0
+        self.servers.append(socketserver.ThreadingUDPServer(("127.0.0.1", port), UdpHandler))
+        self.port = self.servers[-1].server_address[1]
+        for server in self.servers:
+            server.daemon_threads = True
+
+    def __enter__(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def answer_with(query: DnsMessage, answer=(), rcode: RCode = RCode.NO_ERROR, authority=()) -> DnsMessage:
+    """Response echoing ID and question of the query"""
+    q = query.question[0]
+    return response(q.name, q.qtype, rcode, answer=answer, authority=authority, ID=query.header.ID)
+
+
+async def ask(port: int, qname: str = "www.example.com", **kwargs):
+    """Quiet alookup of qname type A from 127.0.0.1:port, uncached and without stats, metrics or policy unless
+    kwargs pass them"""
+    options = dict(verbose=False, output=False, cache=None, stats=None, metrics=None, policy=None)
+    return await alookup(qname, QType.A, "127.0.0.1", port=port, **(options | kwargs))
+
+
+async def settle(pending):
+    """Waits until the background tasks pending() tracks are done"""
+    while len(pending()):
+        await asyncio.sleep(0.01)
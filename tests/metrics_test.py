@@ -0,0 +1,97 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from resolver.metrics import MetricsRegistry, ResolverMetrics
+from resolver.packet import DnsMessage
+from resolver.record_type import QType, RCode
+from resolver.resolver import alookup
+from tests.fixtures import StubServer, a_record, answer_with
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_counts_from_many_threads_are_merged(self):
+        registry = MetricsRegistry()
+        queries = registry.counter("queries_total", "Queries", ("server",))
+
+        def record():
+            for _ in range(1000):
+                queries.inc("192.0.2.1")
+            queries.inc("192.0.2.2", value=5)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual({("192.0.2.1",): 4000, ("192.0.2.2",): 20}, registry.snapshot()["queries_total"])
+
+        registry.clear()
+        self.assertEqual({}, registry.snapshot()["queries_total"])
+
+    def test_prometheus_text_format(self):
+        registry = MetricsRegistry()
+        registry.counter("responses_total", "Responses", ("server", "rcode")).inc("192.0.2.1", "NO_ERROR", value=3)
+        latency = registry.histogram("duration_seconds", "Latency", ("server",))
+        for ms in (1, 2, 50):
+            latency.observe(ms / 1000, "192.0.2.1")
+        registry.add_collector(lambda: [("entries", {"cache": "response"}, 7)], description="Entries")
+
+        text = registry.to_prometheus()
+        self.assertIn("# TYPE responses_total counter\n", text)
+        self.assertIn('responses_total{server="192.0.2.1",rcode="NO_ERROR"} 3\n', text)
+        self.assertIn("# TYPE duration_seconds histogram\n", text)
+        self.assertIn('duration_seconds_bucket{server="192.0.2.1",le="+Inf"} 3\n', text)
+        self.assertIn('duration_seconds_count{server="192.0.2.1"} 3\n', text)
+        self.assertIn('entries{cache="response"} 7\n', text)
+
+        buckets = [line for line in text.splitlines() if line.startswith("duration_seconds_bucket")]
+        counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+        self.assertEqual(sorted(counts), counts)  # Cumulative
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dns.prom")
+            registry.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(text, f.read())
+
+    def test_duplicate_metric_rejected(self):
+        registry = MetricsRegistry()
+        registry.counter("queries_total", "Queries")
+        with self.assertRaises(ValueError):
+            registry.counter("queries_total", "Queries")
+
+
+class ResolverMetricsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_lookup_records_responses_truncation_and_timeouts(self):
+        def handler(query: DnsMessage):
+            name = query.question[0].name
+            if name.startswith("drop"):
+                return None
+            reply = answer_with(query, rcode=RCode.NXDOMAIN if name.startswith("missing") else RCode.NO_ERROR)
+            reply.header.truncation = name.startswith("big")
+            return reply
+
+        def tcp_handler(query: DnsMessage):
+            return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+        metrics = ResolverMetrics()
+        with StubServer(handler, tcp_handler=tcp_handler) as stub:
+            for name, qtype in (("a.example.com", QType.A), ("missing.example.com", QType.MX),
+                                ("big.example.com", QType.A), ("drop.example.com", QType.A)):
+                await alookup(name, qtype, "127.0.0.1", verbose=False, output=False, cache=None, timeout=0.2,
+                              port=stub.port, stats=None, metrics=metrics)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual({("127.0.0.1", "A", "udp"): 3, ("127.0.0.1", "MX", "udp"): 1,
+                          ("127.0.0.1", "A", "tcp"): 1}, snapshot["dns_queries_total"])
+        self.assertEqual({("127.0.0.1", "NO_ERROR"): 2, ("127.0.0.1", "NXDOMAIN"): 1}, snapshot["dns_responses_total"])
+        self.assertEqual({("127.0.0.1",): 1}, snapshot["dns_truncated_total"])
+        self.assertEqual({("127.0.0.1", "truncated"): 1}, snapshot["dns_retries_total"])
+        self.assertEqual({("127.0.0.1", "A"): 1}, snapshot["dns_timeouts_total"])
+        self.assertEqual(2, snapshot["dns_query_duration_seconds"][("127.0.0.1", "A")].count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import ipaddress
+import os
+import struct
+import tempfile
+import unittest
+
+from resolver.pcap import CaptureSummary, TcpStreams, read_messages
+from resolver.record_type import QType
+from resolver.resolver import create_query
+from tests.fixtures import a_record, raw_query, response
+
+QUERY = create_query("www.example.com", QType.A).build_bytes()
+ANSWER = response("www.example.com", answer=[a_record("www.example.com", "192.0.2.1")]).build_bytes()
+
+
+def udp(payload: bytes, sport: int, dport: int) -> tuple[int, bytes]:
+    return 17, struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+
+
+def tcp(payload: bytes, sport: int, dport: int, seq: int, flags: int = 0x18) -> tuple[int, bytes]:
+    return 6, struct.pack("!HHIIBBHHH", sport, dport, seq, 0, 5 << 4, flags, 65535, 0, 0) + payload
+
+
+def ipv4(segment: tuple[int, bytes], src: str = "192.0.2.10", dst: str = "192.0.2.53", fragment: int = 0) -> bytes:
+    protocol, data = segment
+    return struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(data), 1, fragment, 64, protocol, 0,
+                       ipaddress.IPv4Address(src).packed, ipaddress.IPv4Address(dst).packed) + data
+
+
+def ipv6(segment: tuple[int, bytes], src: str = "2001:db8::10", dst: str = "2001:db8::53") -> bytes:
+    protocol, data = segment
+    return struct.pack("!IHBB16s16s", 6 << 28, len(data), protocol, 64, ipaddress.IPv6Address(src).packed,
+                       ipaddress.IPv6Address(dst).packed) + data
+
+
+def ethernet(packet: bytes, vlan: bool = False) -> bytes:
+    ethertype = struct.pack("!H", 0x86DD if packet[0] >> 4 == 6 else 0x0800)
+    tag = struct.pack("!HH", 0x8100, 42) if vlan else b""
+    return b"\x02" * 6 + b"\x04" * 6 + tag + ethertype + packet + b"\x00" * 8  # Trailing padding
+
+
+def pcap(frames: list[bytes], linktype: int = 1) -> bytes:
+    return struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, linktype) + \
+        b"".join(struct.pack("<IIII", 1700000000 + i, 500000, len(frame), len(frame)) + frame
+                 for i, frame in enumerate(frames))
+
+
+def pcapng(frames: list[bytes], linktype: int = 1) -> bytes:
+    def block(block_type: int, body: bytes) -> bytes:
+        body += b"\x00" * (-len(body) % 4)
+        return struct.pack("<II", block_type, len(body) + 12) + body + struct.pack("<I", len(body) + 12)
+
+    data = block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1))
+    data += block(1, struct.pack("<HHI", linktype, 0, 65535) + struct.pack("<HHB3x", 9, 1, 9) + b"\x00" * 4)
+    for i, frame in enumerate(frames):
+        timestamp = (1700000000 + i) * 10 ** 9
+        data += block(6, struct.pack("<IIIII", 0, timestamp >> 32, timestamp & 0xFFFFFFFF, len(frame), len(frame)) +
+                      frame)
+    return data
+
+
+class CaptureTest(unittest.TestCase):
+    def read(self, capture: bytes, **kwargs) -> tuple[list, CaptureSummary]:
+        with tempfile.NamedTemporaryFile(suffix=".pcap", delete=False) as f:
+            f.write(capture)
+        self.addCleanup(os.unlink, f.name)
+        summary = CaptureSummary()
+        return list(read_messages(f.name, summary=summary, **kwargs)), summary
+
+    def test_udp_over_ethernet_pcap(self):
+        frames = [ethernet(ipv4(udp(QUERY, 40000, 53))),
+                  ethernet(ipv4(udp(ANSWER, 53, 40000), src="192.0.2.53", dst="192.0.2.10")),
+                  ethernet(ipv4(udp(b"\x00" * 48, 40000, 123))),  # NTP
+                  ethernet(ipv4(udp(QUERY, 40000, 53), fragment=0x2000))]
+        messages, summary = self.read(pcap(frames))
+        self.assertEqual(2, len(messages))
+        query, answer = messages
+        self.assertEqual(("192.0.2.10", 40000, "192.0.2.53", 53, "udp"),
+                         (query.payload.src, query.payload.sport, query.payload.dst, query.payload.dport,
+                          query.payload.transport))
+        self.assertEqual(1700000000.5, query.payload.timestamp)
+        self.assertFalse(query.message.header.response)
+        self.assertEqual(["192.0.2.1"], answer.message.answer_records(QType.A))
+        self.assertIn("response 0xaaaa NO_ERROR www.example.com. A 1/0/0", answer.summary())
+        self.assertEqual((4, 2, 0), (summary.frames, summary.messages, summary.errors))
+
+    def test_ipv6_with_vlan_pcapng(self):
+        messages, _ = self.read(pcapng([ethernet(ipv6(udp(ANSWER, 53, 40000)), vlan=True)]))
+        record = messages[0].to_dict()
+        self.assertEqual(("2001:db8::10", 1700000000.0, "NO_ERROR"), (record["src"], record["time"], record["rcode"]))
+        self.assertEqual([{"name": "www.example.com.", "type": "A", "ttl": 3600, "data": "192.0.2.1"}],
+                         record["answer"])
+
+    def test_tcp_framed_messages_are_reassembled(self):
+        framed = [struct.pack("!H", len(m)) + m for m in (QUERY, QUERY, ANSWER)]
+        stream = framed[0] + framed[1] + framed[2]
+        split = len(framed[0]) + len(framed[1]) + 5
+        frames = [ipv4(tcp(b"", 40000, 53, 999, flags=0x02)),
+                  ipv4(tcp(stream[:split], 40000, 53, 1000)),
+                  ipv4(tcp(stream[:split], 40000, 53, 1000)),  # Retransmission
+                  ipv4(tcp(stream[split:], 40000, 53, 1000 + split, flags=0x19))]
+        messages, _ = self.read(pcap(frames, linktype=101))
+        self.assertEqual(["tcp"] * 3, [m.payload.transport for m in messages])
+        self.assertEqual([False, False, True], [m.message.header.response for m in messages])
+
+    def test_malformed_payload_and_custom_port(self):
+        frames = [ethernet(ipv4(udp(QUERY[:20], 40000, 5353))), ethernet(ipv4(udp(QUERY, 40000, 53)))]
+        messages, summary = self.read(pcap(frames), ports=[5353])
+        self.assertEqual(["MALFORMED"], [m.error for m in messages])
+        self.assertEqual(1, summary.errors)
+
+    def test_unknown_question_type_is_written_by_number(self):
+        messages, summary = self.read(pcap([ethernet(ipv4(udp(raw_query("www.example.com", 65), 40000, 53)))]))
+        self.assertIsNone(messages[0].error)
+        self.assertIn("query 0xaaaa www.example.com. TYPE65", messages[0].summary())
+        self.assertEqual([{"name": "www.example.com.", "type": "TYPE65"}], messages[0].to_dict()["question"])
+        self.assertEqual(0, summary.errors)
+
+    def test_not_a_capture(self):
+        for data in (b"\x00" * 64, b"", b"\xd4\xc3\xb2\xa1\x02\x00"):
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                self.read(data)
+
+
+class TcpStreamsTest(unittest.TestCase):
+    def test_gap_drops_incomplete_message(self):
+        streams = TcpStreams()
+        flow = ("a", 1, "b", 53)
+        framed = struct.pack("!H", len(QUERY)) + QUERY
+        self.assertEqual([], streams.feed(flow, 100, 0, framed[:10]))
+        self.assertEqual([QUERY], streams.feed(flow, 200, 0, framed))  # Rest of the first message was lost
+        self.assertEqual([QUERY], streams.feed(flow, 200 + len(framed), 0x01, framed))  # FIN ends the stream
+        self.assertEqual(0, len(streams.streams))
+
+    def test_streams_are_bounded(self):
+        streams = TcpStreams(max_streams=2)
+        for port in range(5):
+            streams.feed(("a", port, "b", 53), 0, 0, b"\x00\xff")
+        self.assertEqual([("a", 3, "b", 53), ("a", 4, "b", 53)], list(streams.streams))
+
+
+if __name__ == '__main__':
+    unittest.main()
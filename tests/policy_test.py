@@ -0,0 +1,136 @@
+import time
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsMessage
+from resolver.policy import QueryPolicy
+from resolver.record_type import QType, RCode
+from resolver.resolver import lookup, recursive_lookup
+from resolver.selection import ServerStat, ServerStatsTable
+from tests.fixtures import StubServer, a_record, answer_with, referral, response
+
+EXAMPLE_NS = {"ns1.example.com": "192.0.2.1", "ns2.example.com": "192.0.2.2", "ns3.example.com": "192.0.2.3"}
+
+
+class QueryPolicyTest(unittest.TestCase):
+    def test_adaptive_timeout(self):
+        policy = QueryPolicy(initial_timeout=1.0, min_timeout=0.05, max_timeout=4.0, backoff=2.0)
+        self.assertEqual(1.0, policy.timeout(None))
+        self.assertEqual(1.0, policy.timeout(ServerStat(srtt=0.01)))  # No samples yet
+        self.assertAlmostEqual(0.06, policy.timeout(ServerStat(srtt=0.02, rttvar=0.01, responses=3)))
+        self.assertAlmostEqual(0.24, policy.timeout(ServerStat(srtt=0.02, rttvar=0.01, responses=3), rounds=2))
+        self.assertEqual(0.05, policy.timeout(ServerStat(srtt=0.001, responses=3)))
+        self.assertEqual(4.0, policy.timeout(ServerStat(srtt=3.0, rttvar=1.0, timeouts=2), rounds=1))
+
+    def test_failover_rcodes(self):
+        policy = QueryPolicy()
+        self.assertTrue(policy.should_failover(None))
+        self.assertTrue(policy.should_failover(response("example.com", rcode=RCode.SERVFAIL)))
+        self.assertFalse(policy.should_failover(response("example.com", rcode=RCode.NXDOMAIN)))
+
+
+class FailoverTest(unittest.TestCase):
+    def setUp(self):
+        self.delegations = DelegationCache()
+        self.delegations.add_referral(referral("www.example.com", "example.com", EXAMPLE_NS))
+        self.stats = ServerStatsTable(explore=0.0)
+        for i, addr in enumerate(EXAMPLE_NS.values()):
+            self.stats.record_rtt(addr, 0.010 * (i + 1))
+
+    def resolve(self, answers: dict, policy: QueryPolicy = QueryPolicy()):
+        def fake_lookup(domain_name, record_type, server_ip, **kwargs):
+            return answers.get(server_ip)
+
+        network = mock.AsyncMock(side_effect=fake_lookup)
+        with mock.patch("resolver.resolver.alookup", network):
+            result = recursive_lookup("www.example.com", QType.A, output=False, cache=ResponseCache(),
+                                      delegations=self.delegations, stats=self.stats, policy=policy)
+        return result, network
+
+    def test_timeout_fails_over_to_next_fastest_address(self):
+        answer = response("www.example.com", answer=[a_record("www.example.com", "192.0.2.80")])
+        result, network = self.resolve({"192.0.2.2": answer})
+        self.assertEqual(["192.0.2.80"], result.answer_records(QType.A))
+        calls = [(call.kwargs["server_ip"], call.kwargs["timeout"]) for call in network.call_args_list]
+        self.assertEqual(["192.0.2.1", "192.0.2.2"], [addr for addr, _ in calls])
+        self.assertLess(calls[0][1], 0.1)  # Derived from the 10ms RTT, not a constant
+        self.assertIsNone(network.call_args_list[1].kwargs["policy"])
+
+    def test_servfail_fails_over(self):
+        answer = response("www.example.com", answer=[a_record("www.example.com", "192.0.2.80")])
+        servfail = response("www.example.com", rcode=RCode.SERVFAIL)
+        result, network = self.resolve({"192.0.2.1": servfail, "192.0.2.2": servfail, "192.0.2.3": answer})
+        self.assertEqual(["192.0.2.80"], result.answer_records(QType.A))
+        self.assertEqual(3, network.call_count)
+
+    def test_attempts_and_deadline_are_bounded(self):
+        result, network = self.resolve({}, QueryPolicy(max_attempts=5))
+        self.assertIsNone(result)
+        self.assertEqual(5, network.call_count)
+        self.assertEqual(["192.0.2.1", "192.0.2.2", "192.0.2.3", "192.0.2.1", "192.0.2.2"],
+                         [call.kwargs["server_ip"] for call in network.call_args_list])
+        self.assertGreater(network.call_args_list[3].kwargs["timeout"], network.call_args_list[0].kwargs["timeout"])
+
+        result, network = self.resolve({}, QueryPolicy(deadline=0.0))
+        self.assertIsNone(result)
+        self.assertEqual(0, network.call_count)
+
+
+class LookupRetryTest(unittest.TestCase):
+    def test_lost_query_is_retried(self):
+        dropped = []
+
+        def drop_first(query: DnsMessage):
+            if not dropped:
+                dropped.append(query)
+                return None
+            return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+        with StubServer(drop_first) as stub:
+            started = time.monotonic()
+            result = lookup("www.example.com", QType.A, "127.0.0.1", verbose=False, output=False, cache=None,
+                            port=stub.port, stats=None, metrics=None, policy=QueryPolicy(initial_timeout=0.1))
+            elapsed = time.monotonic() - started
+        self.assertEqual(["192.0.2.1"], result.answer_records(QType.A))
+        self.assertEqual(2, len(stub.queries))
+        self.assertLess(elapsed, 1.0)
+
+    def test_undecodable_response_fails_over(self):
+        def unknown_rcode_first(query: DnsMessage):
+            if len(stub.queries) > 1:
+                return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+            data = bytearray(answer_with(query).build_bytes())
+            data[3] |= 0x0F  # Unassigned RCODE 15
+            return bytes(data)
+
+        metrics = ResolverMetrics()
+        with StubServer(unknown_rcode_first) as stub:
+            result = lookup("www.example.com", QType.A, "127.0.0.1", verbose=False, output=False, cache=None,
+                            port=stub.port, stats=None, metrics=metrics, policy=QueryPolicy(initial_timeout=0.5))
+        self.assertEqual(["192.0.2.1"], result.answer_records(QType.A))
+        self.assertEqual({("127.0.0.1",): 1}, metrics.snapshot()["dns_errors_total"])
+
+    def test_retries_count_one_cache_miss(self):
+        cache = ResponseCache()
+        with StubServer(lambda query: None) as stub:
+            result = lookup("www.example.com", QType.A, "127.0.0.1", verbose=False, output=False, cache=cache,
+                            port=stub.port, stats=None, metrics=None,
+                            policy=QueryPolicy(initial_timeout=0.05, max_attempts=3))
+        self.assertIsNone(result)
+        self.assertEqual(3, len(stub.queries))
+        self.assertEqual(1, cache.misses)
+
+    def test_timeout_bounds_whole_lookup(self):
+        with StubServer(lambda query: None) as stub:
+            started = time.monotonic()
+            result = lookup("www.example.com", QType.A, "127.0.0.1", verbose=False, output=False, cache=None,
+                            timeout=0.3, port=stub.port, stats=None, metrics=None, policy=QueryPolicy())
+            elapsed = time.monotonic() - started
+        self.assertIsNone(result)
+        self.assertLess(elapsed, 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsMessage
+from resolver.prefetch import prefetcher
+from resolver.record_type import QType
+from resolver.resolver import arecursive_lookup
+from tests.fixtures import FakeClock, StubServer, a_record, answer_with, ask, response, settle
+
+
+def short_lived(query: DnsMessage):
+    return answer_with(query, [a_record(query.question[0].name, "192.0.2.1", ttl=100)])
+
+
+class PrefetchTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(clock=self.clock, prefetch_hits=2, prefetch_window=0.1)
+        self.metrics = ResolverMetrics()
+
+    async def ask(self, port: int, qname: str = "www.example.com"):
+        return await ask(port, qname, cache=self.cache, metrics=self.metrics, timeout=1)
+
+    async def settle(self):
+        await settle(prefetcher)
+
+    async def test_hot_entry_is_refreshed_before_it_expires(self):
+        with StubServer(short_lived) as stub:
+            await self.ask(stub.port)
+            await self.ask(stub.port)  # Hot but not expiring soon
+            self.clock.now += 95
+            await self.ask(stub.port)
+            await self.settle()
+            self.assertEqual(2, len(stub.queries))
+
+            self.clock.now += 50  # The entry first cached would have expired by now
+            cached = await self.ask(stub.port)
+            self.assertEqual(50, cached.answer[0].ttl)
+            self.assertEqual(2, len(stub.queries))
+        self.assertEqual(1, self.cache.prefetched_hits)
+        self.assertEqual({("refreshed",): 1}, self.metrics.snapshot()["dns_prefetches_total"])
+
+    async def test_cold_entry_expires(self):
+        with StubServer(short_lived) as stub:
+            await self.ask(stub.port)
+            self.clock.now += 95
+            await self.ask(stub.port)  # First hit, not hot yet
+            await self.settle()
+            self.assertEqual(1, len(stub.queries))
+        self.assertEqual({}, self.metrics.snapshot()["dns_prefetches_total"])
+
+    async def test_prefetches_are_capped(self):
+        self.cache.max_prefetches = 1
+        with StubServer(short_lived) as stub:
+            for qname in ("a.example.com", "b.example.com"):
+                await self.ask(stub.port, qname)
+                await self.ask(stub.port, qname)
+            self.clock.now += 95
+            await asyncio.gather(self.ask(stub.port, "a.example.com"), self.ask(stub.port, "a.example.com"),
+                                 self.ask(stub.port, "b.example.com"))
+            await self.settle()
+            self.assertEqual(3, len(stub.queries))
+        self.assertEqual({("refreshed",): 1, ("dropped",): 1}, self.metrics.snapshot()["dns_prefetches_total"])
+
+    async def test_recursive_resolution_is_refreshed(self):
+        caches = []
+
+        async def fake_lookup(domain_name, record_type, server_ip, **kwargs):
+            caches.append(kwargs["cache"])
+            return response(domain_name, answer=[a_record(domain_name, "192.0.2.80", ttl=100)])
+
+        self.cache.put(response("www.example.com", answer=[a_record("www.example.com", "192.0.2.80", ttl=100)]))
+        with mock.patch("resolver.resolver.alookup", mock.AsyncMock(side_effect=fake_lookup)):
+            for elapsed in (0, 0, 95):
+                self.clock.now += elapsed
+                await arecursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                        delegations=DelegationCache(), metrics=self.metrics)
+            await self.settle()
+        self.assertEqual([None], caches)  # The refresh asked past the cache
+        self.clock.now += 50
+        self.assertEqual(50, self.cache.get("www.example.com", QType.A).answer[0].ttl)
+        self.assertEqual(1, self.cache.prefetched_hits)
+        self.assertEqual({("refreshed",): 1}, self.metrics.snapshot()["dns_prefetches_total"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.policy import QueryPolicy
+from resolver.record_type import QType
+from resolver.resolver import MAX_CNAME_HOPS, arecursive_lookup, cname_chain, recursive_lookup
+from resolver.root_hints import ROOT_HINTS
+from tests.fixtures import COM_NS, a_record, answer_with, cname_record, referral, response
+
+EXAMPLE_NS = {"ns1.example.com": "192.0.2.53"}
+
+
+def fake_network(answers: dict):
+    """Returns lookup replacement answering iterative queries from (server_ip, qname) -> DnsMessage mapping"""
+    def fake_lookup(domain_name, record_type, server_ip, **kwargs):
+        return answers[(server_ip, domain_name)]
+
+    return mock.AsyncMock(side_effect=fake_lookup)
+
+
+class RecursiveLookupTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.delegations = DelegationCache()
+
+    def network(self):
+        answers = {}
+        for qname, addr in (("www.example.com", "192.0.2.80"), ("mail.example.com", "192.0.2.25")):
+            for root in ROOT_HINTS.values():
+                answers[(root, qname)] = referral(qname, "com", COM_NS)
+            answers[("192.5.6.30", qname)] = referral(qname, "example.com", EXAMPLE_NS)
+            answers[("192.0.2.53", qname)] = response(qname, answer=[a_record(qname, addr)])
+        return fake_network(answers)
+
+    def test_sibling_resolution_starts_at_zone_cut(self):
+        network = self.network()
+        with mock.patch("resolver.resolver.alookup", network):
+            first = recursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                     delegations=self.delegations)
+            self.assertEqual(["192.0.2.80"], first.answer_records(QType.A))
+            self.assertEqual(3, network.call_count)  # root -> com -> example.com
+
+            second = recursive_lookup("mail.example.com", QType.A, output=False, cache=self.cache,
+                                      delegations=self.delegations)
+            self.assertEqual(["192.0.2.25"], second.answer_records(QType.A))
+            self.assertEqual(4, network.call_count)  # Straight to example.com nameserver
+            self.assertEqual("192.0.2.53", network.call_args.kwargs["server_ip"])
+
+    def test_glueless_delegation_resolves_ns_address(self):
+        answers = {("192.0.2.99", "ns.example.net"): response("ns.example.net",
+                                                              answer=[a_record("ns.example.net", "192.0.2.54")]),
+                   ("192.0.2.54", "www.example.com"): response("www.example.com",
+                                                               answer=[a_record("www.example.com", "192.0.2.80")])}
+        self.delegations.add_referral(referral("ns.example.net", "net", {"ns.nic.net": "192.0.2.99"}))
+        for root in ROOT_HINTS.values():
+            answers[(root, "www.example.com")] = referral("www.example.com", "com", COM_NS)
+        answers[("192.5.6.30", "www.example.com")] = referral("www.example.com", "example.com",
+                                                              {"ns.example.net": None})
+        with mock.patch("resolver.resolver.alookup", fake_network(answers)):
+            result = recursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                      delegations=self.delegations)
+        self.assertEqual(["192.0.2.80"], result.answer_records(QType.A))
+        self.assertEqual(("example.com", [("ns.example.net", "192.0.2.54")]),
+                         self.delegations.closest("www.example.com"))
+
+
+    def test_resolution_counts_one_cache_miss(self):
+        def answer(msg, server, timeout):
+            return answer_with(msg, [a_record(msg.question[0].name, "192.0.2.80")]).build_bytes()
+
+        self.delegations.add_referral(referral("www.example.com", "example.com", EXAMPLE_NS))
+        transport = mock.Mock(query=mock.AsyncMock(side_effect=answer))
+        with mock.patch("resolver.resolver.udp_transport", return_value=transport):
+            for _ in range(2):
+                recursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                 delegations=self.delegations, metrics=None)
+        self.assertEqual(1, transport.query.call_count)
+        self.assertEqual((1, 1), (self.cache.misses, self.cache.hits))
+
+class CnameChainTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.delegations = DelegationCache()
+        self.delegations.add_referral(referral("example.com", "example.com", EXAMPLE_NS))
+
+    def resolve(self, answers: dict):
+        network = fake_network(answers)
+        with mock.patch("resolver.resolver.alookup", network):
+            result = recursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                      delegations=self.delegations)
+        return result, [call.args[0] for call in network.call_args_list]
+
+    def test_chain_within_answer_is_not_resolved_again(self):
+        chain = [cname_record("www.example.com", "web.example.com", ttl=300),
+                 cname_record("web.example.com", "cdn.example.com", ttl=60),
+                 a_record("cdn.example.com", "192.0.2.80", ttl=20)]
+        result, asked = self.resolve({("192.0.2.53", "www.example.com"): response("www.example.com", answer=chain)})
+        self.assertEqual(["www.example.com"], asked)
+        self.assertEqual(["192.0.2.80"], result.answer_records(QType.A))
+        self.assertEqual(3, len(result.answer))
+        self.assertEqual([300, 60, 20], [self.cache.get(name, QType.A).answer[0].ttl
+                                         for name in ("www.example.com", "web.example.com", "cdn.example.com")])
+
+    def test_only_the_tail_is_resolved(self):
+        chain = [cname_record("www.example.com", "edge.example.com"),
+                 cname_record("edge.example.com", "www.example.net")]
+        answers = {("192.0.2.53", "www.example.com"): response("www.example.com", answer=chain),
+                   ("192.0.2.99", "www.example.net"): response("www.example.net",
+                                                               answer=[a_record("www.example.net", "192.0.2.81")])}
+        self.delegations.add_referral(referral("example.net", "example.net", {"ns.example.net": "192.0.2.99"}))
+        result, asked = self.resolve(answers)
+        self.assertEqual(["www.example.com", "www.example.net"], asked)
+        self.assertEqual("www.example.com", result.question[0].name)
+        self.assertEqual(["edge.example.com", "www.example.net", "192.0.2.81"], [str(rr.rdata) for rr in result.answer])
+
+    def test_loops_and_long_chains_are_rejected(self):
+        loop = [cname_record("www.example.com", "web.example.com"), cname_record("web.example.com", "www.example.com")]
+        result, _ = self.resolve({("192.0.2.53", "www.example.com"): response("www.example.com", answer=loop)})
+        self.assertIsNone(result)
+        long_chain = [cname_record(f"{i}.example.com", f"{i + 1}.example.com") for i in range(MAX_CNAME_HOPS + 1)]
+        with self.assertRaises(ValueError):
+            cname_chain(long_chain, "0.example.com", QType.A)
+
+
+class GluelessResolutionTest(unittest.IsolatedAsyncioTestCase):
+    def glueless_network(self, nameservers, net_answer):
+        """example.com is delegated to nameservers without glue, their addresses are asked from the .net server
+        which answers with net_answer(qname)"""
+        async def fake_lookup(domain_name, record_type, server_ip, **kwargs):
+            await asyncio.sleep(0.01)
+            if server_ip in ROOT_HINTS.values():
+                if domain_name.endswith(".net"):
+                    return referral(domain_name, "net", {"ns.nic.net": "192.0.2.99"})
+                return referral(domain_name, "com", COM_NS)
+            if server_ip == "192.5.6.30":
+                return referral(domain_name, "example.com", {ns: None for ns in nameservers})
+            if server_ip == "192.0.2.99":
+                return await net_answer(domain_name)
+            return response(domain_name, answer=[a_record(domain_name, "192.0.2.80")])
+
+        return mock.AsyncMock(side_effect=fake_lookup)
+
+    async def resolve(self, policy: QueryPolicy = QueryPolicy()):
+        return await arecursive_lookup("www.example.com", QType.A, output=False, cache=ResponseCache(),
+                                       delegations=DelegationCache(), policy=policy)
+
+    async def test_broken_nameserver_does_not_stall_resolution(self):
+        cancelled = []
+
+        async def net_answer(qname):
+            if qname == "ns.fast.net":
+                await asyncio.sleep(0.05)  # Lets ns.broken.net reach the .net server before it is cancelled
+                return response(qname, answer=[a_record(qname, "192.0.2.54")])
+            try:
+                await asyncio.sleep(30)  # ns.broken.net cannot be resolved
+            except asyncio.CancelledError:
+                cancelled.append(qname)
+                raise
+
+        network = self.glueless_network(["ns.broken.net", "ns.fast.net"], net_answer)
+        started = time.monotonic()
+        with mock.patch("resolver.resolver.alookup", network):
+            for _ in range(3):  # Nameservers are tried in random order
+                result = await self.resolve()
+                self.assertEqual(["192.0.2.80"], result.answer_records(QType.A))
+        self.assertLess(time.monotonic() - started, 5)
+        await asyncio.sleep(0.05)
+        self.assertEqual(3, cancelled.count("ns.broken.net"))
+
+    async def test_glueless_chains_are_bounded(self):
+        async def net_answer(qname):
+            # Every nameserver is delegated to three more nameservers without glue, one level deeper
+            depth = int(qname.split(".")[1][1:])
+            return referral(qname, f"d{depth}.net", {f"{label}.d{depth + 1}.net": None for label in "abc"})
+
+        network = self.glueless_network([f"{label}.d1.net" for label in "abc"], net_answer)
+        with mock.patch("resolver.resolver.alookup", network):
+            result = await asyncio.wait_for(self.resolve(QueryPolicy(max_glueless=7)), timeout=5)
+        self.assertEqual([], result.answer)
+        nameserver_queries = [call for call in network.call_args_list if call.kwargs["server_ip"] == "192.0.2.99"]
+        self.assertLessEqual(len(nameserver_queries), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,45 +1,13 @@
 import binascii
 import unittest
 
-from resolver.packet import DnsHeader, DnsQuestion, QType, QClass, DnsResourceRecord, DnsMessage
-from resolver.buffer import ByteBuffer
+from resolver.packet import DnsHeader, DnsQuestion, QType, QClass, DnsResourceRecord, DnsMessage, LazyDnsMessage
+from resolver.buffer import ByteBuffer, ByteWriter, encode_name
+from resolver.record_type import MINFORecord, MXRecord, NSRecord, RData, SOARecord
+from resolver.resolver import parse_qtype
 from resolver.packet import RCode
-
-RESPONSE_NS_ROOT = "1b9d81800001000e0000001a0000020001000002000100070bf2001401660c726f6f742d73657276657273036e657400" \
-                   "000002000100070bf200040163c01e000002000100070bf20004016ac01e000002000100070bf20004016dc01e000002" \
-                   "000100070bf20004016bc01e000002000100070bf200040165c01e000002000100070bf20004016cc01e000002000100" \
-                   "070bf200040162c01e000002000100070bf200040161c01e000002000100070bf200040164c01e000002000100070bf2" \
-                   "00040169c01e000002000100070bf200040167c01e000002000100070bf200040168c01e00002e000100070bf2011300" \
-                   "0208000007e9006243e3d06232b2402647001dfbd924aea41fac479152a8b01572487d61d43af61a4f15a0a07d6c5dc2" \
-                   "0430493b9a4789368867f773c73e53c44fba1d36483e8680c5d16be32c9b300e899471acecc115330ebedb2613904bf0" \
-                   "9c460ee514fa3a7548f0c62d628312d3e170fe204767d56966e0f66c71ee81c88a560d36f4db9e155549cfb18d8e3037" \
-                   "3b7309b7b3776fc739156e745a08fb981dce58fee3c5a4a6a3738ae406d1ff1c93544a6e8f1b2473e6ddeb32170c8662" \
-                   "502dcc5b381c77d4517217550da09d6e17f5fac200b661a91869caf5fc93eebef1eaeece2e22c88665cce9462610ffcd" \
-                   "17e1554f43e56eb4fe0c21a9a09655e7696643f4b6f48b9e0743a49167a5f02a6a09c0e000010001000860680004c661" \
-                   "be35c0e0001c000100086068001020010500000100000000000000000053c01c00010001000861050004c00505f1c01c" \
-                   "001c000100088d14001020010500002f0000000000000000000fc03b0001000100085dc00004c021040cc03b001c0001" \
-                   "000888ee00102001050000020000000000000000000cc04a0001000100085f590004c03a801ec04a001c0001000861f4" \
-                   "0010200105030c2700000000000000020030c0590001000100085d980004ca0c1b21c059001c000100085dd000102001" \
-                   "0dc3000000000000000000000035c0680001000100085d740004c1000e81c068001c0001000860d10010200107fd0000" \
-                   "00000000000000000001c07700010001000881750004c0cbe60ac077001c00010008675400102001050000a800000000" \
-                   "00000000000ec086000100010008609f0004c707532ac086001c000100087009001020010500009f0000000000000000" \
-                   "0042c0950001000100085dbb0004c7090ec9c0a40001000100085d700004c6290004c0a4001c0001000861a300102001" \
-                   "0503ba3e00000000000000020030c0b300010001000861f00004c7075b0dc0b3001c0001000861f0001020010500002d" \
-                   "0000000000000000000dc0c200010001000861ec0004c0249411c0c2001c000100085ff90010200107fe000000000000" \
-                   "000000000053c0d10001000100089b130004c0702404c0d1001c000100088d1400102001050000120000000000000000" \
-                   "0d0d0000290200000080000000"
-
-QUERY_A_ROOT_SERVER = "e2b40100000100000000000001630c726f6f742d73657276657273036e65740000010001"
-
-QUERY_A_BERKELEY = "026373086265726b656c6579036564750000010001"
-
-RESPONSE_DNS_FRAME_A_WITH_JUMP = "08758180000100010000000001680c726f6f742d73657276657273036e65740000010001c00c0" \
-                                 "0010001000882c00004c661be35"
-
-RESPONSE_A_NS_BERKELEY = "62a6818000010001000000000561646e7333086265726b656c6579036564750000010001c00c0001000100002a" \
-                         "300004c06b668e"
-
-RR_A_WITH_JUMP__ = "c00c00010001000882c00004c661be35"
+from tests.fixtures import RESPONSE_NS_ROOT, QUERY_A_ROOT_SERVER, QUERY_A_BERKELEY, RESPONSE_DNS_FRAME_A_WITH_JUMP, \
+    RESPONSE_A_NS_BERKELEY, RR_A_WITH_JUMP__
 
 
 class MyTestCase(unittest.TestCase):
@@ -76,6 +44,35 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(4, record_a.rdlength)
         self.assertEqual("198.97.190.53", str(record_a.rdata))
 
+    def test_read_qname_memoizes_suffixes(self):
+        message = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_NS_ROOT))
+        bb = ByteBuffer(bytes.fromhex(RESPONSE_NS_ROOT))
+        DnsMessage().from_buffer(bb)
+        self.assertEqual("root-servers.net", next(name for name, _, _ in bb.names.values()
+                                                  if name.startswith("root")))
+        self.assertEqual(sorted(str(rr.rdata) for rr in message.answer if rr.qtype == QType.NS),
+                         [f"{letter}.root-servers.net" for letter in "abcdefghijklm"])
+
+        # Reading a name again from a memoized offset leaves the cursor right past it
+        bb.pos = 12
+        self.assertEqual("", bb.read_qname())
+        self.assertEqual(13, bb.pos)
+
+    def test_read_qname_rejects_pointer_loops_and_long_names(self):
+        header = bytes(12)
+        cases = {
+            "self": header + b"\xc0\x0c",
+            "mutual": header + b"\x01a\xc0\x10\x01b\xc0\x0c",
+            "forward": header + b"\xc0\x0e\x00",
+            "past end": header + b"\xc0",
+            "reserved": header + b"\x40a\x00",
+            "too long": header + b"\x3f" + b"a" * 63 + b"\x3f" + b"b" * 63 + b"\x3f" + b"c" * 63 +
+                        b"\x3f" + b"d" * 63 + b"\x00",
+        }
+        for case, data in cases.items():
+            with self.subTest(case), self.assertRaises(ValueError):
+                ByteBuffer(data, pos=len(header) if case != "mutual" else len(header) + 4).read_qname()
+
     def test_read_header_manual(self):
         bb = ByteBuffer(buf=bytes.fromhex(RESPONSE_NS_ROOT))
         ID = bb.read_uint16()
@@ -133,6 +130,144 @@ class MyTestCase(unittest.TestCase):
         message = question.build()
         self.assertEqual(QUERY_A_BERKELEY, message)
 
+    def test_read_bytes(self):
+        bb = ByteBuffer(buf=bytes.fromhex("026373086265726b656c65790365647500"))
+        self.assertEqual(b"\x02cs\x08", bb.read_bytes(4))
+        self.assertEqual(4, bb.pos)
+        with self.assertRaises(ValueError):
+            bb.read_bytes(100)
+
+    def test_rdata_kept_as_bytes(self):
+        msg = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        self.assertEqual(bytes.fromhex("c06b668e"), msg.answer[0].rdata.data)
+        self.assertEqual("c06b668e", repr(msg.answer[0].rdata))
+        self.assertEqual("192.107.102.142", str(msg.answer[0].rdata))
+
+    def test_header_flags_round_trip(self):
+        header = DnsHeader(ID=0x1234, response=True, opcode=2, authoritative_answer=True, truncation=True,
+                           recursion_desired=False, recursion_available=True, Z=0b101, response_code=RCode.REFUSED)
+        bw = header.write(ByteWriter())
+        self.assertEqual(bw.getvalue().hex(), header.build())
+        self.assertEqual(header, DnsHeader().from_buffer(ByteBuffer(bw.getvalue())))
+
+    def test_message_build_round_trip(self):
+        msg = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_NS_ROOT))
+        data = msg.build_bytes()
+        self.assertEqual(data.hex(), msg.build())
+
+        rebuilt = DnsMessage().from_bytes(data)
+        self.assertEqual(msg.header, rebuilt.header)
+        self.assertEqual(msg.question, rebuilt.question)
+        self.assertEqual([(r.name, r.qtype, r.ttl, str(r.rdata)) for r in msg.answer + msg.additional],
+                         [(r.name, r.qtype, r.ttl, str(r.rdata)) for r in rebuilt.answer + rebuilt.additional])
+
+    def test_build_query(self):
+        msg = DnsMessage().from_bytes(bytes.fromhex(QUERY_A_ROOT_SERVER))
+        self.assertEqual(QUERY_A_ROOT_SERVER, msg.build())
+
+    def test_compression_ns_referral(self):
+        msg = DnsMessage().from_bytes(bytes.fromhex(RESPONSE_NS_ROOT))
+        compressed = msg.build_bytes()
+        plain = msg.build_bytes(compress=False)
+        self.assertLess(len(compressed), len(plain))
+        self.assertLessEqual(len(compressed), len(bytes.fromhex(RESPONSE_NS_ROOT)))
+
+        rebuilt = DnsMessage().from_bytes(compressed)
+        self.assertEqual(msg.authority_ns(), rebuilt.authority_ns())
+        self.assertEqual([str(ans.rdata) for ans in msg.answer], [str(ans.rdata) for ans in rebuilt.answer])
+        self.assertEqual(msg.resolved_ns(target_section="answer"), rebuilt.resolved_ns(target_section="answer"))
+
+    def test_compression_pointer_read_qname(self):
+        bw = ByteWriter()
+        bw.write_qname("cs.berkeley.edu")
+        bw.write_qname("www.Berkeley.edu.")
+        bw.write_qname("berkeley.edu")
+        # "www" label followed by pointer to "berkeley.edu" at offset 3, then a bare pointer to the same suffix
+        self.assertEqual("026373086265726b656c65790365647500" "03777777c003" "c003", bw.getvalue().hex())
+
+        bb = ByteBuffer(bw.getvalue())
+        self.assertEqual("cs.berkeley.edu", bb.read_qname())
+        self.assertEqual("www.berkeley.edu", bb.read_qname())
+        self.assertEqual("berkeley.edu", bb.read_qname())
+        self.assertEqual(bb.pos, len(bb.buf))
+
+    def test_compression_rdata_names(self):
+        def rdata(cls, raw: bytes):
+            return cls(ByteBuffer(raw), len(raw))
+
+        soa_raw = encode_name("ns1.example.com") + encode_name("hostmaster.example.com") + bytes(range(20))
+        msg = DnsMessage(header=DnsHeader(response=True))
+        msg.add_question(DnsQuestion("example.com", QType.MX))
+        msg.add_resource_record(DnsResourceRecord("example.com", QType.MX, QClass.IN, 300,
+                                                  rdata=rdata(MXRecord, b"\x00\x0a" + encode_name("mx.example.com"))),
+                                "answer")
+        msg.add_resource_record(DnsResourceRecord("example.com", QType.NS, QClass.IN, 300,
+                                                  rdata=rdata(NSRecord, encode_name("ns1.example.com"))), "authority")
+        msg.add_resource_record(DnsResourceRecord("example.com", QType.SOA, QClass.IN, 300,
+                                                  rdata=rdata(SOARecord, soa_raw)), "authority")
+        minfo_raw = encode_name("hostmaster.example.com") + encode_name("errors.example.com")
+        msg.add_resource_record(DnsResourceRecord("example.com", QType.MINFO, QClass.IN, 300,
+                                                  rdata=rdata(MINFORecord, minfo_raw)), "additional")
+
+        compressed = msg.build_bytes()
+        self.assertLess(len(compressed), len(msg.build_bytes(compress=False)))
+
+        rebuilt = DnsMessage().from_bytes(compressed)
+        mx, ns, soa = rebuilt.answer[0].rdata, rebuilt.authority[0].rdata, rebuilt.authority[1].rdata
+        self.assertEqual((10, "mx.example.com"), (mx.mx_preference, mx.name))
+        self.assertEqual("ns1.example.com", ns.name)
+        self.assertEqual(("ns1.example.com", "hostmaster.example.com"), (soa.primary_ns, soa.responsible_mx))
+        self.assertEqual(msg.authority[1].rdata.minimum_ttl, soa.minimum_ttl)
+        self.assertEqual(len(ns.data), rebuilt.authority[0].rdlength)
+        minfo = rebuilt.additional[0].rdata
+        self.assertEqual(("hostmaster.example.com", "errors.example.com"),
+                         (minfo.responsible_mailbox, minfo.error_mailbox))
+
+    def test_unknown_types_and_classes_are_opaque(self):
+        msg = DnsMessage(header=DnsHeader(response=True))
+        msg.add_question(DnsQuestion("example.com", QType(65), QClass(3)))
+        https = DnsResourceRecord("example.com", QType(65), QClass.IN, 300, rdata=RData(b"\x00\x01\x00"))
+        msg.add_resource_record(https, "answer")
+        rebuilt = DnsMessage().from_bytes(msg.build_bytes())
+        self.assertIs(QType(65), rebuilt.question[0].qtype)
+        self.assertEqual(("TYPE65", "CLASS3"), (rebuilt.question[0].qtype.name, rebuilt.question[0].qclass.name))
+        self.assertEqual(b"\x00\x01\x00", rebuilt.answer[0].rdata.data)
+        self.assertIs(QType(65), parse_qtype("type65"))
+        with self.assertRaises(ValueError):
+            QType(0x10000)
+
+    def test_skip_qname(self):
+        bb = ByteBuffer(buf=bytes.fromhex(RR_A_WITH_JUMP__))
+        self.assertEqual(2, bb.skip_qname().pos)
+        bb = ByteBuffer(buf=bytes.fromhex(QUERY_A_BERKELEY))
+        self.assertEqual(17, bb.skip_qname().pos)
+
+    def test_lazy_message_decodes_on_access(self):
+        data = bytes.fromhex(RESPONSE_NS_ROOT)
+        msg = LazyDnsMessage().from_bytes(data)
+        self.assertEqual(RCode.NO_ERROR, msg.header.response_code)
+        self.assertIsNone(msg._sections)  # Header only so far
+
+        self.assertEqual({"question": 1, "answer": 14, "authority": 0, "additional": 26}, msg.skip_sections())
+        self.assertEqual("m.root-servers.net", str(msg.answer[3].rdata))
+        self.assertEqual(1, sum(item is not None for item in msg.answer.items))
+        self.assertEqual(0, sum(item is not None for item in msg.additional.items))
+
+        eager = DnsMessage().from_bytes(data)
+        self.assertEqual(eager, msg.materialize())
+        self.assertEqual(eager.resolved_ns(target_section="answer"), msg.resolved_ns(target_section="answer"))
+        self.assertEqual(data.hex(), msg.build())
+
+    def test_lazy_message_mutation_and_errors(self):
+        msg = LazyDnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY))
+        msg.add_pseudo_record(1232)
+        self.assertEqual(2, len(msg.additional) + len(msg.answer))
+        self.assertEqual(1232, DnsMessage().from_bytes(msg.build_bytes()).additional[0].qclass)
+
+        truncated = LazyDnsMessage().from_bytes(bytes.fromhex(RESPONSE_A_NS_BERKELEY)[:-6])
+        with self.assertRaises(ValueError):
+            truncated.skip_sections()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.record_type import QType
+from resolver.resolver import recursive_lookup
+from resolver.root_hints import ROOT_HINTS
+from resolver.selection import ServerStatsTable
+from tests.fixtures import FakeClock, a_record, response
+
+SERVERS = [("ns1", "192.0.2.1"), ("ns2", "192.0.2.2"), ("ns3", "192.0.2.3")]
+
+
+class ServerStatsTableTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stats = ServerStatsTable(explore=0.0, clock=self.clock)
+
+    def test_prefers_lowest_smoothed_rtt(self):
+        self.stats.record_rtt("192.0.2.1", 0.200)
+        self.stats.record_rtt("192.0.2.2", 0.020)
+        self.stats.record_rtt("192.0.2.3", 0.080)
+        self.assertEqual(["ns2", "ns3", "ns1"], [name for name, _ in self.stats.order(SERVERS)])
+
+        for _ in range(10):
+            self.stats.record_rtt("192.0.2.2", 0.300)
+        self.assertEqual(("ns3", "192.0.2.3"), self.stats.select(SERVERS))
+        self.assertAlmostEqual(0.3, self.stats.get("192.0.2.2").srtt, delta=0.02)
+
+    def test_unknown_servers_are_probed_first(self):
+        self.stats.record_rtt("192.0.2.1", 0.050)
+        self.assertNotEqual("ns1", self.stats.select(SERVERS)[0])
+
+    def test_timeouts_penalize_and_back_off(self):
+        for addr in ("192.0.2.1", "192.0.2.2", "192.0.2.3"):
+            self.stats.record_rtt(addr, 0.010)
+        self.stats.record_timeout("192.0.2.1", timeout=2.0)
+        self.assertEqual(2.0, self.stats.get("192.0.2.1").srtt)
+        self.assertEqual("ns1", self.stats.order(SERVERS)[-1][0])
+
+        self.stats.record_timeout("192.0.2.2", timeout=2.0)
+        self.stats.record_timeout("192.0.2.2", timeout=2.0)
+        self.assertEqual(4.0, self.stats.get("192.0.2.2").srtt)
+        self.assertEqual(self.clock.now + 1.0, self.stats.get("192.0.2.2").backoff_until)
+        self.assertEqual(["ns3", "ns1", "ns2"], [name for name, _ in self.stats.order(SERVERS)])
+
+        # Backed off servers are still returned when nothing else is left
+        self.assertEqual(("ns2", "192.0.2.2"), self.stats.select(SERVERS[1:2]))
+
+        self.clock.now += 1.0
+        self.stats.record_rtt("192.0.2.2", 0.010)
+        self.assertEqual((0, 0.0), (self.stats.get("192.0.2.2").consecutive_timeouts,
+                                    self.stats.get("192.0.2.2").backoff_until))
+
+    def test_exploration_probes_slower_servers(self):
+        stats = ServerStatsTable(explore=1.0, clock=self.clock)
+        stats.record_rtt("192.0.2.1", 0.010)
+        stats.record_rtt("192.0.2.2", 0.500)
+        self.assertEqual(("ns2", "192.0.2.2"), stats.select(SERVERS[:2]))
+
+    def test_snapshot_is_inspectable(self):
+        self.stats.record_rtt("192.0.2.1", 0.010)
+        snapshot = self.stats.snapshot()
+        snapshot["192.0.2.1"].srtt = 1.0
+        self.assertEqual(0.010, self.stats.get("192.0.2.1").srtt)
+        self.assertIn("192.0.2.1", str(self.stats))
+
+
+class RecursiveSelectionTest(unittest.TestCase):
+    def test_recursive_lookup_queries_fastest_root(self):
+        stats = ServerStatsTable(explore=0.0)
+        for addr in ROOT_HINTS.values():
+            stats.record_rtt(addr, 0.100)
+        stats.record_rtt(ROOT_HINTS["k.root-servers.net"], 0.001)
+
+        answer = response("example.com", answer=[a_record("example.com", "192.0.2.80")])
+        network = mock.AsyncMock(return_value=answer)
+        with mock.patch("resolver.resolver.alookup", network):
+            recursive_lookup("example.com", QType.A, output=False, cache=ResponseCache(),
+                             delegations=DelegationCache(), stats=stats)
+        self.assertEqual(ROOT_HINTS["k.root-servers.net"], network.call_args.kwargs["server_ip"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import unittest
+
+from resolver.buffer import ByteBuffer
+from resolver.cache import ResponseCache
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsHeader, DnsMessage, DnsResourceRecord
+from resolver.policy import QueryPolicy
+from resolver.record_type import QClass, QType, RCode, RData
+from resolver.resolver import alookup
+from resolver.server import DnsServer, forward_to
+from tests.fixtures import StubServer, a_record, answer_with, ask, compressed_ptr, raw_query
+
+
+def upstream(query: DnsMessage):
+    qname = query.question[0].name
+    if qname.endswith("in-addr.arpa"):
+        return compressed_ptr(query, ("mail.example.com", "www.example.com"))
+    if qname.startswith("drop"):
+        return None
+    if query.question[0].qtype.value == 65:  # HTTPS, unknown to the parser
+        return answer_with(query, [DnsResourceRecord(qname, QType(65), QClass.IN, 300, rdata=RData(b"\x00\x01\x00"))])
+    if qname.startswith("big"):
+        return answer_with(query, [a_record(qname, f"192.0.2.{i}") for i in range(1, 51)])
+    return answer_with(query, [a_record(qname, "192.0.2.1")])
+
+
+class DnsServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stub = StubServer(upstream).__enter__()
+        resolve = forward_to("127.0.0.1", self.stub.port, cache=ResponseCache(),
+                             policy=QueryPolicy(initial_timeout=0.5, deadline=1.0))
+        self.server = await DnsServer(resolve, port=0).start()
+
+    async def asyncTearDown(self):
+        self.server.close()
+        self.stub.__exit__(None, None, None)
+
+    async def ask(self, qname: str, transport: str = "udp", opt_size=4096, metrics=None):
+        return await ask(self.server.port, qname, metrics=metrics, transport=transport, opt_size=opt_size, timeout=2)
+
+    async def test_answers_over_udp_and_tcp_from_cache(self):
+        udp = await self.ask("WWW.example.com")
+        self.assertEqual(["192.0.2.1"], udp.answer_records(QType.A))
+        self.assertEqual("WWW.example.com", udp.question[0].name)  # Question of the client is echoed
+        self.assertTrue(udp.header.recursion_available)
+        tcp = await self.ask("www.example.com", transport="tcp")
+        self.assertEqual(["192.0.2.1"], tcp.answer_records(QType.A))
+        self.assertEqual(1, len(self.stub.queries))  # Second answer came from cache
+
+    async def test_upstream_timeout_is_servfail(self):
+        response = await self.ask("drop.example.com")
+        self.assertEqual(RCode.SERVFAIL, response.header.response_code)
+
+    async def test_large_answer_truncated_for_classic_clients(self):
+        metrics = ResolverMetrics()
+        response = await self.ask("big.example.com", opt_size=None, metrics=metrics)
+        self.assertEqual(50, len(response.answer))
+        self.assertEqual({("127.0.0.1",): 1}, metrics.snapshot()["dns_truncated_total"])
+        self.assertEqual(50, len((await self.ask("big.example.com", opt_size=1232)).answer))  # Fits EDNS payload
+
+    async def test_compressed_ptr_answer_is_forwarded_intact(self):
+        response = await alookup("1.2.0.192.in-addr.arpa", QType.PTR, "127.0.0.1", port=self.server.port,
+                                 verbose=False, output=False, cache=None, stats=None, metrics=None, policy=None)
+        self.assertEqual(["mail.example.com", "www.example.com"], response.answer_records(QType.PTR))
+
+    async def test_malformed_queries(self):
+        reply = await self.server.handle(bytes.fromhex("12340100000100000000000003777777"), udp=True)
+        header = DnsHeader().from_buffer(ByteBuffer(reply))
+        self.assertEqual((0x1234, RCode.FORMERR), (header.ID, header.response_code))
+        self.assertIsNone(await self.server.handle(b"\x12\x34\x01", udp=True))
+
+        query = DnsMessage(header=DnsHeader(ID=7, opcode=2))
+        reply = DnsMessage().from_bytes(await self.server.handle(query.build_bytes(), udp=True))
+        self.assertEqual(RCode.NOTIMP, reply.header.response_code)
+
+    async def test_unknown_query_type_is_forwarded(self):
+        reply = DnsMessage().from_bytes(await self.server.handle(raw_query("www.example.com", 65, ID=0x1234), udp=True))
+        self.assertEqual((0x1234, RCode.NO_ERROR), (reply.header.ID, reply.header.response_code))
+        self.assertEqual(("www.example.com", "TYPE65"), (reply.question[0].name, reply.question[0].qtype.name))
+        self.assertEqual([(QType(65), b"\x00\x01\x00")], [(rr.qtype, rr.rdata.data) for rr in reply.answer])
+
+    async def test_many_concurrent_clients(self):
+        names = [f"host{i}.example.com" for i in range(500)]
+        responses = await asyncio.gather(*(self.ask(name) for name in names))
+        self.assertEqual(500, len([r for r in responses if r is not None and r.answer]))
+
+
+if __name__ == '__main__':
+    unittest.main()
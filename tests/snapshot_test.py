@@ -0,0 +1,87 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache, cache_key
+from resolver.packet import DnsMessage, LazyDnsMessage
+from resolver.record_type import QType, RCode
+from resolver.resolver import create_query
+from resolver.snapshot import load_snapshot, save_snapshot
+from tests.fixtures import FakeClock, a_record, compressed_ptr, negative_response, referral, response
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.snap")
+        self.clock = FakeClock()
+        self.cache = ResponseCache(clock=self.clock)
+        self.delegations = DelegationCache(clock=self.clock)
+
+    def restored(self, later: float = 0.0) -> tuple[ResponseCache, DelegationCache, int]:
+        """Caches of a process started later seconds after the snapshot was saved"""
+        clock = FakeClock()
+        cache, delegations = ResponseCache(clock=clock), DelegationCache(clock=clock)
+        wall = time.time() + later
+        with mock.patch("resolver.snapshot.time.time", return_value=wall):
+            restored = load_snapshot(self.path, cache, delegations)
+        return cache, delegations, restored
+
+    def test_round_trip(self):
+        self.cache.put(response("www.example.com", answer=[a_record("www.example.com", "192.0.2.1", ttl=300)]))
+        self.cache.put(negative_response("nx.example.com", RCode.NXDOMAIN))
+        self.clock.now += 30
+        self.cache.get("www.example.com", QType.A)  # Most recently used
+        self.delegations.add_referral(referral("www.example.com", "example.com", {"ns1.example.com": "192.0.2.53"}))
+        self.assertEqual(3, save_snapshot(self.path, self.cache, self.delegations))
+
+        cache, delegations, restored = self.restored()
+        self.assertEqual(3, restored)
+        self.assertEqual(["nx.example.com", "www.example.com"], [name for name, _, _ in cache.entries])
+        self.assertIsInstance(cache.entries[cache_key("www.example.com", QType.A)].message, LazyDnsMessage)
+        answer = cache.get("WWW.example.com", QType.A)
+        self.assertEqual(["192.0.2.1"], answer.answer_records(QType.A))
+        self.assertEqual(270, answer.answer[0].ttl)  # Aged by the time spent in cache before saving
+        self.assertEqual(RCode.NXDOMAIN, cache.get("nx.example.com", QType.A).header.response_code)
+        self.assertEqual(("example.com", [("ns1.example.com", "192.0.2.53")]), delegations.closest("a.example.com"))
+
+    def test_compressed_names_survive_round_trip(self):
+        query = create_query("1.2.0.192.in-addr.arpa", QType.PTR)
+        self.cache.put(DnsMessage().from_bytes(compressed_ptr(query, ("mail.example.com", "www.example.com"))))
+        save_snapshot(self.path, self.cache)
+
+        cache, _, _ = self.restored()
+        answer = cache.get("1.2.0.192.in-addr.arpa", QType.PTR)
+        self.assertEqual(["mail.example.com", "www.example.com"], answer.answer_records(QType.PTR))
+
+    def test_entries_expired_while_down_are_dropped(self):
+        self.cache.put(response("short.example.com", answer=[a_record("short.example.com", "192.0.2.1", ttl=60)]))
+        self.cache.put(response("long.example.com", answer=[a_record("long.example.com", "192.0.2.2", ttl=600)]))
+        save_snapshot(self.path, self.cache)
+
+        cache, _, restored = self.restored(later=120)
+        self.assertEqual(1, restored)
+        self.assertIsNone(cache.get("short.example.com", QType.A))
+        self.assertEqual(600 - 120, cache.get("long.example.com", QType.A).answer[0].ttl)
+
+    def test_lazy_entries_age_consistently(self):
+        self.cache.put(response("www.example.com", answer=[a_record("www.example.com", "192.0.2.1", ttl=300)]))
+        save_snapshot(self.path, self.cache)
+        cache, _, _ = self.restored()
+        cache.clock.now += 10
+        self.assertEqual(290, cache.get("www.example.com", QType.A).answer[0].ttl)
+        cache.clock.now += 10
+        self.assertEqual(280, cache.get("www.example.com", QType.A).answer[0].ttl)
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot at all, just some text")
+        with self.assertRaises(ValueError):
+            load_snapshot(self.path, ResponseCache())
+
+
+if __name__ == '__main__':
+    unittest.main()
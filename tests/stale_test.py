@@ -0,0 +1,88 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.coalesce import single_flight
+from resolver.metrics import ResolverMetrics
+from resolver.packet import DnsMessage
+from resolver.policy import QueryPolicy
+from resolver.record_type import QType, RCode
+from resolver.resolver import arecursive_lookup
+from tests.fixtures import FakeClock, StubServer, a_record, answer_with, ask, cname_record, response, settle
+
+
+class ServeStaleTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ResponseCache(clock=self.clock, stale_window=3600)
+        self.metrics = ResolverMetrics()
+        self.policy = QueryPolicy(initial_timeout=0.3, max_attempts=2, deadline=0.6, stale_timeout=0.1)
+        self.mode = "answer"
+
+        def upstream(query: DnsMessage):
+            if self.mode == "drop":
+                return None
+            if self.mode == "servfail":
+                return answer_with(query, rcode=RCode.SERVFAIL)
+            return answer_with(query, [a_record(query.question[0].name, "192.0.2.1", ttl=60)])
+
+        self.stub = StubServer(upstream).__enter__()
+        self.addCleanup(self.stub.__exit__, None, None, None)
+
+    async def ask(self):
+        return await ask(self.stub.port, cache=self.cache, metrics=self.metrics, policy=self.policy)
+
+    async def settle(self):
+        await settle(single_flight)
+
+    async def test_stale_answer_while_upstream_is_unresponsive(self):
+        await self.ask()
+        self.clock.now += 120
+        self.mode = "drop"
+        started = time.monotonic()
+        stale = await self.ask()
+        self.assertLess(time.monotonic() - started, self.policy.deadline)
+        self.assertEqual(["192.0.2.1"], stale.answer_records(QType.A))
+        self.assertEqual(30, stale.answer[0].ttl)
+        self.assertEqual({("timeout",): 1}, self.metrics.snapshot()["dns_stale_answers_total"])
+
+        await self.settle()  # The refresh left running in the background gives up
+        self.mode = "answer"
+        await self.ask()
+        await self.settle()  # Within stale_timeout or not, the refresh replaces the stale entry
+        fresh = self.cache.get("www.example.com", QType.A)
+        self.assertEqual(60, fresh.answer[0].ttl)
+
+    async def test_stale_answer_on_server_failure(self):
+        self.policy.stale_timeout = 2.0
+        await self.ask()
+        self.clock.now += 120
+        self.mode = "servfail"
+        self.assertEqual(30, (await self.ask()).answer[0].ttl)
+        self.assertEqual({("failure",): 1}, self.metrics.snapshot()["dns_stale_answers_total"])
+
+    async def test_nothing_served_past_stale_window(self):
+        await self.ask()
+        self.clock.now += 60 + 3600
+        self.mode = "drop"
+        self.assertIsNone(await self.ask())
+        self.assertEqual({}, self.metrics.snapshot()["dns_stale_answers_total"])
+
+    async def test_recursive_stale_answer_follows_cname(self):
+        async def unreachable(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        self.cache.put(response("www.example.com", answer=[cname_record("www.example.com", "cdn.example.net", 60)]))
+        self.cache.put(response("cdn.example.net", answer=[a_record("cdn.example.net", "192.0.2.7", ttl=20)]))
+        self.clock.now += 120
+        with mock.patch("resolver.resolver.alookup", mock.AsyncMock(side_effect=unreachable)):
+            stale = await arecursive_lookup("www.example.com", QType.A, output=False, cache=self.cache,
+                                            delegations=DelegationCache(), metrics=self.metrics, policy=self.policy)
+        self.assertEqual(["192.0.2.7"], stale.answer_records(QType.A))
+        self.assertEqual(20, stale.answer[0].ttl)
+
+
+if __name__ == '__main__':
+    unittest.main()
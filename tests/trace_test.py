@@ -0,0 +1,109 @@
+import json
+import unittest
+from unittest import mock
+
+from resolver.cache import DelegationCache, ResponseCache
+from resolver.packet import DnsMessage
+from resolver.record_type import QType
+from resolver.resolver import create_query, lookup, recursive_lookup
+from resolver.root_hints import ROOT_HINTS
+from resolver.trace import Span
+from tests.fixtures import COM_NS, StubServer, a_record, answer_with, referral, response
+
+
+def traced_network(answers: dict):
+    """Like fake_network in recursive_test but records a query span for every lookup"""
+    def fake_lookup(domain_name, record_type, server_ip, trace=None, **kwargs):
+        result = answers[(server_ip, domain_name)]
+        if trace is not None:
+            trace.child(f"query {domain_name}", server=server_ip).finish(result.header.response_code.name)
+        return result
+
+    return mock.AsyncMock(side_effect=fake_lookup)
+
+
+class SpanTest(unittest.TestCase):
+    def test_waterfall_and_json(self):
+        root = Span("www.example.com A", kind="lookup", start=10.0)
+        query = root.child("query www.example.com A @a.root-servers.net", server="198.41.0.4")
+        query.start, query.bytes_out, query.bytes_in = 10.0, 40, 500
+        query.phases = {"encode": 0.0001, "network": 0.02, "decode": 0.0002}
+        query.finish("NO_ERROR")
+        query.end = 10.025
+        sub = root.child("resolve ns.example.net. A", kind="resolve")
+        sub.start, sub.end, sub.outcome = 10.025, 10.1, "NO_ERROR"
+        root.end, root.outcome = 10.1, "NO_ERROR"
+
+        lines = root.waterfall(width=20).splitlines()
+        self.assertEqual("<<TRACE>> www.example.com A 100.0ms", lines[0])
+        self.assertEqual(4, len(lines))
+        self.assertIn("|#####               |", lines[2])  # Query takes the first quarter
+        self.assertIn("|     ###############|", lines[3])
+        self.assertIn("out 40B in 500B", lines[2])
+        self.assertIn("network 20.00ms", lines[2])
+
+        exported = json.loads(root.to_json())
+        self.assertEqual(["query", "resolve"], [span["kind"] for span in exported["children"]])
+        self.assertAlmostEqual(0.025, exported["children"][0]["duration"])
+        self.assertEqual("198.41.0.4", exported["children"][0]["server"])
+
+
+class ResolutionTraceTest(unittest.TestCase):
+    def test_glueless_sub_resolution_is_nested(self):
+        answers = {("192.0.2.99", "ns.example.net"): response("ns.example.net",
+                                                              answer=[a_record("ns.example.net", "192.0.2.54")]),
+                   ("192.0.2.54", "www.example.com"): response("www.example.com",
+                                                               answer=[a_record("www.example.com", "192.0.2.80")])}
+        delegations = DelegationCache()
+        delegations.add_referral(referral("ns.example.net", "net", {"ns.nic.net": "192.0.2.99"}))
+        for root in ROOT_HINTS.values():
+            answers[(root, "www.example.com")] = referral("www.example.com", "com", COM_NS)
+        answers[("192.5.6.30", "www.example.com")] = referral("www.example.com", "example.com",
+                                                              {"ns.example.net": None})
+        trace = Span("www.example.com A", kind="lookup")
+        with mock.patch("resolver.resolver.alookup", traced_network(answers)):
+            recursive_lookup("www.example.com", QType.A, output=False, cache=ResponseCache(),
+                             delegations=delegations, trace=trace)
+
+        resolve = trace.children[0]
+        self.assertEqual("resolve www.example.com. A", resolve.name)
+        self.assertEqual("NO_ERROR", resolve.outcome)
+        self.assertEqual(["query", "query", "resolve", "query"], [span.kind for span in resolve.children])
+        glue = resolve.children[2]
+        self.assertEqual("resolve ns.example.net. A", glue.name)
+        self.assertEqual(["192.0.2.99"], [span.server for span in glue.children])
+        self.assertLessEqual(resolve.start, glue.start)
+        self.assertLessEqual(glue.end, resolve.end)
+
+    def test_query_phases_with_tcp_retry(self):
+        def truncated(query: DnsMessage):
+            reply = answer_with(query)
+            reply.header.truncation = True
+            return reply
+
+        def full(query: DnsMessage):
+            return answer_with(query, [a_record(query.question[0].name, "192.0.2.1")])
+
+        trace = Span("big.example.com A", kind="lookup")
+        with StubServer(truncated, tcp_handler=full) as stub:
+            result = lookup("big.example.com", QType.A, "127.0.0.1", verbose=False, output=False, cache=None,
+                            port=stub.port, stats=None, metrics=None, trace=trace)
+        self.assertIsNotNone(result)
+        query = trace.children[0]
+        self.assertEqual("query", query.kind)
+        self.assertEqual("NO_ERROR", query.outcome)
+        self.assertEqual(["encode", "network", "tcp", "decode"], list(query.phases))
+        self.assertEqual(2 * len(create_query("big.example.com", QType.A).build_bytes()), query.bytes_out)
+        self.assertGreater(query.bytes_in, len(result.build_bytes()))  # Truncated UDP response counts too
+
+    def test_timeout_outcome(self):
+        trace = Span("drop.example.com A", kind="lookup")
+        with StubServer(lambda query: None) as stub:
+            self.assertIsNone(lookup("drop.example.com", QType.A, "127.0.0.1", verbose=False, output=False,
+                                     cache=None, timeout=0.1, port=stub.port, stats=None, metrics=None, trace=trace))
+        self.assertEqual("TIMEOUT", trace.children[0].outcome)
+        self.assertIn("network", trace.children[0].phases)
+
+
+if __name__ == '__main__':
+    unittest.main()
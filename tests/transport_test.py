@@ -0,0 +1,171 @@
+import asyncio
+import time
+import unittest
+
+from resolver.cache import ResponseCache
+from resolver.packet import DnsMessage
+from resolver.record_type import QType
+from resolver.resolver import alookup, lookup
+from resolver.buffer import UINT16
+from resolver.transport import TcpTransport, UdpTransport
+from resolver.resolver import create_query
+from tests.fixtures import StubServer, a_record, answer_with
+
+
+def address_of(qname: str) -> str:
+    return f"192.0.2.{int(qname.split('.')[0][4:]) % 250 + 1}"
+
+
+def echo_address(query: DnsMessage) -> DnsMessage:
+    qname = query.question[0].name
+    return answer_with(query, [a_record(qname, address_of(qname))])
+
+
+class UdpTransportTest(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_queries_share_sockets(self):
+        with StubServer(echo_address) as stub:
+            names = [f"host{i}.example.com" for i in range(300)]
+            responses = await asyncio.gather(*(alookup(name, QType.A, "127.0.0.1", verbose=False, cache=None,
+                                                       port=stub.port, output=False) for name in names))
+        for name, response in zip(names, responses):
+            self.assertEqual([address_of(name)], response.answer_records(QType.A))
+        self.assertEqual(300, len(stub.queries))
+
+    async def test_out_of_order_responses(self):
+        def slow_first(query: DnsMessage):
+            if query.question[0].name.startswith("host0."):
+                time.sleep(0.3)
+            return echo_address(query)
+
+        with StubServer(slow_first) as stub:
+            transport = UdpTransport(pool_size=1)
+            first = create_query("host0.example.com", QType.A)
+            second = create_query("host1.example.com", QType.A)
+            second.header.ID = first.header.ID  # Same ID towards the same server is reassigned
+            done = []
+
+            async def query(msg):
+                data = await transport.query(msg, ("127.0.0.1", stub.port), timeout=2)
+                done.append(DnsMessage().from_bytes(data).question[0].name)
+
+            await asyncio.gather(query(first), query(second))
+            transport.close()
+        self.assertEqual(["host1.example.com", "host0.example.com"], done)
+
+    async def test_sockets_are_replaced_and_dead_ones_dropped(self):
+        with StubServer(echo_address) as stub:
+            transport = UdpTransport(pool_size=1, max_queries=2)
+            used = []
+            for i in range(6):
+                await transport.query(create_query(f"host{i}.example.com", QType.A), ("127.0.0.1", stub.port), 2)
+                used.append(transport.protocols[0])
+            self.assertEqual(3, len(set(used)))
+            self.assertEqual([True, True, False], [p.closed for p in dict.fromkeys(used)])
+
+            used[-1].transport.close()
+            await asyncio.sleep(0.01)
+            await transport.query(create_query("host9.example.com", QType.A), ("127.0.0.1", stub.port), 2)
+            self.assertEqual(1, len(transport.protocols))
+            self.assertIsNot(used[-1], transport.protocols[0])
+            transport.close()
+
+    async def test_mismatched_responses_are_dropped(self):
+        def spoofing(query: DnsMessage):
+            wrong_id = echo_address(query)
+            wrong_id.header.ID ^= 0xFFFF
+            wrong_question = answer_with(query, [a_record("host1.example.com", "203.0.113.1")])
+            wrong_question.question[0].name = "host1.example.com"
+            return [wrong_id, wrong_question, b"\x00garbage", echo_address(query)]
+
+        with StubServer(spoofing) as stub:
+            response = await alookup("host7.example.com", QType.A, "127.0.0.1", verbose=False, cache=None,
+                                     port=stub.port, output=False)
+        self.assertEqual([address_of("host7.example.com")], response.answer_records(QType.A))
+
+    async def test_per_query_timeout(self):
+        with StubServer(lambda query: None) as stub:
+            started = time.monotonic()
+            response = await alookup("host1.example.com", QType.A, "127.0.0.1", verbose=False, cache=None,
+                                     timeout=0.2, port=stub.port, output=False)
+        self.assertIsNone(response)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+class TcpTransportTest(unittest.IsolatedAsyncioTestCase):
+    async def test_truncated_response_retried_over_tcp(self):
+        def truncated(query: DnsMessage):
+            reply = answer_with(query)
+            reply.header.truncation = True
+            return reply
+
+        with StubServer(truncated, tcp_handler=echo_address) as stub:
+            response = await alookup("host5.example.com", QType.A, "127.0.0.1", verbose=False, cache=None,
+                                     port=stub.port, output=False)
+        self.assertFalse(response.header.truncation)
+        self.assertEqual([address_of("host5.example.com")], response.answer_records(QType.A))
+        self.assertEqual((1, 1), (len(stub.queries), len(stub.tcp_queries)))
+
+    async def test_explicit_tcp_reuses_connection(self):
+        with StubServer(lambda query: None, tcp_handler=echo_address) as stub:
+            for i in range(3):
+                response = await alookup(f"host{i}.example.com", "A", "127.0.0.1", verbose=False, cache=None,
+                                         port=stub.port, output=False, transport="tcp")
+                self.assertEqual([address_of(f"host{i}.example.com")], response.answer_records(QType.A))
+            responses = await asyncio.gather(*(alookup(f"host{i}.example.com", "A", "127.0.0.1", verbose=False,
+                                                       cache=None, port=stub.port, output=False, transport="tcp")
+                                               for i in range(20)))
+            self.assertEqual(20, len([r for r in responses if r is not None]))
+        self.assertEqual(0, len(stub.queries))
+        self.assertEqual(23, len(stub.tcp_queries))
+        self.assertEqual(1, stub.tcp_connections)
+
+    async def test_pipelined_out_of_order_responses(self):
+        connections = 0
+
+        async def reversing_server(reader, writer):
+            nonlocal connections
+            connections += 1
+            frames = []
+            for _ in range(2):
+                frames.append(await reader.readexactly(UINT16.unpack(await reader.readexactly(2))[0]))
+            for frame in reversed(frames):
+                reply = echo_address(DnsMessage().from_bytes(frame)).build_bytes()
+                writer.write(UINT16.pack(len(reply)) + reply)
+            await writer.drain()
+
+        server = await asyncio.start_server(reversing_server, "127.0.0.1", 0)
+        address = server.sockets[0].getsockname()[:2]
+        transport = TcpTransport()
+        first, second = create_query("host1.example.com", QType.A), create_query("host2.example.com", QType.A)
+        second.header.ID = first.header.ID
+        replies = await asyncio.gather(transport.query(first, address, timeout=2),
+                                       transport.query(second, address, timeout=2))
+        transport.close()
+        server.close()
+        self.assertNotEqual(first.header.ID, second.header.ID)
+        self.assertEqual(["host1.example.com", "host2.example.com"],
+                         [DnsMessage().from_bytes(reply).question[0].name for reply in replies])
+        self.assertEqual(1, connections)
+
+    async def test_connection_refused(self):
+        with StubServer(lambda query: None) as stub:
+            pass
+        response = await alookup("host1.example.com", "A", "127.0.0.1", verbose=False, cache=None, port=stub.port,
+                                 output=False, transport="tcp")
+        self.assertIsNone(response)
+
+
+class SyncWrapperTest(unittest.TestCase):
+    def test_lookup_runs_on_background_loop(self):
+        cache = ResponseCache()
+        with StubServer(echo_address) as stub:
+            response = lookup("host3.example.com", "a", "127.0.0.1", verbose=False, output=False, cache=cache,
+                              port=stub.port)
+            self.assertEqual([address_of("host3.example.com")], response.answer_records(QType.A))
+            lookup("host3.example.com", "a", "127.0.0.1", verbose=False, output=False, cache=cache, port=stub.port)
+        self.assertEqual(1, len(stub.queries))
+        self.assertEqual(1, cache.hits)
+
+
+if __name__ == '__main__':
+    unittest.main()
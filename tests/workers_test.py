@@ -0,0 +1,58 @@
+import functools
+import os
+import signal
+import socket
+import sys
+import time
+import unittest
+
+from benchmarks.load import generate, upstream, warm
+from resolver.cache import ResponseCache
+from resolver.server import forward_to
+from resolver.workers import Supervisor, free_port, serve_worker
+from tests.fixtures import StubServer
+
+
+def crash():
+    sys.exit(3)
+
+
+class SupervisorTest(unittest.TestCase):
+    def test_crashed_worker_is_restarted(self):
+        supervisor = Supervisor(crash, workers=2, min_uptime=0.0)
+        with supervisor:
+            deadline = time.monotonic() + 5
+            while supervisor.restarts < 2 and time.monotonic() < deadline:
+                supervisor.supervise(0.5)
+        self.assertGreaterEqual(supervisor.restarts, 2)
+        self.assertEqual(0, supervisor.alive())
+
+    def test_worker_failing_at_startup_is_restarted_after_delay(self):
+        with Supervisor(crash, workers=1, min_uptime=10.0, restart_delay=0.3) as supervisor:
+            started = time.monotonic()
+            while supervisor.restarts == 0 and time.monotonic() - started < 5:
+                supervisor.supervise(1.0)
+            self.assertGreaterEqual(time.monotonic() - started, 0.3)
+            self.assertEqual(1, supervisor.restarts)
+
+
+class ReusePortWorkersTest(unittest.TestCase):
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "SO_REUSEPORT not supported")
+    def test_workers_share_port_and_survive_kill(self):
+        port = free_port()
+        with StubServer(upstream) as stub:
+            make_resolve = functools.partial(forward_to, "127.0.0.1", stub.port, ResponseCache())
+            with Supervisor(functools.partial(serve_worker, make_resolve, "127.0.0.1", port), workers=2,
+                            min_uptime=0.0) as supervisor:
+                warm(port, names=10)
+                self.assertGreater(generate(port, names=10, duration=0.2, window=8), 0)
+
+                os.kill(supervisor.processes[0].pid, signal.SIGKILL)
+                self.assertEqual(1, supervisor.supervise(2.0))
+                self.assertEqual(2, supervisor.alive())
+                warm(port, names=10)
+                self.assertGreater(generate(port, names=10, duration=0.2, window=8), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()